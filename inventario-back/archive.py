@@ -0,0 +1,36 @@
+import argparse
+from datetime import date
+
+import crud
+from database import SessionLocal
+
+# Archivar meses completos de movimientos en ficheros NDJSON comprimidos
+# Uso: python archive.py --before 2025-01-01   (archiva todos los meses anteriores a enero de 2025)
+def main():
+    parser = argparse.ArgumentParser(description="Archivar movimientos antiguos en ficheros NDJSON comprimidos")
+    parser.add_argument(
+        "--before", type=date.fromisoformat,
+        help="Archivar los meses completos anteriores a esta fecha (AAAA-MM-DD)",
+    )
+    parser.add_argument("--dir", default=crud.MOVEMENTS_ARCHIVE_DIR, help="Carpeta de los ficheros de archivo")
+    parser.add_argument("--list", action="store_true", help="Mostrar los meses ya archivados y salir")
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        if args.list:
+            for archivo in crud.get_archives(db):
+                print(f"{archivo.range_start:%Y-%m}: {archivo.row_count} movimientos en {archivo.path}")
+            return
+        if args.before is None:
+            parser.error("Falta --before")
+        try:
+            archivados = crud.archive_movements(db, args.before, args.dir)
+        except ValueError as error:
+            parser.error(str(error))
+        for archivo in archivados:
+            print(f"{archivo.range_start:%Y-%m}: {archivo.row_count} movimientos -> {archivo.path}")
+        if not archivados:
+            print("No hay movimientos que archivar")
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,95 @@
-from fastapi import Depends, HTTPException, status
+from collections import OrderedDict
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt, ExpiredSignatureError
 from sqlalchemy.orm import Session
-from database import SessionLocal
-from models import User
+import hashlib
+import hmac
+import os
+import threading
+import time
+from database import get_db  # Misma dependencia que los endpoints: una sesión por petición
+import crud_async
 
 SECRET_KEY = "clave-super-secreta"  # Clave secreta para firmar y verificar JWT
 ALGORITHM = "HS256"  # Algoritmo para el cifrado del token JWT
 
+# Segundos que se reutiliza un usuario validado. La caché es de cada worker: tras un cambio de contraseña,
+# el worker que lo atiende la invalida al momento, pero los demás aceptan los tokens anteriores hasta
+# AUTH_CACHE_TTL segundos más (como mucho)
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))  # Máximo de usuarios en caché (LRU)
+# Usuarios (separados por comas) que pueden lanzar las tareas de mantenimiento (/analytics/rebuild, /alerts/rebuild)
+ADMIN_USERS = {nombre.strip() for nombre in os.getenv("ADMIN_USERS", "admin").split(",") if nombre.strip()}
+# Token que pueden enviar los scrapers de /metrics (Authorization: Bearer <token>). Vacío: solo administradores
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
 # Esquema OAuth2 para obtener token desde endpoint /login
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-# Función para obtener sesión de base de datos
-def get_db():
-    db = SessionLocal()  # Crear sesión
-    try:
-        yield db  # Proveer sesión para uso en endpoints
-    finally:
-        db.close()  # Cerrar sesión al finalizar
+# Usuario autenticado tal y como lo necesitan los endpoints (sin sesión ORM asociada)
+class Principal:
+    def __init__(self, id: int, username: str, token_version: str = None):
+        self.id = id
+        self.username = username
+        self.token_version = token_version
+
+# Versión del token: contador de cambios de contraseña del usuario. No depende del hash, así que el
+# rehash transparente del login (cambio de BCRYPT_ROUNDS) no invalida las demás sesiones
+def token_version(user) -> str:
+    return str(user.password_version or 0)
+
+# Versión de los tokens emitidos antes del contador (huella del hash). Se siguen aceptando mientras
+# el hash no cambie, para no cerrar todas las sesiones al actualizar
+def legacy_token_version(user) -> str:
+    return hashlib.sha256(user.hashed_password.encode()).hexdigest()[:12]
+
+# Claims de identidad que se firman en el token de acceso
+def token_claims(user) -> dict:
+    return {"sub": user.username, "ver": token_version(user)}
+
+# Caché LRU con caducidad de usuarios ya validados, por (username, versión del token)
+class PrincipalCache:
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, clave):
+        with self.lock:
+            entrada = self.entries.get(clave)
+            if entrada is None or entrada[0] < time.monotonic():
+                self.entries.pop(clave, None)  # Ausente o caducada
+                self.misses += 1
+                return None
+            self.entries.move_to_end(clave)  # Más reciente
+            self.hits += 1
+            return entrada[1]
+
+    def set(self, clave, principal: Principal):
+        with self.lock:
+            self.entries[clave] = (time.monotonic() + self.ttl, principal)
+            self.entries.move_to_end(clave)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)  # Expulsar la menos usada
+
+    # Olvidar todas las versiones de un usuario (p. ej. tras cambiar su contraseña)
+    def invalidate(self, username: str):
+        with self.lock:
+            for clave in [clave for clave in self.entries if clave[0] == username]:
+                del self.entries[clave]
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+principal_cache = PrincipalCache(AUTH_CACHE_TTL, AUTH_CACHE_SIZE)
 
 # Función para obtener el usuario actual según token JWT
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     # Excepción a lanzar si el token no es válido o no se puede autenticar
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,  # Código HTTP 401
@@ -44,9 +113,36 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         # Cualquier otro error en token: lanzar excepción general de credenciales inválidas
         raise credentials_exception
 
+    version = payload.get("ver")  # Ausente en tokens emitidos antes de existir la claim
+    clave = (username, version)
+    principal = principal_cache.get(clave)
+    if principal is not None:
+        return principal  # Usuario ya validado recientemente
+
     # Buscar usuario en base de datos por username obtenido
-    user = db.query(User).filter(User.username == username).first()
+    user = await crud_async.get_user_by_username(db, username)
     if user is None:
         raise credentials_exception  # Si no existe usuario, lanzar excepción
+    if version is not None and version not in (token_version(user), legacy_token_version(user)):
+        raise credentials_exception  # Token emitido antes de un cambio de contraseña
+
+    principal = Principal(user.id, user.username, version)
+    principal_cache.set(clave, principal)
+    return principal  # Devolver usuario válido para uso en endpoint
+
+# Usuario autenticado que además es administrador (para endpoints de mantenimiento)
+async def get_admin_user(current_user: Principal = Depends(get_current_user)):
+    if current_user.username not in ADMIN_USERS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Se requieren permisos de administrador",
+        )
+    return current_user
 
-    return user  # Devolver usuario válido para uso en endpoint
+# Acceso a /metrics: con METRICS_TOKEN, el token de los scrapers; sin él (o con otro token), un administrador
+async def require_metrics_access(request: Request, db: Session = Depends(get_db)):
+    cabecera = request.headers.get("authorization", "")
+    token = cabecera[7:] if cabecera.lower().startswith("bearer ") else ""
+    if METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return
+    await get_admin_user(await get_current_user(token, db))
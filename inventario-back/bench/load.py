@@ -0,0 +1,447 @@
+# Prueba de carga de la API: N clientes concurrentes repiten peticiones reales (login, catálogo,
+# historial, ajustes de cantidad...) durante un tiempo fijo y se informa en JSON, por operación,
+# del rendimiento, la latencia (p50/p95/p99) y las consultas a la base de datos por petición
+#
+#   python bench/load.py --scenario mixed --concurrency 32 --duration 30 --output resultado.json
+#   python bench/load.py --scenario mixed --baseline resultado.json   # Falla si empeora respecto a otra ejecución
+#   python bench/load.py --scenario write --idempotency-keys --retry-rate 0.1   # Escrituras con Idempotency-Key y reintentos
+#
+# Sin --url arranca uvicorn con la base de datos de DATABASE_URL (conviene cargarla antes con bench/seed.py)
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+import httpx
+
+DIRECTORIO_API = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Peso de cada operación en cada escenario
+SCENARIOS = {
+    "mixed": {"login": 5, "items": 35, "movements": 30, "update": 30},  # Uso normal de la aplicación
+    "read": {"items": 30, "item": 20, "movements": 25, "item_movements": 25},
+    "write": {"update": 60, "movement": 40},  # Contención sobre las filas de los items más usados
+    "login": {"login": 100},  # Tormenta de logins (bcrypt)
+    "history": {"movements": 50, "item_movements": 50},  # Historial reciente (comparar con distintos tamaños)
+    "snapshot": {"snapshot": 100},  # Stock a una fecha pasada
+    "analytics": {"throughput": 40, "top_movers": 30, "turnover": 30},
+    "scan": {"scan": 80, "resolve": 5, "movement": 15},  # Escáneres: resolver el código de barras y registrar el movimiento
+}
+
+# -------------------------
+# Operaciones: cada una devuelve (método, ruta, argumentos de httpx)
+# -------------------------
+
+def random_item(ctx):
+    # Distribución sesgada: pocos items concentran la mayoría de peticiones, como en bench/seed.py
+    return ctx.item_ids[int(len(ctx.item_ids) * ctx.rng.random() ** 3)]
+
+def random_day(ctx) -> date:
+    return date.today() - timedelta(days=ctx.rng.randint(0, ctx.days))
+
+def op_login(ctx):
+    return "POST", "/login", {"data": {"username": ctx.rng.choice(ctx.users), "password": ctx.password}}
+
+def op_scan(ctx):
+    return "GET", f"/items/by-ean/{ctx.ean13s[random_item(ctx)]}", {}
+
+def op_resolve(ctx):
+    codigos = [ctx.ean13s[random_item(ctx)] for _ in range(50)]
+    return "POST", "/items/resolve", {"json": {"ean13": codigos}}
+
+def op_items(ctx):
+    parametros = {"limit": 100, "sort": ctx.rng.choice(["id", "sku", "-quantity"])}
+    return "GET", "/items", {"params": parametros}
+
+def op_item(ctx):
+    return "GET", f"/items/{random_item(ctx)}", {}
+
+def op_movements(ctx):
+    return "GET", "/movements", {"params": {"limit": 100}}
+
+def op_item_movements(ctx):
+    return "GET", f"/items/{random_item(ctx)}/movements", {"params": {"limit": 50}}
+
+def op_update(ctx):
+    item_id = random_item(ctx)
+    cantidad = ctx.rng.randint(0, 1000)
+    return "PUT", f"/items/{item_id}", {"json": {"quantity": cantidad}, "headers": ctx.auth, "event": (item_id, cantidad)}
+
+def op_movement(ctx):
+    tipo = ctx.rng.choice(["entrada", "salida"])
+    datos = {"item_id": random_item(ctx), "type": tipo, "amount": ctx.rng.randint(1, 5)}
+    return "POST", "/movements", {"json": datos, "headers": ctx.auth}
+
+def op_snapshot(ctx):
+    instante = datetime.combine(random_day(ctx), datetime.min.time()) + timedelta(seconds=ctx.rng.randint(0, 86399))
+    return "GET", "/items/snapshot", {"params": {"at": instante.isoformat()}, "headers": ctx.auth}
+
+def op_throughput(ctx):
+    parametros = {"group_by": "item", "period": "week", "item_id": random_item(ctx)}
+    return "GET", "/analytics/throughput", {"params": parametros, "headers": ctx.auth}
+
+def op_top_movers(ctx):
+    parametros = {"desde": (date.today() - timedelta(days=30)).isoformat(), "limit": 20}
+    return "GET", "/analytics/top-movers", {"params": parametros, "headers": ctx.auth}
+
+def op_turnover(ctx):
+    hasta = random_day(ctx)
+    parametros = {"desde": (hasta - timedelta(days=30)).isoformat(), "hasta": hasta.isoformat(), "limit": 100}
+    return "GET", "/analytics/turnover", {"params": parametros, "headers": ctx.auth}
+
+OPERATIONS = {
+    "login": op_login, "items": op_items, "item": op_item, "movements": op_movements,
+    "item_movements": op_item_movements, "update": op_update, "movement": op_movement,
+    "snapshot": op_snapshot, "throughput": op_throughput, "top_movers": op_top_movers, "turnover": op_turnover,
+    "scan": op_scan, "resolve": op_resolve,
+}
+
+# -------------------------
+# Medición
+# -------------------------
+
+# Percentil por rango más cercano de una lista ordenada
+def percentile(ordenados: list, p: float):
+    if not ordenados:
+        return None
+    return ordenados[min(len(ordenados) - 1, max(0, math.ceil(p / 100 * len(ordenados)) - 1))]
+
+def latency_summary(segundos: list) -> dict:
+    ordenados = sorted(segundos)
+    if not ordenados:
+        return {}
+    return {
+        "mean": round(sum(ordenados) / len(ordenados) * 1000, 2),
+        **{f"p{p}": round(percentile(ordenados, p) * 1000, 2) for p in (50, 95, 99)},
+        "max": round(ordenados[-1] * 1000, 2),
+    }
+
+# Resultados de una operación: latencia, códigos de estado y consultas (cabecera X-DB-Queries)
+class OperationStats:
+    def __init__(self):
+        self.latencias = []
+        self.estados = Counter()
+        self.consultas = []
+
+    def record(self, duracion: float, estado, consultas):
+        self.latencias.append(duracion)
+        self.estados[str(estado)] += 1
+        if consultas is not None:
+            self.consultas.append(int(consultas))
+
+    # Resultados de todas las operaciones juntas
+    @classmethod
+    def merge(cls, todas):
+        total = cls()
+        for stats in todas:
+            total.latencias += stats.latencias
+            total.estados.update(stats.estados)
+            total.consultas += stats.consultas
+        return total
+
+    def summary(self, duracion: float) -> dict:
+        errores = sum(veces for estado, veces in self.estados.items() if not estado.startswith("2"))
+        return {
+            "requests": len(self.latencias),
+            "errors": errores,
+            "statuses": dict(sorted(self.estados.items())),
+            "throughput_rps": round(len(self.latencias) / duracion, 2),
+            "latency_ms": latency_summary(self.latencias),
+            "db_queries": {
+                "mean": round(sum(self.consultas) / len(self.consultas), 2),
+                "max": max(self.consultas),
+            } if self.consultas else None,
+        }
+
+# Estado compartido por los clientes virtuales
+class Context:
+    def __init__(self, client, args, items: dict, auth: dict):
+        self.client = client
+        self.rng = random.Random(args.seed)
+        self.item_ids = list(items)
+        self.ean13s = items  # id -> EAN13
+        self.auth = auth
+        self.users = args.users
+        self.password = args.password
+        self.days = args.days
+        self.escrituras = {}  # (item_id, cantidad) -> instante en que se envió la escritura, para medir la llegada de eventos
+        self.idempotency_keys = args.idempotency_keys
+        self.retry_rate = args.retry_rate
+        self.reintentos = Counter()  # Reintentos con la misma Idempotency-Key: enviados, repetidos y distintos
+
+# Enviar una petición; devuelve la respuesta (None si falla la conexión), el estado y las consultas
+async def send(ctx, metodo: str, ruta: str, opciones: dict):
+    try:
+        respuesta = await ctx.client.request(metodo, ruta, **opciones)
+        return respuesta, respuesta.status_code, respuesta.headers.get("x-db-queries")
+    except httpx.HTTPError as error:
+        return None, type(error).__name__, None
+
+async def virtual_user(ctx, nombres: list, pesos: list, stats: dict, medir_desde: float, fin: float):
+    while time.perf_counter() < fin:
+        nombre = ctx.rng.choices(nombres, pesos)[0]
+        metodo, ruta, opciones = OPERATIONS[nombre](ctx)
+        evento = opciones.pop("event", None)
+        escritura = metodo != "GET" and ruta != "/login"
+        if ctx.idempotency_keys and escritura:
+            opciones["headers"] = dict(opciones.get("headers", {}), **{"Idempotency-Key": uuid.uuid4().hex})
+        inicio = time.perf_counter()
+        if evento is not None:
+            ctx.escrituras[evento] = inicio
+        respuesta, estado, consultas = await send(ctx, metodo, ruta, opciones)
+        ahora = time.perf_counter()
+        if inicio >= medir_desde:  # Las peticiones del calentamiento no cuentan
+            stats.setdefault(nombre, OperationStats()).record(ahora - inicio, estado, consultas)
+
+        # Reintento de un escáner tras un timeout: misma petición y misma clave, debe repetir la respuesta
+        reintentable = ctx.idempotency_keys and escritura and respuesta is not None and respuesta.is_success
+        if reintentable and ctx.rng.random() < ctx.retry_rate:
+            inicio = time.perf_counter()
+            repetida, estado, consultas = await send(ctx, metodo, ruta, opciones)
+            ahora = time.perf_counter()
+            if inicio >= medir_desde:
+                stats.setdefault(f"{nombre}_retry", OperationStats()).record(ahora - inicio, estado, consultas)
+                ctx.reintentos["sent"] += 1
+                if repetida is not None and repetida.headers.get("idempotent-replayed") == "true":
+                    ctx.reintentos["replayed"] += 1
+                if repetida is None or repetida.status_code != respuesta.status_code or repetida.content != respuesta.content:
+                    ctx.reintentos["mismatched"] += 1
+
+# Cliente SSE: cuenta los eventos recibidos y el retraso desde que se envió la escritura correspondiente
+async def sse_client(ctx, resultado: dict, fin: float):
+    ultimo_id = None
+    while time.perf_counter() < fin:
+        cabeceras = {"Last-Event-ID": str(ultimo_id)} if ultimo_id is not None else {}
+        try:
+            async with ctx.client.stream("GET", "/events", headers=cabeceras, timeout=None) as respuesta:
+                async for linea in respuesta.aiter_lines():
+                    if linea.startswith("id: "):
+                        ultimo_id = int(linea[4:])
+                    elif linea.startswith("data: "):
+                        resultado["events"] += 1
+                        ahora = time.perf_counter()
+                        for item in json.loads(linea[6:]).get("items", []):
+                            enviado = ctx.escrituras.get((item.get("id"), item.get("quantity")))
+                            if enviado is not None:
+                                resultado["lag"].append(ahora - enviado)
+        except httpx.HTTPError:
+            pass
+        resultado["reconnects"] += 1  # El servidor cierra la conexión a los clientes lentos
+
+# -------------------------
+# Preparación
+# -------------------------
+
+async def login(client, usuario: str, password: str) -> dict:
+    respuesta = await client.post("/login", data={"username": usuario, "password": password})
+    if respuesta.status_code != 200:
+        raise SystemExit(f"No se pudo iniciar sesión como {usuario}: {respuesta.status_code} {respuesta.text}")
+    return {"Authorization": f"Bearer {respuesta.json()['access_token']}"}
+
+# Items para las peticiones, {id: EAN13} (recorriendo el catálogo paginado)
+async def sample_items(client, maximo: int) -> dict:
+    items, cursor = {}, None
+    while len(items) < maximo:
+        parametros = {"limit": min(1000, maximo - len(items))}
+        if cursor:
+            parametros["cursor"] = cursor
+        respuesta = await client.get("/items", params=parametros)
+        respuesta.raise_for_status()
+        items.update((item["id"], item["ean13"]) for item in respuesta.json())
+        cursor = respuesta.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    if not items:
+        raise SystemExit("La base de datos no tiene items: cárguela con bench/seed.py")
+    return items
+
+def free_port() -> int:
+    with socket.socket() as conexion:
+        conexion.bind(("127.0.0.1", 0))
+        return conexion.getsockname()[1]
+
+# Arrancar uvicorn con la configuración de la prueba; devuelve el proceso, la URL y el fichero de log
+def start_server(args):
+    puerto = free_port()
+    entorno = dict(os.environ, DB_ASYNC="1" if args.use_async else "0")
+    log = tempfile.NamedTemporaryFile(prefix="bench-uvicorn-", suffix=".log", delete=False)
+    proceso = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(puerto),
+         "--workers", str(args.workers), "--no-access-log"],
+        cwd=DIRECTORIO_API, env=entorno, stdout=log, stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{puerto}"
+    limite = time.time() + args.startup_timeout
+    while time.time() < limite:
+        if proceso.poll() is not None:
+            raise SystemExit(f"uvicorn terminó al arrancar (código {proceso.returncode}); log en {log.name}")
+        try:
+            if httpx.get(f"{url}/items", params={"limit": 1}, timeout=2).status_code == 200:
+                return proceso, url, log.name
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    proceso.terminate()
+    raise SystemExit(f"uvicorn no respondió en {args.startup_timeout} s; log en {log.name}")
+
+# -------------------------
+# Comparación con una ejecución anterior
+# -------------------------
+
+# Operaciones cuyo p95 sube o cuyo rendimiento baja más de un "tolerancia" por uno
+def compare(actual: dict, anterior: dict, tolerancia: float) -> list:
+    regresiones = []
+    for nombre, datos in actual["operations"].items():
+        base = anterior.get("operations", {}).get(nombre)
+        if not base or not base.get("latency_ms") or not datos.get("latency_ms"):
+            continue
+        p95, p95_base = datos["latency_ms"]["p95"], base["latency_ms"]["p95"]
+        if p95 > p95_base * (1 + tolerancia):
+            regresiones.append({"operation": nombre, "metric": "p95_ms", "baseline": p95_base, "current": p95})
+        rps, rps_base = datos["throughput_rps"], base["throughput_rps"]
+        if rps < rps_base * (1 - tolerancia):
+            regresiones.append({"operation": nombre, "metric": "throughput_rps", "baseline": rps_base, "current": rps})
+    return regresiones
+
+# Mezcla de operaciones de --mix ("items=40,update=60") o del escenario elegido
+def parse_mix(args) -> dict:
+    if not args.mix:
+        return SCENARIOS[args.scenario]
+    mezcla = {}
+    for parte in args.mix.split(","):
+        nombre, _, peso = parte.partition("=")
+        if nombre.strip() not in OPERATIONS:
+            raise SystemExit(f"Operación desconocida: {nombre} (disponibles: {', '.join(OPERATIONS)})")
+        mezcla[nombre.strip()] = float(peso or 1)
+    return mezcla
+
+async def run(args, url: str) -> dict:
+    mezcla = parse_mix(args)
+    limites = httpx.Limits(max_connections=args.concurrency + args.sse_clients + 1)
+    async with httpx.AsyncClient(base_url=url, limits=limites, timeout=args.timeout) as client:
+        auth = await login(client, args.users[0], args.password)
+        items = await sample_items(client, args.sample_items)
+        ctx = Context(client, args, items, auth)
+
+        stats = {}
+        sse = {"events": 0, "reconnects": 0, "lag": []}
+        inicio = time.perf_counter()
+        medir_desde = inicio + args.warmup
+        fin = medir_desde + args.duration
+        oyentes = [asyncio.create_task(sse_client(ctx, sse, fin)) for _ in range(args.sse_clients)]
+        await asyncio.gather(*[
+            virtual_user(ctx, list(mezcla), list(mezcla.values()), stats, medir_desde, fin)
+            for _ in range(args.concurrency)
+        ])
+        await asyncio.sleep(1 if oyentes else 0)  # Margen para que lleguen los últimos eventos
+        for oyente in oyentes:
+            oyente.cancel()
+        await asyncio.gather(*oyentes, return_exceptions=True)
+        duracion = args.duration  # Se cuentan las peticiones empezadas dentro del intervalo medido
+
+        resultado = {
+            "benchmark": "load",
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "config": {
+                "url": url,
+                "scenario": args.scenario if not args.mix else "custom",
+                "mix": mezcla,
+                "concurrency": args.concurrency,
+                "duration_s": args.duration,
+                "warmup_s": args.warmup,
+                "workers": args.workers if not args.url else None,
+                "async": args.use_async if not args.url else None,
+                "database": (os.getenv("DATABASE_URL") or "postgresql").split(":", 1)[0] if not args.url else None,
+                "items_sampled": len(items),
+                "idempotency_keys": args.idempotency_keys,
+                "retry_rate": args.retry_rate if args.idempotency_keys else None,
+                "seed": args.seed,
+            },
+            "totals": OperationStats.merge(stats.values()).summary(duracion),
+            "operations": {nombre: stats[nombre].summary(duracion) for nombre in sorted(stats)},
+        }
+        if args.sse_clients:
+            resultado["sse"] = {
+                "clients": args.sse_clients,
+                "events_received": sse["events"],
+                "reconnects": sse["reconnects"],
+                "delivery_lag_ms": latency_summary(sse["lag"]),
+            }
+        if args.idempotency_keys and args.retry_rate:
+            resultado["retries"] = {clave: ctx.reintentos[clave] for clave in ("sent", "replayed", "mismatched")}
+        if args.check_ledger:
+            # Cada movimiento debe partir de la cantidad del anterior y cada item coincidir con su último movimiento
+            informe = (await client.get("/snapshots/check", headers=auth)).json()
+            resultado["ledger"] = {clave: valor for clave, valor in informe.items() if not clave.endswith("_samples")}
+        return resultado
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de la API de inventario")
+    parser.add_argument("--url", help="API ya arrancada (por defecto se arranca uvicorn con DATABASE_URL)")
+    parser.add_argument("--workers", type=int, default=1, help="Workers de uvicorn (sin --url)")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Arrancar la API con DB_ASYNC=1 (sin --url)")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed", help="Mezcla de operaciones")
+    parser.add_argument("--mix", help="Mezcla propia, p. ej. items=40,update=60 (sustituye a --scenario)")
+    parser.add_argument("--concurrency", type=int, default=16, help="Clientes simultáneos")
+    parser.add_argument("--duration", type=float, default=30, help="Segundos medidos")
+    parser.add_argument("--warmup", type=float, default=5, help="Segundos de calentamiento (no se miden)")
+    parser.add_argument("--timeout", type=float, default=60, help="Timeout de cada petición")
+    parser.add_argument("--sse-clients", type=int, default=0, help="Clientes conectados a /events durante la prueba")
+    parser.add_argument("--users", default="bench1", help="Usuarios para login, separados por comas (los de bench/seed.py)")
+    parser.add_argument("--password", default="bench", help="Contraseña de los usuarios")
+    parser.add_argument("--days", type=int, default=365, help="Días hacia atrás para fechas de fotos y analítica")
+    parser.add_argument("--sample-items", type=int, default=10000, help="Items usados en las peticiones")
+    parser.add_argument("--seed", type=int, default=1, help="Semilla de la elección de operaciones")
+    parser.add_argument("--idempotency-keys", action="store_true", help="Enviar las escrituras con una Idempotency-Key nueva")
+    parser.add_argument("--retry-rate", type=float, default=0, help="Fracción de escrituras repetidas con la misma clave (con --idempotency-keys)")
+    parser.add_argument("--check-ledger", action="store_true", help="Comprobar la coherencia del historial al terminar")
+    parser.add_argument("--output", help="Fichero donde guardar el resultado JSON")
+    parser.add_argument("--baseline", help="Resultado JSON anterior con el que comparar")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Empeoramiento tolerado frente a --baseline")
+    parser.add_argument("--startup-timeout", type=float, default=120, help="Segundos esperando a que arranque uvicorn")
+    args = parser.parse_args()
+    args.users = [usuario.strip() for usuario in args.users.split(",") if usuario.strip()]
+
+    proceso = None
+    url = args.url
+    if url is None:
+        proceso, url, log = start_server(args)
+        print(f"API arrancada en {url} (log en {log})", file=sys.stderr)
+    try:
+        resultado = asyncio.run(run(args, url))
+    finally:
+        if proceso is not None:
+            proceso.terminate()
+            proceso.wait(timeout=30)
+
+    fallo = False
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fichero:
+            regresiones = compare(resultado, json.load(fichero), args.tolerance)
+        resultado["baseline"] = {"file": args.baseline, "tolerance": args.tolerance, "regressions": regresiones}
+        fallo = bool(regresiones)
+    if "ledger" in resultado and not resultado["ledger"].get("ok"):
+        fallo = True
+    if resultado.get("retries", {}).get("mismatched"):
+        fallo = True  # Un reintento ha recibido una respuesta distinta de la original
+
+    texto = json.dumps(resultado, indent=2)
+    print(texto)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fichero:
+            fichero.write(texto + "\n")
+    if fallo:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
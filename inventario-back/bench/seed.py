@@ -0,0 +1,211 @@
+# Catálogo sintético para benchmarks y pruebas de carga: items, historial de movimientos coherente
+# (cada movimiento parte de la cantidad del anterior), totales diarios, fotos de stock y usuarios
+#
+#   python bench/seed.py --items 100000 --movements 10000000 --days 730
+#
+# Usa la base de datos de DATABASE_URL (o de las variables DB_*), igual que la API.
+# Los datos son deterministas para una misma --seed: dos ejecuciones sobre bases vacías son comparables
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import bindparam, column, func, select, table, text, update
+
+import crud
+import migrations
+import partitions
+from database import SessionLocal, engine
+from models import DEFAULT_LOCATION_ID, Base, Item, ItemStock, Movement, User
+from schemas import ean13_check_digit
+from security import hash_password
+
+BLOQUE = 50000  # Filas por COPY / INSERT y por transacción
+TIPOS = (("entrada", 45), ("salida", 45), ("ajuste", 10))  # Tipos de movimiento y peso de cada uno
+
+# EAN13 válido del rango de uso interno (prefijo 20-29), único por número de item
+def synthetic_ean13(numero: int) -> str:
+    base = f"2{numero:011d}"
+    return base + ean13_check_digit(base)
+
+def create_users(db, usuarios: int, password: str):
+    existentes = set(db.scalars(select(User.username).where(User.username.like("bench%"))))
+    hash_comun = hash_password(password)  # Mismo hash para todos: bcrypt es lento a propósito
+    nuevos = [
+        User(username=f"bench{n}", hashed_password=hash_comun)
+        for n in range(1, usuarios + 1) if f"bench{n}" not in existentes
+    ]
+    db.add_all(nuevos)
+    db.commit()
+    return [f"bench{n}" for n in range(1, usuarios + 1)]
+
+# Items con cantidad 0 (se fija al final, con la del último movimiento); devuelve sus ids en orden
+def create_items(db, items: int, prefijo: str):
+    ocupados = db.scalar(select(func.count()).select_from(Item).where(Item.sku.like(f"{prefijo}%")))
+    if ocupados:
+        raise SystemExit(f"Ya hay {ocupados} items con el prefijo {prefijo}: use otro --prefix o una base de datos vacía")
+    desplazamiento = db.scalar(select(func.coalesce(func.max(Item.id), 0)))  # EAN13 distintos de los ya existentes
+    for inicio in range(0, items, BLOQUE):
+        crud.copy_rows(db, Item.__table__, [
+            {"sku": f"{prefijo}{n:07d}", "ean13": synthetic_ean13(desplazamiento + n), "quantity": 0}
+            for n in range(inicio + 1, min(inicio + BLOQUE, items) + 1)
+        ])
+        db.commit()
+    return db.scalars(select(Item.id).where(Item.sku.like(f"{prefijo}%")).order_by(Item.sku)).all()
+
+# Particiones mensuales del periodo generado (en PostgreSQL; la de por defecto recogería todo)
+def create_partitions(desde, hasta):
+    with engine.begin() as conexion:
+        if not partitions.is_partitioned(conexion, Movement.__tablename__):
+            return
+        mes = partitions.month_start(desde)
+        while mes <= partitions.month_start(hasta):
+            partitions.create_month_partition(conexion, Movement.__tablename__, "timestamp", mes)
+            mes = partitions.add_months(mes, 1)
+
+# Generar los movimientos en orden cronológico: una "creación" por item al inicio del periodo y el resto
+# repartidos uniformemente hasta ahora, concentrados en pocos items (como un catálogo real).
+# Devuelve la cantidad final de cada item
+def create_movements(db, item_ids: list, movimientos: int, usuarios: list, inicio, fin, rng):
+    cantidades = {}
+    bloque = []
+
+    def volcar():
+        crud.copy_rows(db, Movement.__table__, bloque)
+        db.commit()
+        bloque.clear()
+
+    for item_id in item_ids:
+        cantidad = rng.randint(0, 100)
+        cantidades[item_id] = cantidad
+        bloque.append({
+            "item_id": item_id, "type": "creación", "amount": cantidad, "timestamp": inicio,
+            "username": "sistema", "quantity_before": 0, "quantity_after": cantidad,
+            "location_id": DEFAULT_LOCATION_ID,
+        })
+        if len(bloque) >= BLOQUE:
+            volcar()
+
+    restantes = max(0, movimientos - len(item_ids))
+    paso = (fin - inicio) / max(1, restantes)
+    nombres, pesos = zip(*TIPOS)
+    for n in range(restantes):
+        item_id = item_ids[int(len(item_ids) * rng.random() ** 3)]  # Los primeros items se mueven mucho más
+        antes = cantidades[item_id]
+        tipo = rng.choices(nombres, pesos)[0]
+        if tipo == "salida" and antes == 0:
+            tipo = "entrada"
+        if tipo == "entrada":
+            amount = rng.randint(1, 50)
+            despues = antes + amount
+        elif tipo == "salida":
+            amount = rng.randint(1, min(antes, 20))
+            despues = antes - amount
+        else:
+            despues = rng.randint(0, 200)
+            amount = despues - antes
+        cantidades[item_id] = despues
+        bloque.append({
+            "item_id": item_id, "type": tipo, "amount": amount, "timestamp": inicio + paso * (n + 1),
+            "username": rng.choice(usuarios), "quantity_before": antes, "quantity_after": despues,
+            "location_id": DEFAULT_LOCATION_ID,
+        })
+        if len(bloque) >= BLOQUE:
+            volcar()
+    if bloque:
+        volcar()
+    return cantidades
+
+# Fijar la cantidad de cada item a la del último movimiento (todo el stock en la ubicación principal)
+def set_final_quantities(db, cantidades: dict):
+    filas = [{"item_id": item_id, "quantity": cantidad} for item_id, cantidad in cantidades.items()]
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("CREATE TEMP TABLE bench_quantities (item_id integer, quantity integer) ON COMMIT DROP"))
+        crud.copy_rows(db, table("bench_quantities", column("item_id"), column("quantity")), filas)
+        db.execute(text("UPDATE items SET quantity = q.quantity FROM bench_quantities q WHERE items.id = q.item_id"))
+    else:
+        db.execute(
+            update(Item.__table__).where(Item.__table__.c.id == bindparam("item_id")).values(quantity=bindparam("quantity")),
+            filas,
+        )
+    crud.copy_rows(db, ItemStock.__table__, [
+        {"item_id": item_id, "location_id": DEFAULT_LOCATION_ID, "quantity": cantidad}
+        for item_id, cantidad in cantidades.items()
+        if cantidad
+    ])
+    db.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Cargar un catálogo sintético para pruebas de rendimiento")
+    parser.add_argument("--items", type=int, default=10000, help="Items creados")
+    parser.add_argument("--movements", type=int, default=1000000, help="Movimientos en total (incluye la creación de cada item)")
+    parser.add_argument("--days", type=int, default=365, help="Días de historial hasta ahora")
+    parser.add_argument("--users", type=int, default=20, help="Usuarios bench1..benchN")
+    parser.add_argument("--password", default="bench", help="Contraseña de los usuarios creados")
+    parser.add_argument("--snapshot-days", type=int, default=30, help="Días entre fotos de stock (0 = sin fotos)")
+    parser.add_argument("--prefix", default="BENCH-", help="Prefijo del SKU de los items creados")
+    parser.add_argument("--seed", type=int, default=1, help="Semilla de los datos aleatorios")
+    parser.add_argument("--drop", action="store_true", help="Borrar y recrear todas las tablas antes de cargar")
+    args = parser.parse_args()
+
+    if args.drop:
+        Base.metadata.drop_all(bind=engine)
+    migrations.migrate(engine)
+    rng = random.Random(args.seed)
+    tiempos = {}
+    fin = crud.now_madrid() - timedelta(seconds=crud.SNAPSHOT_SETTLE_SECONDS)
+    inicio = fin - timedelta(days=args.days)
+
+    with SessionLocal() as db:
+        marca = time.perf_counter()
+        usuarios = create_users(db, args.users, args.password)
+        item_ids = create_items(db, args.items, args.prefix)
+        tiempos["items_s"] = time.perf_counter() - marca
+
+        marca = time.perf_counter()
+        create_partitions(inicio, fin)
+        cantidades = create_movements(db, item_ids, args.movements, usuarios, inicio, fin, rng)
+        set_final_quantities(db, cantidades)
+        crud.rebuild_reorder_alerts(db)  # Alertas de los items que acaban agotados
+        tiempos["movements_s"] = time.perf_counter() - marca
+
+        marca = time.perf_counter()
+        filas_totales = crud.rebuild_movement_stats(db)
+        tiempos["daily_stats_s"] = time.perf_counter() - marca
+
+        # Cada foto parte de la anterior: se toman en orden cronológico
+        marca = time.perf_counter()
+        fotos = 0
+        if args.snapshot_days > 0:
+            fecha = inicio + timedelta(days=args.snapshot_days)
+            while fecha < fin:
+                crud.create_snapshot(db, fecha)
+                fotos += 1
+                fecha += timedelta(days=args.snapshot_days)
+        tiempos["snapshots_s"] = time.perf_counter() - marca
+
+        if db.get_bind().dialect.name == "postgresql":
+            db.execute(text("ANALYZE"))  # Estadísticas del planificador al día tras la carga masiva
+            db.commit()
+
+    print(json.dumps({
+        "benchmark": "seed",
+        "database": engine.dialect.name,
+        "items": len(item_ids),
+        "movements": max(args.movements, len(item_ids)),
+        "daily_stat_rows": filas_totales,
+        "snapshots": fotos,
+        "users": len(usuarios),
+        "from": inicio.isoformat(),
+        "to": fin.isoformat(),
+        "seed": args.seed,
+        **{clave: round(valor, 2) for clave, valor in tiempos.items()},
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Micro-benchmark: serializar N movimientos por el camino de FastAPI (entidades ORM validadas con
+# response_model=list[MovementOut]) frente al camino rápido (filas con columnas + FastJSONResponse)
+#
+#   python bench/serialization.py --rows 100000
+#
+# Sin DATABASE_URL usa una base de datos SQLite temporal; con DATABASE_URL usa esa base de datos
+# (crea los movimientos que falten hasta llegar a --rows)
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.gettempdir(), "bench_serialization.db"))
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from sqlalchemy import func, select
+
+import crud
+import migrations
+from database import SessionLocal, engine
+from models import Item, Movement
+from schemas import MovementOut
+from serialization import FastJSONResponse, orjson, rows_to_dicts
+
+# Crear items y movimientos sintéticos hasta tener "filas" movimientos
+def seed(filas: int):
+    migrations.migrate(engine)
+    with SessionLocal() as db:
+        if not db.scalar(select(func.count()).select_from(Item)):
+            db.add_all([Item(sku=f"BENCH{i}", ean13=f"{i:013d}", quantity=0) for i in range(1, 101)])
+            db.commit()
+        item_ids = db.scalars(select(Item.id)).all()
+        existentes = db.scalar(select(func.count()).select_from(Movement))
+        inicio = datetime(2026, 1, 1)
+        bloque = []
+        for n in range(existentes, filas):
+            bloque.append({
+                "item_id": item_ids[n % len(item_ids)],
+                "type": "entrada",
+                "amount": 1,
+                "timestamp": inicio + timedelta(seconds=n),
+                "username": "bench" if n % 2 else None,
+                "quantity_before": n,
+                "quantity_after": n + 1,
+            })
+            if len(bloque) == 10000:
+                crud.copy_rows(db, Movement.__table__, bloque)
+                bloque = []
+        if bloque:
+            crud.copy_rows(db, Movement.__table__, bloque)
+        db.commit()
+
+# Camino de FastAPI: entidades ORM, validación y serialización con el response_model y JSONResponse
+def orm_path(filas: int):
+    campo = create_model_field(name="Response_bench", type_=list[MovementOut], mode="serialization")
+    with SessionLocal() as db:
+        inicio = time.perf_counter()
+        movimientos = db.query(Movement).order_by(Movement.id).limit(filas).all()
+        consulta = time.perf_counter()
+        contenido = asyncio.run(serialize_response(field=campo, response_content=movimientos))
+        cuerpo = JSONResponse(contenido).body
+        fin = time.perf_counter()
+    return consulta - inicio, fin - consulta, cuerpo
+
+# Camino rápido: filas con las columnas de MovementOut y codificación directa
+def fast_path(filas: int):
+    with SessionLocal() as db:
+        inicio = time.perf_counter()
+        movimientos = db.query(*crud.MOVEMENT_OUT_COLUMNS).order_by(Movement.id).limit(filas).all()
+        consulta = time.perf_counter()
+        cuerpo = FastJSONResponse(rows_to_dicts(movimientos, crud.MOVEMENT_FIELDS)).body
+        fin = time.perf_counter()
+    return consulta - inicio, fin - consulta, cuerpo
+
+def measure(camino, filas: int, repeticiones: int):
+    tiempos = [camino(filas) for _ in range(repeticiones)]
+    return {
+        "query_s": statistics.median(t[0] for t in tiempos),
+        "serialize_s": statistics.median(t[1] for t in tiempos),
+        "total_s": statistics.median(t[0] + t[1] for t in tiempos),
+        "bytes": len(tiempos[-1][2]),
+    }, tiempos[-1][2]
+
+def main():
+    parser = argparse.ArgumentParser(description="Serialización de movimientos: response_model frente al camino rápido")
+    parser.add_argument("--rows", type=int, default=100000, help="Movimientos serializados")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeticiones (se informa la mediana)")
+    args = parser.parse_args()
+
+    seed(args.rows)
+    actual, cuerpo_actual = measure(orm_path, args.rows, args.repeat)
+    rapido, cuerpo_rapido = measure(fast_path, args.rows, args.repeat)
+    if json.loads(cuerpo_actual) != json.loads(cuerpo_rapido):
+        raise SystemExit("Los dos caminos no producen el mismo JSON")
+
+    print(json.dumps({
+        "benchmark": "serialization",
+        "rows": args.rows,
+        "database": engine.dialect.name,
+        "encoder": "orjson" if orjson is not None else "json",
+        "orm_response_model": actual,
+        "fast_path": rapido,
+        "speedup": actual["total_s"] / rapido["total_s"],
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import hashlib
+import os
+import threading
+import time
+
+CACHE_URL = os.getenv("CACHE_URL", "")  # Vacío: caché en memoria del proceso; redis://... : Redis
+CACHE_TTL = int(os.getenv("CACHE_TTL", "300"))  # Segundos máximos que vive una entrada
+CACHE_SWEEP_SECONDS = int(os.getenv("CACHE_SWEEP_SECONDS", "60"))  # Cada cuánto se borran las entradas caducadas
+
+# -------------------------
+# Backends (subconjunto de la interfaz de Redis: get, set con ex, delete, incr)
+# -------------------------
+
+# Caché en memoria del proceso, con caducidad por entrada.
+# Las entradas caducadas que nadie vuelve a leer se borran en un barrido periódico al escribir
+class MemoryBackend:
+    def __init__(self, sweep_seconds: int = CACHE_SWEEP_SECONDS):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.sweep_seconds = sweep_seconds
+        self.next_sweep = time.monotonic() + sweep_seconds
+
+    # Borrar las entradas caducadas (con el lock tomado)
+    def _sweep(self, ahora: float):
+        caducadas = [name for name, (_, caduca) in self.entries.items() if caduca is not None and caduca < ahora]
+        for name in caducadas:
+            del self.entries[name]
+        self.next_sweep = ahora + self.sweep_seconds
+
+    def get(self, name):
+        with self.lock:
+            entrada = self.entries.get(name)
+            if entrada is None:
+                return None
+            valor, caduca = entrada
+            if caduca is not None and caduca < time.monotonic():
+                del self.entries[name]
+                return None
+            return valor
+
+    def set(self, name, value, ex=None):
+        ahora = time.monotonic()
+        with self.lock:
+            if ahora >= self.next_sweep:
+                self._sweep(ahora)
+            self.entries[name] = (value, ahora + ex if ex else None)
+        return True
+
+    def delete(self, *names):
+        with self.lock:
+            return sum(1 for name in names if self.entries.pop(name, None) is not None)
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            valor, caduca = self.entries.get(name, (0, None))
+            valor = int(valor) + amount
+            self.entries[name] = (valor, caduca)
+            return valor
+
+# Crear el backend configurado; Redis es opcional y solo se importa si se usa
+def create_backend(url: str = CACHE_URL):
+    if not url:
+        return MemoryBackend()
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError("CACHE_URL apunta a Redis pero el paquete 'redis' no está instalado")
+    return redis.Redis.from_url(url)
+
+# -------------------------
+# Caché de items serializados
+# -------------------------
+
+# Caché del listado de items y de cada item, ya serializados en JSON con su ETag.
+# Cada clave incluye un contador de versión: invalidar es incrementarlo, y una lectura
+# lenta que rellene la caché tras una escritura queda guardada bajo la versión antigua.
+# Al invalidar se borran las entradas de la versión anterior, que ya nadie leerá
+class ItemCache:
+    def __init__(self, backend, ttl: int = CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.stats_counters = {"hits": 0, "misses": 0, "not_modified": 0, "invalidations": 0}
+
+    def _count(self, contador: str):
+        with self.lock:
+            self.stats_counters[contador] += 1
+
+    def _version(self, clave_version: str) -> int:
+        return int(self.backend.get(clave_version) or 0)
+
+    def _get(self, clave: str):
+        valor = self.backend.get(clave)
+        if valor is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        etag, cuerpo = valor.split(b"\n", 1)  # Se guarda como "etag\ncuerpo"
+        return etag.decode(), cuerpo
+
+    def _set(self, clave: str, cuerpo: bytes):
+        etag = '"' + hashlib.sha1(cuerpo).hexdigest() + '"'  # ETag fuerte: huella del contenido
+        self.backend.set(clave, etag.encode() + b"\n" + cuerpo, ex=self.ttl)
+        return etag, cuerpo
+
+    # Listado completo: versión global de items
+    def list_version(self) -> int:
+        return self._version("items:version")
+
+    def get_list(self, version: int):
+        return self._get(f"items:list:{version}")
+
+    def set_list(self, version: int, cuerpo: bytes):
+        return self._set(f"items:list:{version}", cuerpo)
+
+    # Item individual: versión propia, así cambiar un item no invalida los demás
+    def item_version(self, item_id: int) -> int:
+        return self._version(f"items:{item_id}:version")
+
+    def get_item(self, item_id: int, version: int):
+        return self._get(f"items:{item_id}:{version}")
+
+    def set_item(self, item_id: int, version: int, cuerpo: bytes):
+        return self._set(f"items:{item_id}:{version}", cuerpo)
+
+    # Invalidar el listado y las entradas de los items modificados
+    def invalidate(self, item_ids=()):
+        version = self.backend.incr("items:version")
+        antiguas = [f"items:list:{version - 1}"]
+        for item_id in item_ids:
+            version = self.backend.incr(f"items:{item_id}:version")
+            antiguas.append(f"items:{item_id}:{version - 1}")
+        self.backend.delete(*antiguas)
+        self._count("invalidations")
+
+    def record_not_modified(self):
+        self._count("not_modified")
+
+    def stats(self):
+        with self.lock:
+            contadores = dict(self.stats_counters)
+        consultas = contadores["hits"] + contadores["misses"]
+        contadores["hit_rate"] = contadores["hits"] / consultas if consultas else 0.0
+        contadores["backend"] = type(self.backend).__name__
+        return contadores
+
+item_cache = ItemCache(create_backend())
+
+# -------------------------
+# Índice de códigos de barras
+# -------------------------
+
+ITEM_CODES_MAX = int(os.getenv("ITEM_CODES_MAX", "500000"))  # Códigos como máximo en el índice de cada worker
+
+# Índice en memoria del proceso de EAN13 y SKU al id del item, para resolver un escaneo sin ir a la base de datos.
+# Se rellena al resolver códigos y con las escrituras de este worker. Las escrituras de otros workers pueden
+# dejar entradas obsoletas: quien lo usa comprueba que el item encontrado sigue teniendo ese código
+class ItemCodeIndex:
+    def __init__(self, max_entries: int = ITEM_CODES_MAX):
+        self.max_entries = max_entries
+        self.ids = {}  # (campo, código) -> id del item
+        self.codes = {}  # id del item -> sus claves en ids
+        self.lock = threading.Lock()
+        self.stats_counters = {"hits": 0, "misses": 0, "stale": 0}
+
+    def get(self, campo: str, codigo: str):
+        with self.lock:
+            item_id = self.ids.get((campo, codigo))
+            self.stats_counters["hits" if item_id is not None else "misses"] += 1
+            return item_id
+
+    def _remove(self, item_id: int):
+        for clave in self.codes.pop(item_id, ()):
+            if self.ids.get(clave) == item_id:
+                del self.ids[clave]
+
+    # Registrar los códigos actuales de un item (sustituye a los que tuviera)
+    def add(self, item_id: int, sku: str, ean13: str):
+        claves = (("sku", sku), ("ean13", ean13))
+        with self.lock:
+            self._remove(item_id)
+            if len(self.ids) + len(claves) > self.max_entries:
+                # Lleno: se vacía y se vuelve a llenar con los códigos que se sigan escaneando
+                self.ids.clear()
+                self.codes.clear()
+            for clave in claves:
+                anterior = self.ids.get(clave)
+                if anterior is not None and anterior != item_id:
+                    self._remove(anterior)  # El código ha pasado a otro item (p. ej. tras un borrado)
+                self.ids[clave] = item_id
+            self.codes[item_id] = claves
+
+    # Olvidar un item (borrado, códigos cambiados o entrada obsoleta)
+    def discard(self, item_id: int, stale: bool = False):
+        with self.lock:
+            self._remove(item_id)
+            if stale:
+                self.stats_counters["stale"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
+            self.codes.clear()
+
+    def stats(self):
+        with self.lock:
+            contadores = dict(self.stats_counters)
+            contadores["entries"] = len(self.ids)
+        consultas = contadores["hits"] + contadores["misses"]
+        contadores["hit_rate"] = contadores["hits"] / consultas if consultas else 0.0
+        return contadores
+
+item_codes = ItemCodeIndex()
+
+# Comprobar si la cabecera If-None-Match coincide con el ETag actual
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidatos = [valor.strip() for valor in if_none_match.split(",")]
+    return "*" in candidatos or etag in candidatos
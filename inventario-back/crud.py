@@ -1,111 +1,1795 @@
+from sqlalchemy import (
+    Date, Float, and_, case, cast, column, delete, func, insert, literal, or_, select, table, text, true, tuple_, union_all,
+    update,
+)
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
 from sqlalchemy.orm import Session
-from models import Item, Movement
-from schemas import ItemOut, ItemCreate, ItemUpdate, MovementOut, MovementCreate, UserCreate
-from datetime import datetime
+from sqlalchemy.util import await_only
+from models import (
+    DEFAULT_LOCATION_ID, IdempotencyKey, Item, ItemStock, Location, Movement, MovementArchive, MovementDailyStat,
+    StockAlert, StockEvent, StockSnapshot, StockSnapshotItem,
+)
+from schemas import (
+    TRANSFER_TYPE, ItemOut, ItemCreate, ItemUpdate, LocationCreate, LocationItemOut, LocationStockOut,
+    MovementOut, MovementCreate, MovementBatchOut, UserCreate, ean13_check_digit,
+)
+from datetime import date, datetime, timedelta
+from typing import Optional
 from models import User
-from security import pwd_context
+from security import hash_password
+from cache import item_cache, item_codes
+from events import EVENTS_CHANNEL, PROCESS_ID, event_hub
+import partitions
+from serialization import dumps, rows_to_dicts, schema_fields
 
+import asyncio
+import base64
+import binascii
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
 import pytz
+import random
+import time
+from collections import namedtuple
 
 madrid_tz = pytz.timezone('Europe/Madrid')
 
-# Obtener todos los productos
-def get_items(db: Session):
-    return db.query(Item).all()  # Devuelve todos los items en la tabla
+ITEM_ACTIVE = Item.deleted_at.is_(None)  # Items no borrados (borrado lógico)
+ITEM_NOT_FOUND = "Item no encontrado"
+LOCATION_NOT_FOUND = "Ubicación no encontrada"
+INSUFFICIENT_STOCK = "Stock insuficiente"  # Salida o traspaso que dejaría la ubicación en negativo
 
+# Columnas de los listados, en el orden de los campos de ItemOut y MovementOut: las filas se
+# serializan directamente, sin cargar entidades ORM (identity map) ni validarlas una a una
+ITEM_FIELDS = schema_fields(ItemOut)
+MOVEMENT_FIELDS = schema_fields(MovementOut)
+LOCATION_STOCK_FIELDS = schema_fields(LocationStockOut)
+LOCATION_ITEM_FIELDS = schema_fields(LocationItemOut)
+ITEM_OUT_COLUMNS = [getattr(Item, campo) for campo in ITEM_FIELDS]
+MOVEMENT_OUT_COLUMNS = [getattr(Movement, campo) for campo in MOVEMENT_FIELDS]
+MovementRecord = namedtuple("MovementRecord", MOVEMENT_FIELDS)  # Movimiento leído de un archivo
 
-# Actualizar cantidad de un item e insertar movimiento relacionado
-def update_item_quantity(db: Session, item_id: int, item_data: ItemUpdate, user: str = None):
-    item = db.query(Item).filter(Item.id == item_id).first()  # Buscar item por id
-    if not item:
-        return None  # Si no existe, devolver None
+MAX_REINTENTOS = 5  # Reintentos ante fallos de serialización o interbloqueos
+ERRORES_REINTENTABLES = {"40001", "40P01"}  # serialization_failure, deadlock_detected (PostgreSQL)
+# Margen hasta el que se fotografía el stock: los movimientos más recientes pueden pertenecer a
+# transacciones aún sin confirmar (la hora se asigna antes del commit)
+SNAPSHOT_SETTLE_SECONDS = int(os.getenv("SNAPSHOT_SETTLE_SECONDS", "60"))
+SNAPSHOT_LOCK_ID = 7311  # Clave del advisory lock que evita fotos simultáneas desde varios workers
+# Carpeta de los ficheros de movimientos archivados
+MOVEMENTS_ARCHIVE_DIR = os.getenv(
+    "MOVEMENTS_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive")
+)
+EVENT_MAX_MOVEMENTS = int(os.getenv("EVENT_MAX_MOVEMENTS", "500"))  # Movimientos incluidos en un evento como máximo
+EVENTS_RETENTION_HOURS = int(os.getenv("EVENTS_RETENTION_HOURS", "24"))  # Horas que se conservan los eventos
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))  # Horas que se conservan las claves de idempotencia
+CONSUMPTION_WINDOW_DAYS = int(os.getenv("CONSUMPTION_WINDOW_DAYS", "28"))  # Días de salidas para el consumo medio
 
-    cantidad_anterior = item.quantity  # Cantidad antes de actualizar
-    cantidad_nueva = item_data.quantity  # Cantidad nueva desde el payload
-    diferencia = cantidad_nueva - cantidad_anterior  # Diferencia de cantidad
 
-    item.quantity = cantidad_nueva  # Actualizar cantidad
-    db.add(item)  # Añadir a sesión para update
+# Indica si un error de base de datos es transitorio y la transacción puede repetirse
+def is_retryable(error: OperationalError):
+    codigo = getattr(error.orig, "pgcode", None)
+    if codigo in ERRORES_REINTENTABLES:
+        return True
+    return "database is locked" in str(error.orig)  # Equivalente en SQLite
 
-    movimiento = Movement(
-        item_id=item_id,
-        type="ajuste",  # Tipo de movimiento
-        amount=diferencia,  # Cantidad modificada
-        timestamp=datetime.now(pytz.timezone("Europe/Madrid")),  # Hora Madrid
-        username=user,  # Usuario que hace el cambio
-        quantity_before=cantidad_anterior,  # Cantidad antes
-        quantity_after=cantidad_nueva  # Cantidad después
-    )
-    db.add(movimiento)  # Añadir movimiento a sesión
-    db.commit()  # Guardar cambios
-    db.refresh(item)  # Refrescar el item con datos actuales
-    return item  # Devolver item actualizado
 
+# Ejecutar una operación transaccional reintentando ante conflictos de concurrencia
+def run_with_retries(db: Session, operacion):
+    for intento in range(MAX_REINTENTOS):
+        try:
+            return operacion()
+        except OperationalError as error:
+            db.rollback()  # Deshacer la transacción fallida antes de reintentar
+            if not is_retryable(error) or intento == MAX_REINTENTOS - 1:
+                raise
+            espera = random.uniform(0, 0.01 * 2 ** intento)  # Espera exponencial con jitter
+            if db.get_bind().dialect.is_async:
+                # Con DB_ASYNC=1 se ejecuta con run_sync en el hilo del event loop: esperar sin bloquearlo
+                await_only(asyncio.sleep(espera))
+            else:
+                time.sleep(espera)
 
-# Crear un nuevo movimiento y actualizar cantidad del item
-def create_movement(db: Session, movement_data: MovementCreate):
-    item = db.query(Item).filter(Item.id == movement_data.item_id).first()  # Buscar item
-    if not item:
-        return None  # Si no existe item, devolver None
 
-    quantity_before = item.quantity  # Cantidad antes de movimiento
+# Variación de stock que produce un movimiento según su tipo
+def movement_delta(tipo: str, amount: int):
+    if tipo == "entrada":
+        return amount
+    if tipo == "salida":
+        return -amount
+    return 0  # Otros tipos (ajuste, traspaso) no modifican la cantidad total
 
-    # Ajustar cantidad según tipo de movimiento
-    if movement_data.type == "entrada":
-        item.quantity += movement_data.amount
-    elif movement_data.type == "salida":
-        item.quantity -= movement_data.amount
 
-    quantity_after = item.quantity  # Cantidad después de movimiento
+# Variación de stock por (item, ubicación) que produce un movimiento
+def location_deltas(item_id: int, tipo: str, amount: int, origen: int, destino: Optional[int] = None) -> dict:
+    if tipo == TRANSFER_TYPE:
+        return {(item_id, origen): -amount, (item_id, destino): amount}
+    return {(item_id, origen): movement_delta(tipo, amount)}
 
-    movement = Movement(
-        item_id=movement_data.item_id,
-        type=movement_data.type,
-        amount=movement_data.amount,
-        timestamp=datetime.now(madrid_tz),  # Hora Madrid
-        username=getattr(movement_data, "username", None),  # Usuario opcional
-        quantity_before=quantity_before,
-        quantity_after=quantity_after,
+
+# Sumar variaciones de stock {(item_id, location_id): delta} dentro de la transacción en curso
+# Igual que los totales diarios, las filas de cada item quedan protegidas por el bloqueo de la fila del item
+def add_item_stock(db: Session, variaciones: dict):
+    filas = [
+        {"item_id": item_id, "location_id": location_id, "quantity": delta}
+        for (item_id, location_id), delta in sorted(variaciones.items())  # Orden fijo de bloqueo
+        if delta
+    ]
+    if not filas:
+        return
+    tabla = ItemStock.__table__
+    sentencia = dialect_insert(db, tabla)
+    db.execute(
+        sentencia.on_conflict_do_update(
+            index_elements=["item_id", "location_id"],
+            set_={"quantity": tabla.c.quantity + sentencia.excluded.quantity},
+        ),
+        filas,
     )
 
-    db.add(movement)  # Añadir movimiento
-    db.commit()  # Guardar cambios
-    db.refresh(movement)  # Refrescar movimiento creado
-    return movement  # Devolver movimiento
 
+# Sumar unos movimientos (dicts u objetos Movement) a los totales diarios, dentro de la transacción en curso
+# Las filas de totales son por item, así que quedan protegidas por el bloqueo de la fila del item
+def record_movement_stats(db: Session, movimientos):
+    totales = {}
+    for movimiento in movimientos:
+        datos = movimiento if isinstance(movimiento, dict) else vars(movimiento)
+        clave = (datos["timestamp"].date(), datos["item_id"], datos.get("username") or "", datos["type"])
+        total = totales.setdefault(clave, {"amount": 0, "change": 0, "movements": 0})
+        total["amount"] += datos["amount"]
+        total["change"] += datos["quantity_after"] - datos["quantity_before"]
+        total["movements"] += 1
+    if not totales:
+        return
+
+    tabla = MovementDailyStat.__table__
+    sentencia = dialect_insert(db, tabla)
+    db.execute(
+        sentencia.on_conflict_do_update(
+            index_elements=["day", "item_id", "username", "type"],
+            set_={
+                columna: tabla.c[columna] + sentencia.excluded[columna]
+                for columna in ("amount", "change", "movements")
+            },
+        ),
+        [
+            {"day": dia, "item_id": item_id, "username": usuario, "type": tipo, **total}
+            for (dia, item_id, usuario, tipo), total in sorted(totales.items())  # Orden fijo de bloqueo
+        ],
+    )
+
+
+# Movimiento (dict u objeto Movement) en el formato compacto de los eventos
+def movement_event(movimiento) -> dict:
+    datos = movimiento if isinstance(movimiento, dict) else vars(movimiento)
+    evento = {
+        columna: datos.get(columna)
+        for columna in (
+            "id", "item_id", "type", "amount", "username", "quantity_before", "quantity_after",
+            "location_id", "to_location_id",
+        )
+    }
+    evento["timestamp"] = datos["timestamp"].isoformat()
+    return evento
+
+
+# Registrar un evento del canal en tiempo real dentro de la transacción en curso (justo antes del commit):
+# solo se publica si la transacción se confirma. items: cambios de cada item (id y campos nuevos)
+def record_event(db: Session, tipo: str, items=(), movimientos=()):
+    db.flush()  # Asignar id a los movimientos añadidos a la sesión
+    movimientos = list(movimientos)
+    datos = {"items": list(items), "movements": [movement_event(m) for m in movimientos[:EVENT_MAX_MOVEMENTS]]}
+    if len(movimientos) > EVENT_MAX_MOVEMENTS:
+        datos["movements_truncated"] = len(movimientos) - EVENT_MAX_MOVEMENTS  # Resto: consultar /movements
+    evento_id = db.execute(
+        insert(StockEvent)
+        .values(created_at=now_madrid(), type=tipo, payload=json.dumps(datos, ensure_ascii=False), source=PROCESS_ID)
+        .returning(StockEvent.id)
+    ).scalar_one()
+    if db.get_bind().dialect.name == "postgresql":
+        # NOTIFY se entrega al confirmar la transacción: despierta el reparto en todos los workers
+        db.execute(select(func.pg_notify(EVENTS_CHANNEL, str(evento_id))))
+    return evento_id
+
+
+# Avisar de que unos items han cambiado, tras confirmar la transacción
+# (invalida la caché de items y reparte el evento a los clientes conectados a este worker)
+def notify_items_changed(item_ids):
+    item_cache.invalidate(item_ids)
+    event_hub.wake()
+
+# Obtener todos los productos (filas con las columnas de ItemOut)
+def get_items(db: Session):
+    return db.query(*ITEM_OUT_COLUMNS).filter(ITEM_ACTIVE).all()  # Devuelve todos los items no borrados
+
+
+# Obtener un producto por id (None si no existe o está borrado)
+def get_item(db: Session, item_id: int):
+    item = db.get(Item, item_id)
+    return item if item is not None and item.deleted_at is None else None
+
+
+# Columnas por las que se puede ordenar el catálogo; id y sku son únicas
+ITEM_SORTS = {"id": Item.id, "sku": Item.sku, "quantity": Item.quantity}
+
+
+# Codificar cursor opaco del catálogo: orden usado y (valor de la columna, id) del último item
+def encode_item_cursor(orden: str, valor, item_id: int) -> str:
+    crudo = json.dumps([orden, valor, item_id])
+    return base64.urlsafe_b64encode(crudo.encode()).decode()
+
+
+# Decodificar cursor del catálogo; None si no es válido o se generó con otro orden
+def decode_item_cursor(cursor: str, orden: str):
+    try:
+        orden_cursor, valor, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, binascii.Error, UnicodeDecodeError):
+        return None
+    tipo_valor = str if orden.lstrip("-") == "sku" else int
+    if orden_cursor != orden or not isinstance(valor, tipo_valor) or not isinstance(item_id, int):
+        return None
+    return valor, item_id
+
+
+# Aplicar búsqueda y filtros del catálogo a una consulta (Query o select) sobre items
+def filter_items(query, q=None, contains=None, max_quantity=None, out_of_stock=False):
+    query = query.filter(ITEM_ACTIVE)
+    if q:
+        # Prefijo de SKU o EAN13: rango de los índices varchar_pattern_ops (LIKE 'abc%')
+        query = query.filter(or_(Item.sku.startswith(q, autoescape=True), Item.ean13.startswith(q, autoescape=True)))
+    if contains:
+        # Texto en cualquier posición del SKU, sin distinguir mayúsculas: índice trigram (pg_trgm)
+        escapado = contains.replace("/", "//").replace("%", "/%").replace("_", "/_")
+        query = query.filter(Item.sku.ilike(f"%{escapado}%", escape="/"))
+    if max_quantity is not None:
+        query = query.filter(Item.quantity <= max_quantity)  # Stock bajo
+    if out_of_stock:
+        query = query.filter(Item.quantity == 0)  # Sin stock
+    return query
+
+
+# Obtener una página del catálogo (paginación keyset por la columna de orden y el id)
+# orden: "id", "sku" o "quantity", con "-" delante para orden descendente
+def get_items_page(db: Session, limit: int = 100, orden: str = "id", cursor: Optional[tuple] = None, **filtros):
+    descendente = orden.startswith("-")
+    columna = ITEM_SORTS[orden.lstrip("-")]
+    query = filter_items(db.query(*ITEM_OUT_COLUMNS), **filtros)
+
+    # Continuar justo después del último item entregado
+    if cursor is not None:
+        valor, item_id = cursor
+        if columna is Item.quantity:
+            # Columna no única: se desempata por id con el índice (quantity, id)
+            clave, limite = tuple_(Item.quantity, Item.id), tuple_(valor, item_id)
+        else:
+            clave, limite = columna, valor
+        query = query.filter(clave < limite if descendente else clave > limite)
+
+    if descendente:
+        query = query.order_by(columna.desc(), Item.id.desc())
+    else:
+        query = query.order_by(columna, Item.id)
+    filas = query.limit(limit + 1).all()  # Una fila de más para saber si hay página siguiente
+
+    siguiente_cursor = None
+    if len(filas) > limit:
+        filas = filas[:limit]
+        ultimo = filas[-1]
+        siguiente_cursor = encode_item_cursor(orden, getattr(ultimo, columna.key), ultimo.id)
+    return filas, siguiente_cursor
+
+
+# Sentencia EXPLAIN (solo PostgreSQL) para obtener la estimación del planificador
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, sentencia):
+        self.sentencia = sentencia
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(elemento, compilador, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compilador.process(elemento.sentencia, **kw)
+
+
+# Número aproximado de items que cumplen los filtros, sin recorrer la tabla con COUNT(*)
+# En PostgreSQL se usa la estimación del planificador (estadísticas de ANALYZE); en SQLite se cuenta
+def estimate_items_count(db: Session, **filtros):
+    consulta = filter_items(select(Item.id), **filtros)
+    if db.get_bind().dialect.name != "postgresql":
+        return db.scalar(select(func.count()).select_from(consulta.subquery()))
+    plan = db.execute(Explain(consulta)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)  # asyncpg devuelve el JSON como texto
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+# Actualizar cantidad de un item e insertar movimiento relacionado; devuelve (item, error)
+# Sin ubicación, la cantidad es el total y la diferencia se aplica a la ubicación principal;
+# con ubicación, es la cantidad en esa ubicación y el total cambia en la misma diferencia
+def update_item_quantity(db: Session, item_id: int, item_data: ItemUpdate, user: str = None, idempotencia: Optional[dict] = None):
+    ubicacion = item_data.location_id or DEFAULT_LOCATION_ID
+    if not location_exists(db, ubicacion):
+        return None, LOCATION_NOT_FOUND
+
+    def operacion():
+        claim_idempotency_key(db, idempotencia)
+        # Bloquear la fila (SELECT ... FOR UPDATE) para que la cantidad anterior no cambie hasta el commit
+        item = (
+            db.query(Item)
+            .filter(Item.id == item_id, ITEM_ACTIVE)
+            .with_for_update()
+            .populate_existing()
+            .first()
+        )
+        if not item:
+            db.rollback()
+            return None, ITEM_NOT_FOUND  # Si no existe, devolver error
+
+        cantidad_anterior = item.quantity  # Cantidad total antes de actualizar
+        if item_data.location_id is None:
+            diferencia = item_data.quantity - cantidad_anterior  # Diferencia de cantidad total
+        else:
+            en_ubicacion = db.scalar(
+                select(ItemStock.quantity).where(ItemStock.item_id == item_id, ItemStock.location_id == ubicacion)
+            ) or 0
+            diferencia = item_data.quantity - en_ubicacion  # Diferencia de cantidad en la ubicación
+        cantidad_nueva = cantidad_anterior + diferencia  # Cantidad total nueva
+
+        item.quantity = cantidad_nueva  # Actualizar cantidad
+        db.add(item)  # Añadir a sesión para update
+        add_item_stock(db, {(item_id, ubicacion): diferencia})  # Stock de la ubicación en la misma transacción
+        record_reorder_alerts(db, [(item_id, item.reorder_point, cantidad_anterior, cantidad_nueva)])
+
+        movimiento = Movement(
+            item_id=item_id,
+            type="ajuste",  # Tipo de movimiento
+            amount=diferencia,  # Cantidad modificada
+            timestamp=now_madrid(),  # Hora Madrid
+            username=user,  # Usuario que hace el cambio
+            quantity_before=cantidad_anterior,  # Cantidad antes
+            quantity_after=cantidad_nueva,  # Cantidad después
+            location_id=ubicacion,  # Ubicación ajustada
+        )
+        db.add(movimiento)  # Añadir movimiento a sesión
+        record_movement_stats(db, [movimiento])  # Totales diarios en la misma transacción
+        record_event(db, "stock", [{"id": item_id, "quantity": cantidad_nueva}], [movimiento])
+        save_idempotent_response(db, idempotencia, ItemOut.model_validate(item, from_attributes=True).model_dump_json())
+        db.commit()  # Guardar cambios y liberar el bloqueo
+        notify_items_changed([item_id])
+        db.refresh(item)  # Refrescar el item con datos actuales
+        return item, None  # Devolver item actualizado
+
+    return run_with_retries(db, operacion)
+
+
+# Crear un nuevo movimiento y actualizar la cantidad del item y la de su ubicación; devuelve (movimiento, error)
+# Un traspaso mueve unidades de location_id a to_location_id sin cambiar el total del item
+def create_movement(db: Session, movement_data: MovementCreate, idempotencia: Optional[dict] = None):
+    delta = movement_delta(movement_data.type, movement_data.amount)  # Variación de stock total
+    origen = movement_data.location_id or DEFAULT_LOCATION_ID
+    destino = movement_data.to_location_id
+    error = locations_error(db, origen, destino)
+    if error:
+        return None, error
+
+    def operacion():
+        claim_idempotency_key(db, idempotencia)
+        # UPDATE ... SET quantity = quantity + :delta RETURNING quantity: atómico y bloquea la fila
+        # hasta el commit, así los movimientos concurrentes del mismo item quedan encadenados
+        actualizado = db.execute(
+            update(Item)
+            .where(Item.id == movement_data.item_id, ITEM_ACTIVE)
+            .values(quantity=Item.quantity + delta)
+            .returning(Item.quantity, Item.reorder_point)
+            .execution_options(synchronize_session=False)
+        ).one_or_none()
+        if actualizado is None:
+            db.rollback()
+            return None, ITEM_NOT_FOUND  # Si no existe item, devolver error
+        quantity_after = actualizado.quantity
+        cambios_ubicacion = location_deltas(
+            movement_data.item_id, movement_data.type, movement_data.amount, origen, destino
+        )
+
+        if movement_data.type in ("salida", TRANSFER_TYPE):
+            # Misma regla que en los lotes: una salida o un traspaso no puede dejar en negativo el stock
+            # de su ubicación. Con la fila del item bloqueada, ese stock no cambia hasta el commit
+            disponible = db.scalar(
+                select(ItemStock.quantity)
+                .where(ItemStock.item_id == movement_data.item_id, ItemStock.location_id == origen)
+            ) or 0
+            if quantity_after < 0 or disponible + cambios_ubicacion[(movement_data.item_id, origen)] < 0:
+                db.rollback()
+                return None, INSUFFICIENT_STOCK
+
+        movement = Movement(
+            item_id=movement_data.item_id,
+            type=movement_data.type,
+            amount=movement_data.amount,
+            timestamp=now_madrid(),  # Hora Madrid
+            username=getattr(movement_data, "username", None),  # Usuario opcional
+            quantity_before=quantity_after - delta,  # Cantidad antes de movimiento
+            quantity_after=quantity_after,  # Cantidad después de movimiento
+            location_id=origen,  # Ubicación (origen del traspaso)
+            to_location_id=destino,  # Destino del traspaso
+        )
+
+        db.add(movement)  # Añadir movimiento en la misma transacción
+        add_item_stock(db, cambios_ubicacion)
+        record_reorder_alerts(db, [(movement_data.item_id, actualizado.reorder_point, quantity_after - delta, quantity_after)])
+        record_movement_stats(db, [movement])  # Totales diarios en la misma transacción
+        cambios = [{"id": movement_data.item_id, "quantity": quantity_after}] if delta else []
+        record_event(db, "stock", cambios, [movement])
+        save_idempotent_response(db, idempotencia, MovementOut.model_validate(movement, from_attributes=True).model_dump_json())
+        db.commit()  # Guardar cambios y liberar el bloqueo
+        if delta:
+            notify_items_changed([movement_data.item_id])
+        else:
+            event_hub.wake()  # La cantidad no cambia, pero el movimiento se publica
+        db.refresh(movement)  # Refrescar movimiento creado
+        return movement, None  # Devolver movimiento
+
+    return run_with_retries(db, operacion)
+
+
+# Aplicar un lote de movimientos en una sola transacción con sentencias por conjuntos
+# registros: lista de MovementCreate (válidos) o mensajes de error (str) por posición
+def create_movements_batch(db: Session, registros: list, idempotencia: Optional[dict] = None):
+    resultados = [None] * len(registros)
+    item_ids = sorted({r.item_id for r in registros if not isinstance(r, str)})
+    # Ubicación de origen de cada registro válido y errores de ubicación, antes de bloquear nada
+    origenes, errores_ubicacion = {}, {}
+    for indice, registro in enumerate(registros):
+        if isinstance(registro, str):
+            continue
+        origenes[indice] = registro.location_id or DEFAULT_LOCATION_ID
+        error = locations_error(db, origenes[indice], registro.to_location_id)
+        if error:
+            errores_ubicacion[indice] = error
+
+    def operacion():
+        claim_idempotency_key(db, idempotencia)
+        # Bloquear todos los items afectados en orden de id (evita interbloqueos entre lotes)
+        bloqueados = db.execute(
+            select(Item.id, Item.quantity, Item.reorder_point)
+            .where(Item.id.in_(item_ids), ITEM_ACTIVE)
+            .order_by(Item.id)
+            .with_for_update()
+        ).all()
+        cantidades = {fila.id: fila.quantity for fila in bloqueados}
+        puntos_pedido = {fila.id: fila.reorder_point for fila in bloqueados}
+        iniciales = dict(cantidades)  # Cantidades antes del lote para calcular el delta agregado
+        # Stock por ubicación de esos items (protegido por el bloqueo de sus filas)
+        stock = {
+            (fila.item_id, fila.location_id): fila.quantity
+            for fila in db.execute(
+                select(ItemStock.item_id, ItemStock.location_id, ItemStock.quantity).where(ItemStock.item_id.in_(item_ids))
+            )
+        }
+        variaciones = {}  # Variación del lote por (item, ubicación)
+        ahora = now_madrid()  # Misma hora para todo el lote
+        filas = []  # Filas a insertar en movements
+        posiciones = []  # Posición en el lote de cada fila insertada
+
+        for indice, registro in enumerate(registros):
+            if isinstance(registro, str):
+                resultados[indice] = {"index": indice, "ok": False, "error": registro}
+                continue
+            if registro.item_id not in cantidades:
+                resultados[indice] = {"index": indice, "ok": False, "error": ITEM_NOT_FOUND}
+                continue
+            if indice in errores_ubicacion:
+                resultados[indice] = {"index": indice, "ok": False, "error": errores_ubicacion[indice]}
+                continue
+
+            origen = origenes[indice]
+            cambios = location_deltas(registro.item_id, registro.type, registro.amount, origen, registro.to_location_id)
+            restante = stock.get((registro.item_id, origen), 0) + cambios[(registro.item_id, origen)]
+            if registro.type in ("salida", TRANSFER_TYPE) and restante < 0:
+                # Una salida o un traspaso no puede dejar el stock de la ubicación en negativo
+                resultados[indice] = {"index": indice, "ok": False, "error": INSUFFICIENT_STOCK}
+                continue
+
+            quantity_before = cantidades[registro.item_id]
+            quantity_after = quantity_before + movement_delta(registro.type, registro.amount)
+            cantidades[registro.item_id] = quantity_after  # Cantidad acumulada para el siguiente registro
+            for clave, cambio in cambios.items():
+                stock[clave] = stock.get(clave, 0) + cambio
+                variaciones[clave] = variaciones.get(clave, 0) + cambio
+            filas.append({
+                "item_id": registro.item_id,
+                "type": registro.type,
+                "amount": registro.amount,
+                "timestamp": ahora,
+                "username": registro.username,
+                "quantity_before": quantity_before,
+                "quantity_after": quantity_after,
+                "location_id": origen,
+                "to_location_id": registro.to_location_id,
+            })
+            posiciones.append(indice)
+
+        if filas:
+            # Un único UPDATE con el delta agregado por item
+            deltas = {
+                item_id: cantidad - iniciales[item_id]
+                for item_id, cantidad in cantidades.items()
+                if cantidad != iniciales[item_id]
+            }
+            if deltas:
+                db.execute(
+                    update(Item)
+                    .where(Item.id.in_(deltas))
+                    .values(quantity=Item.quantity + case(deltas, value=Item.id))
+                    .execution_options(synchronize_session=False)
+                )
+            add_item_stock(db, variaciones)  # Un único upsert del stock por ubicación
+            record_reorder_alerts(db, [(i, puntos_pedido[i], iniciales[i], cantidades[i]) for i in deltas])
+            # Un único INSERT multi-fila de movimientos, con los ids en el orden de las filas
+            movement_ids = db.scalars(
+                insert(Movement).returning(Movement.id, sort_by_parameter_order=True),
+                filas,
+            ).all()
+            for indice, fila, movement_id in zip(posiciones, filas, movement_ids):
+                resultados[indice] = {
+                    "index": indice,
+                    "ok": True,
+                    "movement_id": movement_id,
+                    "quantity_after": fila["quantity_after"],
+                }
+            record_movement_stats(db, filas)  # Totales diarios en la misma transacción
+        modificados = {fila["item_id"] for fila in filas if fila["quantity_before"] != fila["quantity_after"]}
+        if filas:
+            record_event(
+                db, "stock",
+                [{"id": item_id, "quantity": cantidades[item_id]} for item_id in sorted(modificados)],
+                [dict(fila, id=movement_id) for fila, movement_id in zip(filas, movement_ids)],
+            )
+        save_idempotent_response(db, idempotencia, MovementBatchOut.model_validate(batch_summary(resultados)).model_dump_json())
+        db.commit()  # Confirmar todo el lote a la vez
+        if modificados:
+            notify_items_changed(sorted(modificados))
+        elif filas:
+            event_hub.wake()
+
+    if item_ids:
+        run_with_retries(db, operacion)
+    else:
+        for indice, registro in enumerate(registros):
+            resultados[indice] = {"index": indice, "ok": False, "error": registro}
 
-# Obtener todos los movimientos, ordenados por fecha descendente
-def get_movements(db: Session):
-    return db.query(Movement).order_by(Movement.timestamp.desc()).all()
+    return batch_summary(resultados)
+
+
+# Resumen de un lote de movimientos (respuesta de POST /movements/batch)
+def batch_summary(resultados: list) -> dict:
+    aceptados = sum(1 for r in resultados if r["ok"])
+    return {"accepted": aceptados, "rejected": len(resultados) - aceptados, "results": resultados}
+
+
+# Normalizar una fecha recibida a hora local de Madrid sin zona (como se guardan los movimientos)
+def to_local_naive(fecha: Optional[datetime]):
+    if fecha is None or fecha.tzinfo is None:
+        return fecha  # Fechas sin zona se interpretan ya como hora de Madrid
+    return fecha.astimezone(madrid_tz).replace(tzinfo=None)
+
+
+# Hora actual de Madrid sin zona, tal y como se guarda en las columnas DateTime
+# (asyncpg no acepta fechas con zona en columnas sin zona)
+def now_madrid():
+    return to_local_naive(datetime.now(madrid_tz))
+
+
+# Codificar cursor opaco a partir del (timestamp, id) del último movimiento de una página
+def encode_cursor(timestamp: datetime, movement_id: int) -> str:
+    crudo = f"{timestamp.isoformat()}|{movement_id}"
+    return base64.urlsafe_b64encode(crudo.encode()).decode()
+
+
+# Decodificar cursor opaco; devuelve None si no es válido
+def decode_cursor(cursor: str):
+    try:
+        crudo = base64.urlsafe_b64decode(cursor.encode()).decode()
+        fecha, movement_id = crudo.rsplit("|", 1)
+        return datetime.fromisoformat(fecha), int(movement_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+# Aplicar los filtros del historial a una consulta (Query o select) sobre movements
+def filter_movements(query, item_id=None, type=None, username=None, desde=None, hasta=None):
+    # Cada combinación se resuelve con un índice (columna, timestamp, id)
+    if item_id is not None:
+        query = query.filter(Movement.item_id == item_id)
+    if type is not None:
+        query = query.filter(Movement.type == type)
+    if username is not None:
+        query = query.filter(Movement.username == username)
+    if desde is not None:
+        query = query.filter(Movement.timestamp >= to_local_naive(desde))
+    if hasta is not None:
+        query = query.filter(Movement.timestamp <= to_local_naive(hasta))
+    return query
+
+
+# Obtener una página de movimientos, ordenados por fecha descendente (paginación keyset)
+def get_movements(
+    db: Session,
+    limit: int = 100,
+    cursor: Optional[tuple] = None,
+    item_id: Optional[int] = None,
+    type: Optional[str] = None,
+    username: Optional[str] = None,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    archived: bool = False,
+):
+    query = filter_movements(db.query(*MOVEMENT_OUT_COLUMNS), item_id, type, username, desde, hasta)
+
+    # Continuar justo después del último (timestamp, id) entregado: rango del índice, sin OFFSET
+    if cursor is not None:
+        query = query.filter(tuple_(Movement.timestamp, Movement.id) < tuple_(*cursor))
+
+    # Se pide una fila de más para saber si existe página siguiente
+    filas = query.order_by(Movement.timestamp.desc(), Movement.id.desc()).limit(limit + 1).all()
+
+    # Si se piden también los archivados y la página no se ha llenado, se continúa por los ficheros
+    # (todos los meses archivados son anteriores a los movimientos que siguen en la base de datos)
+    if archived and len(filas) <= limit:
+        ultimo = (filas[-1].timestamp, filas[-1].id) if filas else cursor
+        archivados = iter_archived_movements(db, ultimo, item_id, type, username, desde, hasta)
+        filas += itertools.islice(archivados, limit + 1 - len(filas))
+
+    siguiente_cursor = None
+    if len(filas) > limit:
+        filas = filas[:limit]
+        ultimo = filas[-1]
+        siguiente_cursor = encode_cursor(ultimo.timestamp, ultimo.id)
+    return filas, siguiente_cursor  # Devolver página y cursor de la siguiente (o None)
 
 
 # Crear un nuevo item, validando unicidad de SKU y EAN13
-def create_item(db: Session, item_data: ItemCreate):
-    if db.query(Item).filter(Item.sku == item_data.sku).first():
+def create_item(db: Session, item_data: ItemCreate, idempotencia: Optional[dict] = None):
+    ubicacion = item_data.location_id or DEFAULT_LOCATION_ID
+    if not location_exists(db, ubicacion):
+        return None, LOCATION_NOT_FOUND
+    if db.query(Item).filter(Item.sku == item_data.sku, ITEM_ACTIVE).first():
         return None, "SKU ya existe"  # Error si SKU repetido
-    if db.query(Item).filter(Item.ean13 == item_data.ean13).first():
+    if db.query(Item).filter(Item.ean13 == item_data.ean13, ITEM_ACTIVE).first():
         return None, "EAN13 ya existe"  # Error si EAN13 repetido
 
-    nuevo_item = Item(sku=item_data.sku, ean13=item_data.ean13, quantity=item_data.quantity)
+    claim_idempotency_key(db, idempotencia)
+    nuevo_item = Item(
+        sku=item_data.sku, ean13=item_data.ean13, quantity=item_data.quantity, reorder_point=item_data.reorder_point
+    )
     db.add(nuevo_item)  # Añadir nuevo item
-    db.commit()  # Guardar cambios
-    db.refresh(nuevo_item)  # Refrescar con id y datos actualizados
+    db.flush()  # Asignar id al item: todo lo demás va en la misma transacción
+    add_item_stock(db, {(nuevo_item.id, ubicacion): nuevo_item.quantity})
+    record_reorder_alerts(db, [(nuevo_item.id, nuevo_item.reorder_point, None, nuevo_item.quantity)])
 
-    # Crear movimiento de creación para histórico
+    # Crear movimiento de creación para histórico (primero de la cadena del item)
     movimiento = Movement(
         item_id=nuevo_item.id,
         type="creación",
         amount=nuevo_item.quantity,
-        timestamp=datetime.now(madrid_tz),  # Hora Madrid
+        timestamp=now_madrid(),  # Hora Madrid
         quantity_before=0,
-        quantity_after=nuevo_item.quantity
+        quantity_after=nuevo_item.quantity,
+        location_id=ubicacion,
     )
     db.add(movimiento)  # Añadir movimiento
-    db.commit()  # Guardar cambios
+    record_movement_stats(db, [movimiento])  # Totales diarios en la misma transacción
+    record_event(
+        db, "item_created",
+        [{"id": nuevo_item.id, "sku": nuevo_item.sku, "ean13": nuevo_item.ean13, "quantity": nuevo_item.quantity}],
+        [movimiento],
+    )
+    save_idempotent_response(db, idempotencia, ItemOut.model_validate(nuevo_item, from_attributes=True).model_dump_json())
+    db.commit()  # Item, stock, movimiento, totales, evento y respuesta guardada a la vez
+    db.refresh(nuevo_item)  # Refrescar con id y datos actualizados
+    notify_items_changed([nuevo_item.id])
+    item_codes.add(nuevo_item.id, nuevo_item.sku, nuevo_item.ean13)
 
     return nuevo_item, None  # Devolver item creado y sin error
 
 
+# Comprobar si existe un item sin cargar la fila completa (también si está borrado: conserva su historial)
+def item_exists(db: Session, item_id: int):
+    return db.query(Item.id).filter(Item.id == item_id).first() is not None
+
+
+ITEM_CODE_COLUMNS = {"ean13": Item.ean13, "sku": Item.sku}  # Códigos por los que se resuelve un item
+
+
+# Id del item activo con un EAN13 o SKU (índices únicos de items activos); None si no existe.
+# El resultado queda en el índice en memoria para los siguientes escaneos
+def find_item_id_by_code(db: Session, campo: str, codigo: str):
+    fila = db.execute(
+        select(Item.id, Item.sku, Item.ean13).where(ITEM_CODE_COLUMNS[campo] == codigo, ITEM_ACTIVE)
+    ).first()
+    if fila is None:
+        return None
+    item_codes.add(fila.id, fila.sku, fila.ean13)
+    return fila.id
+
+
+# Items activos de una lista de EAN13 y otra de SKU en una sola consulta; devuelve ({ean13: fila}, {sku: fila})
+def resolve_item_codes(db: Session, ean13s: list, skus: list):
+    condiciones = []
+    if ean13s:
+        condiciones.append(Item.ean13.in_(ean13s))
+    if skus:
+        condiciones.append(Item.sku.in_(skus))
+    if not condiciones:
+        return {}, {}
+    filas = db.execute(select(*ITEM_OUT_COLUMNS).where(or_(*condiciones), ITEM_ACTIVE)).all()
+    for fila in filas:
+        item_codes.add(fila.id, fila.sku, fila.ean13)  # Calentar el índice para los escaneos sueltos
+    pedidos_ean, pedidos_sku = set(ean13s), set(skus)
+    return (
+        {fila.ean13: fila for fila in filas if fila.ean13 in pedidos_ean},
+        {fila.sku: fila for fila in filas if fila.sku in pedidos_sku},
+    )
+
+
+# Eliminar un item; devuelve False si no existe
+# Por defecto es un borrado lógico (deleted_at): el historial se conserva y no se reescriben movimientos.
+# Con purge=True se borran físicamente el item, sus movimientos y sus totales diarios
+def delete_item(db: Session, item_id: int, purge: bool = False, idempotencia: Optional[dict] = None):
+    if not purge:
+        claim_idempotency_key(db, idempotencia)
+        borrado = db.execute(
+            update(Item)
+            .where(Item.id == item_id, ITEM_ACTIVE)
+            .values(deleted_at=now_madrid())
+            .returning(Item.id)
+            .execution_options(synchronize_session=False)
+        ).scalar_one_or_none()
+        if borrado is None:
+            db.rollback()
+            return False
+        close_item_alerts(db, item_id)  # Un item borrado no necesita reposición
+        record_event(db, "item_deleted", [{"id": item_id}])
+        save_idempotent_response(db, idempotencia, None, 204)
+        db.commit()
+        notify_items_changed([item_id])
+        item_codes.discard(item_id)  # Su SKU y EAN13 quedan libres para otro item
+        return True
+
+    item = db.query(Item).filter(Item.id == item_id).first()
+    if not item:
+        return False
+    try:
+        claim_idempotency_key(db, idempotencia)
+        db.query(Movement).filter(Movement.item_id == item_id).delete()
+        db.query(MovementDailyStat).filter(MovementDailyStat.item_id == item_id).delete()  # Sus totales diarios
+        db.query(ItemStock).filter(ItemStock.item_id == item_id).delete()  # Su stock por ubicación
+        db.query(StockAlert).filter(StockAlert.item_id == item_id).delete()  # Sus alertas de reposición
+        db.delete(item)
+        record_event(db, "item_deleted", [{"id": item_id, "purged": True}])
+        save_idempotent_response(db, idempotencia, None, 204)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    notify_items_changed([item_id])
+    item_codes.discard(item_id)
+    return True
+
+
+# INSERT específico del dialecto (PostgreSQL o SQLite) para poder usar ON CONFLICT
+def dialect_insert(db: Session, modelo):
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as insert_dialecto
+    else:
+        from sqlalchemy.dialects.sqlite import insert as insert_dialecto
+    return insert_dialecto(modelo)
+
+
+# Cargar filas en una tabla: COPY FROM STDIN en PostgreSQL, INSERT multi-fila en otros motores
+def copy_rows(db: Session, tabla, filas: list):
+    if not filas:
+        return
+    if db.get_bind().dialect.name != "postgresql":
+        db.execute(insert(tabla), filas)
+        return
+
+    columnas = list(filas[0])
+    conexion = db.connection().connection.driver_connection  # Misma transacción que la sesión
+    if db.get_bind().dialect.driver == "asyncpg":
+        # asyncpg tiene su propio COPY binario; await_only lo ejecuta dentro de run_sync
+        await_only(conexion.copy_records_to_table(
+            tabla.name, records=[tuple(fila.values()) for fila in filas], columns=columnas
+        ))
+        return
+
+    buffer = io.StringIO()
+    # QUOTE_NONNUMERIC: los textos van entre comillas y None queda vacío (NULL en COPY csv)
+    escritor = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for fila in filas:
+        escritor.writerow([
+            to_local_naive(valor) if isinstance(valor, datetime) else valor
+            for valor in fila.values()
+        ])
+    buffer.seek(0)
+    conexion.cursor().copy_expert(f"COPY {tabla.name} ({', '.join(columnas)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+# Insertar items nuevos ignorando conflictos de SKU/EAN13; devuelve (id, sku, quantity, reorder_point) de los creados
+def insert_new_items(db: Session, filas: list):
+    valores = [{"sku": f["sku"], "ean13": f["ean13"], "quantity": f["quantity"]} for f in filas]
+    if db.get_bind().dialect.name == "postgresql":
+        # COPY a una tabla temporal y un único INSERT ... SELECT ... ON CONFLICT
+        db.execute(text(
+            "CREATE TEMP TABLE items_import (sku varchar, ean13 varchar, quantity integer) ON COMMIT DROP"
+        ))
+        copy_rows(db, table("items_import", column("sku"), column("ean13"), column("quantity")), valores)
+        return db.execute(text(
+            "INSERT INTO items (sku, ean13, quantity) SELECT sku, ean13, quantity FROM items_import "
+            "ON CONFLICT DO NOTHING RETURNING id, sku, quantity, reorder_point"
+        )).all()
+
+    tabla = Item.__table__
+    return db.execute(
+        dialect_insert(db, tabla).on_conflict_do_nothing().returning(
+            tabla.c.id, tabla.c.sku, tabla.c.quantity, tabla.c.reorder_point
+        ),
+        valores,
+    ).all()
+
+
+# Importar un bloque de items (upsert por SKU) con consultas por conjuntos
+# filas: lista de dicts con sku, ean13, quantity y line (línea del fichero, para errores)
+def import_items_chunk(db: Session, filas: list, user: str = None):
+    resumen = {"created": 0, "updated": 0, "unchanged": 0, "errors": []}
+
+    # Descartar duplicados dentro del propio bloque (se queda la primera aparición)
+    vistos_sku, vistos_ean, validas = set(), set(), []
+    for fila in filas:
+        if fila["sku"] in vistos_sku or fila["ean13"] in vistos_ean:
+            resumen["errors"].append({"line": fila["line"], "error": "SKU o EAN13 repetido en el fichero"})
+            continue
+        vistos_sku.add(fila["sku"])
+        vistos_ean.add(fila["ean13"])
+        validas.append(fila)
+    if not validas:
+        return resumen
+
+    def operacion():
+        resumen_bloque = {"created": 0, "updated": 0, "unchanged": 0, "errors": []}
+        # Items existentes por SKU (bloqueados) y dueños actuales de los EAN13 del bloque
+        existentes = {
+            fila.sku: fila
+            for fila in db.execute(
+                select(Item.id, Item.sku, Item.ean13, Item.quantity, Item.reorder_point)
+                .where(Item.sku.in_(vistos_sku), ITEM_ACTIVE)
+                .order_by(Item.id)
+                .with_for_update()
+            )
+        }
+        dueno_ean = dict(db.execute(select(Item.ean13, Item.sku).where(Item.ean13.in_(vistos_ean), ITEM_ACTIVE)).all())
+
+        nuevos, cambios, movimientos, ids_creados = [], {}, [], {}
+        ahora = now_madrid()  # Misma hora para todo el bloque
+        for fila in validas:
+            dueno = dueno_ean.get(fila["ean13"])
+            if dueno is not None and dueno != fila["sku"]:
+                resumen_bloque["errors"].append({"line": fila["line"], "error": "EAN13 ya existe"})
+                continue
+            actual = existentes.get(fila["sku"])
+            if actual is None:
+                nuevos.append(fila)
+            elif actual.quantity == fila["quantity"] and actual.ean13 == fila["ean13"]:
+                resumen_bloque["unchanged"] += 1
+            else:
+                cambios[actual.id] = fila
+                if actual.quantity != fila["quantity"]:
+                    movimientos.append({
+                        "item_id": actual.id,
+                        "type": "ajuste",
+                        "amount": fila["quantity"] - actual.quantity,
+                        "timestamp": ahora,
+                        "username": user,
+                        "quantity_before": actual.quantity,
+                        "quantity_after": fila["quantity"],
+                        "location_id": DEFAULT_LOCATION_ID,
+                    })
+
+        if nuevos:
+            # Inserción por conjuntos; ON CONFLICT DO NOTHING cubre SKU/EAN13 creados en paralelo
+            creados = insert_new_items(db, nuevos)
+            ids_creados = {fila.sku: fila for fila in creados}
+            for fila in nuevos:
+                creado = ids_creados.get(fila["sku"])
+                if creado is None:
+                    resumen_bloque["errors"].append({"line": fila["line"], "error": "SKU o EAN13 ya existe"})
+                    continue
+                movimientos.append({
+                    "item_id": creado.id,
+                    "type": "creación",
+                    "amount": creado.quantity,
+                    "timestamp": ahora,
+                    "username": user,
+                    "quantity_before": 0,
+                    "quantity_after": creado.quantity,
+                    "location_id": DEFAULT_LOCATION_ID,
+                })
+            resumen_bloque["created"] = len(creados)
+
+        if cambios:
+            # Un único UPDATE para todos los items modificados del bloque
+            db.execute(
+                update(Item)
+                .where(Item.id.in_(cambios))
+                .values(
+                    quantity=case({i: f["quantity"] for i, f in cambios.items()}, value=Item.id),
+                    ean13=case({i: f["ean13"] for i, f in cambios.items()}, value=Item.id),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            resumen_bloque["updated"] = len(cambios)
+
+        # Alertas de reposición de los items modificados y de los nuevos
+        record_reorder_alerts(db, [
+            (item_id, existentes[f["sku"]].reorder_point, existentes[f["sku"]].quantity, f["quantity"])
+            for item_id, f in cambios.items()
+        ] + [
+            (creado.id, creado.reorder_point, None, creado.quantity) for creado in ids_creados.values()
+        ])
+
+        if movimientos:
+            copy_rows(db, Movement.__table__, movimientos)  # Movimientos del bloque en una sola carga
+            record_movement_stats(db, movimientos)  # Totales diarios en la misma transacción
+            # Las cantidades importadas son totales: la diferencia va a la ubicación principal
+            add_item_stock(db, {
+                (fila["item_id"], DEFAULT_LOCATION_ID): fila["quantity_after"] - fila["quantity_before"]
+                for fila in movimientos
+            })
+        modificados = list(cambios) + [fila["item_id"] for fila in movimientos if fila["type"] == "creación"]
+        if modificados:
+            # Los movimientos cargados con COPY no tienen id en el evento
+            cambios_items = [{"id": i, "ean13": f["ean13"], "quantity": f["quantity"]} for i, f in cambios.items()]
+            cambios_items += [
+                {"id": ids_creados[f["sku"]].id, "sku": f["sku"], "ean13": f["ean13"], "quantity": f["quantity"]}
+                for f in nuevos
+                if f["sku"] in ids_creados
+            ]
+            record_event(db, "stock", cambios_items, movimientos)
+        db.commit()
+        if modificados:
+            notify_items_changed(modificados)
+        for item_id, fila in cambios.items():
+            if existentes[fila["sku"]].ean13 != fila["ean13"]:
+                item_codes.discard(item_id)  # EAN13 cambiado
+        for fila in nuevos:
+            if fila["sku"] in ids_creados:
+                item_codes.add(ids_creados[fila["sku"]].id, fila["sku"], fila["ean13"])
+        return resumen_bloque
+
+    try:
+        resultado = run_with_retries(db, operacion)
+    except IntegrityError:
+        db.rollback()  # Conflicto dentro del bloque (p. ej. EAN13 intercambiados): se rechaza entero
+        resumen["errors"].extend({"line": f["line"], "error": "Conflicto de SKU o EAN13"} for f in validas)
+        return resumen
+    for clave in ("created", "updated", "unchanged"):
+        resumen[clave] += resultado[clave]
+    resumen["errors"].extend(resultado["errors"])
+    return resumen
+
+
+# Recorrer todos los items con un cursor de servidor, en bloques de filas
+def iter_items(db: Session, tamano_bloque: int = 1000):
+    resultado = db.execute(
+        select(Item.id, Item.sku, Item.ean13, Item.quantity)
+        .where(ITEM_ACTIVE)
+        .order_by(Item.id)
+        .execution_options(yield_per=tamano_bloque)  # Sin materializar toda la tabla
+    )
+    yield from resultado.partitions()
+
+
+# Recorrer movimientos filtrados con un cursor de servidor, en bloques de filas
+def iter_movements(db: Session, tamano_bloque: int = 1000, **filtros):
+    query = select(
+        Movement.id, Movement.item_id, Movement.type, Movement.amount, Movement.timestamp,
+        Movement.username, Movement.quantity_before, Movement.quantity_after,
+        Movement.location_id, Movement.to_location_id,
+    )
+    resultado = db.execute(
+        filter_movements(query, **filtros)
+        .order_by(Movement.timestamp.desc(), Movement.id.desc())
+        .execution_options(yield_per=tamano_bloque)
+    )
+    yield from resultado.partitions()
+
+
+# -------------------------
+# Ubicaciones (stock por almacén)
+# -------------------------
+
+# Ids de ubicaciones que se sabe que existen (las ubicaciones no se borran, basta una caché positiva)
+known_locations = {DEFAULT_LOCATION_ID}
+
+
+# Comprobar si existe una ubicación
+def location_exists(db: Session, location_id: int) -> bool:
+    if location_id in known_locations:
+        return True
+    if db.query(Location.id).filter(Location.id == location_id).first() is None:
+        return False
+    known_locations.add(location_id)
+    return True
+
+
+# Validar las ubicaciones de un movimiento; devuelve el mensaje de error o None
+def locations_error(db: Session, origen: int, destino: Optional[int] = None):
+    if destino is not None and destino == origen:
+        return "El origen y el destino del traspaso son la misma ubicación"
+    for location_id in (origen, destino):
+        if location_id is not None and not location_exists(db, location_id):
+            return LOCATION_NOT_FOUND
+    return None
+
+
+# Obtener todas las ubicaciones
+def get_locations(db: Session):
+    return db.query(Location).order_by(Location.id).all()
+
+
+# Crear una ubicación, validando unicidad del código; devuelve (ubicación, error)
+def create_location(db: Session, datos: LocationCreate):
+    if db.query(Location.id).filter(Location.code == datos.code).first():
+        return None, "El código de ubicación ya existe"
+    ubicacion = Location(code=datos.code, name=datos.name)
+    db.add(ubicacion)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()  # Otra petición creó el mismo código a la vez
+        return None, "El código de ubicación ya existe"
+    db.refresh(ubicacion)
+    known_locations.add(ubicacion.id)
+    return ubicacion, None
+
+
+# Stock de un item: el total mantenido en items.quantity y su reparto por ubicación (None si no existe)
+def get_item_stock(db: Session, item_id: int):
+    total = db.scalar(select(Item.quantity).where(Item.id == item_id, ITEM_ACTIVE))
+    if total is None:
+        return None
+    ubicaciones = db.execute(
+        select(ItemStock.location_id, Location.code, ItemStock.quantity)
+        .join(Location, Location.id == ItemStock.location_id)
+        .where(ItemStock.item_id == item_id, ItemStock.quantity != 0)
+        .order_by(ItemStock.location_id)
+    ).all()
+    return {"item_id": item_id, "quantity": total, "locations": rows_to_dicts(ubicaciones, LOCATION_STOCK_FIELDS)}
+
+
+# Items con stock en una ubicación, paginados por id con cursor; devuelve (filas, siguiente_cursor)
+def get_location_items(db: Session, location_id: int, limit: int = 100, cursor: Optional[tuple] = None):
+    query = (
+        select(ItemStock.item_id, Item.sku, Item.ean13, ItemStock.quantity)
+        .join(Item, Item.id == ItemStock.item_id)
+        .where(ItemStock.location_id == location_id, ItemStock.quantity != 0, ITEM_ACTIVE)
+    )
+    if cursor is not None:
+        query = query.where(ItemStock.item_id > cursor[1])
+    filas = db.execute(query.order_by(ItemStock.item_id).limit(limit + 1)).all()
+
+    siguiente_cursor = None
+    if len(filas) > limit:
+        filas = filas[:limit]
+        siguiente_cursor = encode_item_cursor("id", filas[-1].item_id, filas[-1].item_id)
+    return filas, siguiente_cursor
+
+
+# -------------------------
+# Alertas de reposición
+# -------------------------
+
+# Abrir o cerrar la alerta de los items cuya cantidad cruza su punto de pedido.
+# cambios: (item_id, punto de pedido, cantidad antes, cantidad después), con antes None en un item nuevo.
+# Se llama con las filas de los items bloqueadas; si ninguna cantidad cruza su punto de pedido no hace consultas
+def record_reorder_alerts(db: Session, cambios):
+    ahora = now_madrid()
+    abrir, cerrar = [], []
+    for item_id, punto, antes, despues in cambios:
+        if punto is None:
+            continue
+        bajo_antes = antes is not None and antes <= punto
+        if despues <= punto and not bajo_antes:
+            abrir.append({"item_id": item_id, "reorder_point": punto, "quantity": despues, "created_at": ahora})
+        elif despues > punto and bajo_antes:
+            cerrar.append(item_id)
+    if abrir:
+        db.execute(insert(StockAlert), abrir)
+    if cerrar:
+        close_item_alerts(db, cerrar, ahora)
+
+
+# Cerrar las alertas abiertas de uno o varios items
+def close_item_alerts(db: Session, item_ids, ahora: Optional[datetime] = None):
+    if isinstance(item_ids, int):
+        item_ids = [item_ids]
+    db.execute(
+        update(StockAlert)
+        .where(StockAlert.item_id.in_(item_ids), StockAlert.resolved_at.is_(None))
+        .values(resolved_at=ahora or now_madrid())
+        .execution_options(synchronize_session=False)
+    )
+
+
+# Cambiar el punto de pedido de un item y abrir o cerrar su alerta según la cantidad actual; None si no existe
+def set_reorder_point(db: Session, item_id: int, punto: Optional[int]):
+    def operacion():
+        # UPDATE ... RETURNING bloquea la fila: ningún movimiento cambia la cantidad mientras tanto
+        cantidad = db.execute(
+            update(Item)
+            .where(Item.id == item_id, ITEM_ACTIVE)
+            .values(reorder_point=punto)
+            .returning(Item.quantity)
+            .execution_options(synchronize_session=False)
+        ).scalar_one_or_none()
+        if cantidad is None:
+            db.rollback()
+            return None
+        abierta = db.scalar(
+            select(StockAlert.id).where(StockAlert.item_id == item_id, StockAlert.resolved_at.is_(None))
+        ) is not None
+        if abierta and (punto is None or cantidad > punto):
+            close_item_alerts(db, item_id)
+        elif not abierta and punto is not None and cantidad <= punto:
+            record_reorder_alerts(db, [(item_id, punto, None, cantidad)])
+        record_event(db, "stock", [{"id": item_id, "quantity": cantidad, "reorder_point": punto}])
+        db.commit()
+        notify_items_changed([item_id])
+        return db.get(Item, item_id, populate_existing=True)
+
+    return run_with_retries(db, operacion)
+
+
+# Recalcular todas las alertas abiertas a partir de las cantidades actuales (migración, carga masiva o
+# reparación): abre las que faltan y cierra las de items por encima del punto de pedido, sin él o borrados
+def rebuild_reorder_alerts(db: Session):
+    ahora = now_madrid()
+    bajo_minimo = and_(ITEM_ACTIVE, Item.reorder_point.is_not(None), Item.quantity <= Item.reorder_point)
+    abiertas = select(StockAlert.item_id).where(StockAlert.resolved_at.is_(None))
+    cerradas = db.execute(
+        update(StockAlert)
+        .where(StockAlert.resolved_at.is_(None), StockAlert.item_id.not_in(select(Item.id).where(bajo_minimo)))
+        .values(resolved_at=ahora)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    abiertas_nuevas = db.execute(
+        insert(StockAlert).from_select(
+            ["item_id", "reorder_point", "quantity", "created_at"],
+            select(Item.id, Item.reorder_point, Item.quantity, literal(ahora))
+            .where(bajo_minimo, Item.id.not_in(abiertas)),
+        )
+    ).rowcount
+    db.commit()
+    return {"opened": abiertas_nuevas, "resolved": cerradas}
+
+
+# Consumo diario medio (unidades de salida) de cada item en los últimos días, desde los totales diarios:
+# se leen como mucho unos pocos totales por item y día, sin recorrer los movimientos
+def consumption_rates(dias: int = CONSUMPTION_WINDOW_DAYS, item_ids=None):
+    desde = now_madrid().date() - timedelta(days=dias - 1)  # Ventana de "dias" días que acaba hoy
+    consulta = (
+        select(
+            MovementDailyStat.item_id,
+            (cast(func.sum(MovementDailyStat.amount), Float) / dias).label("rate"),
+        )
+        .where(MovementDailyStat.type == "salida", MovementDailyStat.day >= desde)
+        .group_by(MovementDailyStat.item_id)
+    )
+    if item_ids is not None:
+        consulta = consulta.where(MovementDailyStat.item_id.in_(item_ids))
+    return consulta.subquery()
+
+
+# Alertas de reposición (por defecto solo las abiertas), de la más urgente a la menos:
+# días hasta agotarse al consumo medio de la ventana, y después las más recientes
+def get_alerts(db: Session, include_resolved: bool = False, limit: int = 100, dias: int = CONSUMPTION_WINDOW_DAYS):
+    filtro = true() if include_resolved else StockAlert.resolved_at.is_(None)
+    consumo = consumption_rates(dias, select(StockAlert.item_id).where(filtro))
+    ritmo = func.coalesce(consumo.c.rate, 0.0)
+    dias_rotura = case(
+        (Item.quantity <= 0, literal(0.0)),
+        (ritmo > 0, cast(Item.quantity, Float) / ritmo),
+        else_=None,
+    )
+    return db.execute(
+        select(
+            StockAlert.id, StockAlert.item_id, Item.sku, Item.quantity, Item.reorder_point,
+            StockAlert.quantity.label("triggered_quantity"), StockAlert.created_at, StockAlert.resolved_at,
+            ritmo.label("daily_consumption"), dias_rotura.label("days_to_stockout"),
+        )
+        .join(Item, Item.id == StockAlert.item_id)
+        .outerjoin(consumo, consumo.c.item_id == StockAlert.item_id)
+        .where(filtro)
+        .order_by(dias_rotura.asc().nulls_last(), StockAlert.created_at.desc(), StockAlert.id.desc())
+        .limit(limit)
+    ).all()
+
+
+# -------------------------
+# Archivado de movimientos
+# -------------------------
+
+# Columnas guardadas en los ficheros de archivo (una línea JSON por movimiento)
+ARCHIVE_COLUMNS = [
+    "id", "item_id", "type", "amount", "timestamp", "username", "quantity_before", "quantity_after",
+    "location_id", "to_location_id",
+]
+
+
+# Meses archivados, del más reciente al más antiguo
+def get_archives(db: Session):
+    return db.scalars(select(MovementArchive).order_by(MovementArchive.range_start.desc())).all()
+
+
+# Fecha hasta la que (sin incluir) los movimientos están archivados; None si no hay nada archivado
+def archived_until(db: Session):
+    return db.scalar(select(func.max(MovementArchive.range_end)))
+
+
+# Recorrer los movimientos archivados en orden descendente de (timestamp, id), aplicando cursor y filtros
+# Devuelve MovementRecord con las mismas columnas que las filas de la base de datos
+def iter_archived_movements(
+    db: Session, cursor=None, item_id=None, type=None, username=None, desde=None, hasta=None
+):
+    desde, hasta = to_local_naive(desde), to_local_naive(hasta)
+    for archivo in get_archives(db):
+        if (hasta is not None and archivo.range_start > hasta) or (cursor is not None and archivo.range_start > cursor[0]):
+            continue  # Mes posterior a lo que se busca
+        if desde is not None and archivo.range_end <= desde:
+            break  # Este mes y los siguientes son anteriores a lo que se busca
+        with gzip.open(archivo.path, "rt", encoding="utf-8") as fichero:
+            for linea in fichero:
+                datos = json.loads(linea)
+                datos["timestamp"] = datetime.fromisoformat(datos["timestamp"])
+                if cursor is not None and (datos["timestamp"], datos["id"]) >= tuple(cursor):
+                    continue
+                if hasta is not None and datos["timestamp"] > hasta:
+                    continue
+                if desde is not None and datos["timestamp"] < desde:
+                    break  # El fichero está ordenado de más reciente a más antiguo
+                if (item_id is not None and datos["item_id"] != item_id) or \
+                        (type is not None and datos["type"] != type) or \
+                        (username is not None and datos["username"] != username):
+                    continue
+                # Los archivos anteriores a las ubicaciones no tienen sus columnas
+                yield MovementRecord(*(datos.get(campo) for campo in MOVEMENT_FIELDS))
+
+
+# Archivar un mes de movimientos: fichero NDJSON comprimido, registro en el manifiesto y borrado
+# (en PostgreSQL se separa y borra la partición del mes, sin reescribir filas). None si el mes está vacío
+def archive_month(db: Session, inicio: date, directorio: str = MOVEMENTS_ARCHIVE_DIR):
+    rango_inicio = datetime.combine(inicio, datetime.min.time())
+    rango_fin = datetime.combine(partitions.add_months(inicio, 1), datetime.min.time())
+    en_rango = and_(Movement.timestamp >= rango_inicio, Movement.timestamp < rango_fin)
+
+    # Foto de stock al final del mes: las consultas posteriores no necesitan los movimientos archivados
+    create_snapshot(db, rango_fin - timedelta(microseconds=1))
+
+    ruta = os.path.join(directorio, f"movements_{inicio:%Y_%m}.ndjson.gz")
+    temporal = ruta + ".tmp"
+    filas = 0
+    with gzip.open(temporal, "wt", encoding="utf-8") as fichero:
+        resultado = db.execute(
+            select(*(getattr(Movement, columna) for columna in ARCHIVE_COLUMNS))
+            .where(en_rango)
+            .order_by(Movement.timestamp.desc(), Movement.id.desc())
+            .execution_options(yield_per=5000)
+        )
+        for fila in resultado:
+            fichero.write(json.dumps(dict(fila._mapping), default=lambda valor: valor.isoformat()) + "\n")
+            filas += 1
+    if filas == 0:
+        os.remove(temporal)
+        db.rollback()
+        return None
+    os.replace(temporal, ruta)  # El fichero solo aparece completo
+
+    archivo = MovementArchive(
+        range_start=rango_inicio, range_end=rango_fin, path=ruta, row_count=filas, created_at=now_madrid()
+    )
+    db.add(archivo)
+    conexion = db.connection()
+    if not (
+        partitions.is_partitioned(conexion, Movement.__tablename__)
+        and partitions.drop_month_partition(conexion, Movement.__tablename__, inicio)
+    ):
+        db.execute(delete(Movement).where(en_rango))  # Sin partición propia (SQLite o partición por defecto)
+    db.commit()
+    db.refresh(archivo)
+    return archivo
+
+
+# Archivar todos los meses completos anteriores a una fecha; devuelve los meses archivados
+def archive_movements(db: Session, antes: date, directorio: str = MOVEMENTS_ARCHIVE_DIR):
+    limite = partitions.month_start(antes)
+    if limite > partitions.month_start(now_madrid()):
+        raise ValueError("No se puede archivar el mes en curso")
+    mas_antiguo = db.scalar(select(func.min(Movement.timestamp)))
+    if mas_antiguo is None:
+        return []
+    os.makedirs(directorio, exist_ok=True)
+
+    archivados = []
+    inicio = partitions.month_start(mas_antiguo)
+    while inicio < limite:
+        if db.scalar(select(MovementArchive.id).where(MovementArchive.range_start == datetime.combine(inicio, datetime.min.time()))):
+            raise ValueError(f"El mes {inicio:%Y-%m} ya está archivado y vuelve a tener movimientos")
+        archivo = archive_month(db, inicio, directorio)
+        if archivo is not None:
+            archivados.append(archivo)
+        inicio = partitions.add_months(inicio, 1)
+    return archivados
+
+
+# -------------------------
+# Fotos de stock y consultas a una fecha
+# -------------------------
+
+# Variación de stock registrada por un movimiento (válida para todos los tipos)
+MOVEMENT_CHANGE = Movement.quantity_after - Movement.quantity_before
+
+
+# Items que existían (no estaban borrados) en una fecha
+def existing_at(fecha: datetime):
+    return or_(ITEM_ACTIVE, Item.deleted_at > fecha)
+
+
+# Fecha más reciente que admite una foto: los movimientos anteriores ya están confirmados
+def snapshot_cutoff() -> datetime:
+    return now_madrid() - timedelta(seconds=SNAPSHOT_SETTLE_SECONDS)
+
+
+# Foto más reciente tomada en o antes de una fecha (None si no hay ninguna)
+# Una foto posterior al margen de asentamiento (creada antes de que se validara la fecha) puede no incluir
+# movimientos confirmados después: nunca se usa como base
+def get_snapshot_before(db: Session, fecha: datetime):
+    return db.scalars(
+        select(StockSnapshot)
+        .where(StockSnapshot.taken_at <= fecha, StockSnapshot.taken_at <= snapshot_cutoff())
+        .order_by(StockSnapshot.taken_at.desc())
+        .limit(1)
+    ).first()
+
+
+# Cantidades por item a una fecha: foto base + variaciones de los movimientos posteriores a ella
+# Devuelve una subconsulta (item_id, quantity) y la foto usada como base
+def stock_at_query(db: Session, fecha: datetime):
+    base = get_snapshot_before(db, fecha)
+    variaciones = select(Movement.item_id, MOVEMENT_CHANGE.label("quantity")).where(Movement.timestamp <= fecha)
+    if base is None:
+        return variaciones.subquery(), None  # Sin fotos anteriores: se recorre todo el historial
+    partes = union_all(
+        select(StockSnapshotItem.item_id, StockSnapshotItem.quantity).where(StockSnapshotItem.snapshot_id == base.id),
+        variaciones.where(Movement.timestamp > base.taken_at),  # Solo la actividad desde la foto
+    )
+    return partes.subquery(), base
+
+
+# Tomar una foto del stock de todos los items en una fecha (por defecto, ahora menos el margen)
+# Se construye a partir de la foto anterior y los movimientos desde entonces, no de todo el historial
+def create_snapshot(db: Session, fecha: Optional[datetime] = None):
+    limite = snapshot_cutoff()
+    corte = min(to_local_naive(fecha), limite) if fecha else limite  # Nunca después del margen de asentamiento
+    existente = db.scalars(select(StockSnapshot).where(StockSnapshot.taken_at == corte)).first()
+    if existente is not None:
+        return existente
+
+    partes, _ = stock_at_query(db, corte)
+    snapshot = StockSnapshot(taken_at=corte)
+    db.add(snapshot)
+    db.flush()  # Obtener el id de la foto
+    db.execute(
+        insert(StockSnapshotItem).from_select(
+            ["snapshot_id", "item_id", "quantity"],
+            select(literal(snapshot.id), partes.c.item_id, func.sum(partes.c.quantity))
+            .where(partes.c.item_id.in_(select(Item.id).where(existing_at(corte))))  # Sin los ya borrados
+            .group_by(partes.c.item_id),
+        )
+    )
+    snapshot.item_count = db.scalar(
+        select(func.count()).select_from(StockSnapshotItem).where(StockSnapshotItem.snapshot_id == snapshot.id)
+    )
+    db.commit()
+    db.refresh(snapshot)
+    return snapshot
+
+
+# Foto programada: solo si la última tiene más de "intervalo" segundos y ningún otro proceso está tomándola
+def take_scheduled_snapshot(db: Session, intervalo: int):
+    if db.get_bind().dialect.name == "postgresql":
+        libre = db.execute(text("SELECT pg_try_advisory_xact_lock(:clave)"), {"clave": SNAPSHOT_LOCK_ID}).scalar()
+        if not libre:
+            db.rollback()
+            return None
+    corte = now_madrid() - timedelta(seconds=SNAPSHOT_SETTLE_SECONDS)
+    ultima = get_snapshot_before(db, corte)
+    if ultima is not None and ultima.taken_at > corte - timedelta(seconds=intervalo):
+        db.rollback()  # Liberar el lock
+        return None
+    return create_snapshot(db, corte)
+
+
+# Listar las fotos tomadas, de la más reciente a la más antigua
+def get_snapshots(db: Session, limit: int = 100):
+    return db.scalars(select(StockSnapshot).order_by(StockSnapshot.taken_at.desc()).limit(limit)).all()
+
+
+# Stock de cada item a una fecha; devuelve (filas item_id/sku/ean13/quantity, foto usada o None)
+# Los items creados después de la fecha no aparecen, ni los borrados antes de ella
+def get_stock_at(db: Session, fecha: datetime):
+    fecha = to_local_naive(fecha)
+    partes, base = stock_at_query(db, fecha)
+    filas = db.execute(
+        select(Item.id.label("item_id"), Item.sku, Item.ean13, func.sum(partes.c.quantity).label("quantity"))
+        .join(partes, partes.c.item_id == Item.id)
+        .where(existing_at(fecha))
+        .group_by(Item.id, Item.sku, Item.ean13)
+        .order_by(Item.id)
+    ).all()
+    return filas, base
+
+
+# Comprobar la coherencia del historial y de una foto (por defecto, la más reciente); None si la foto no existe
+# - Enlaces rotos: quantity_before de un movimiento distinto del quantity_after del anterior del mismo item
+# - Items descuadrados: cantidad actual distinta del quantity_after de su último movimiento
+# - Descuadres de la foto: cantidad de la foto distinta del último quantity_after hasta su fecha
+def check_consistency(db: Session, snapshot_id: Optional[int] = None, max_ejemplos: int = 20):
+    snapshot = db.get(StockSnapshot, snapshot_id) if snapshot_id else get_snapshot_before(db, now_madrid())
+    if snapshot_id and snapshot is None:
+        return None
+
+    orden = (Movement.timestamp, Movement.id)
+    cadena = select(
+        Movement.id,
+        Movement.item_id,
+        Movement.quantity_before,
+        func.lag(Movement.quantity_after).over(partition_by=Movement.item_id, order_by=orden).label("anterior"),
+    ).subquery()
+    enlace_roto = cadena.c.anterior != cadena.c.quantity_before
+    if archived_until(db) is None:
+        # Sin meses archivados, el primer movimiento de cada item parte de 0
+        enlace_roto = or_(enlace_roto, and_(cadena.c.anterior.is_(None), cadena.c.quantity_before != 0))
+    enlaces_rotos = db.scalar(select(func.count()).select_from(cadena).where(enlace_roto))
+    ejemplos_enlaces = db.execute(
+        select(cadena.c.id, cadena.c.item_id, cadena.c.anterior, cadena.c.quantity_before)
+        .where(enlace_roto)
+        .order_by(cadena.c.id)
+        .limit(max_ejemplos)
+    ).all()
+
+    # Último movimiento de cada item (opcionalmente hasta una fecha)
+    def ultimos(hasta=None):
+        consulta = select(
+            Movement.item_id,
+            Movement.quantity_after,
+            func.row_number().over(
+                partition_by=Movement.item_id, order_by=(Movement.timestamp.desc(), Movement.id.desc())
+            ).label("posicion"),
+        )
+        if hasta is not None:
+            consulta = consulta.where(Movement.timestamp <= hasta)
+        sub = consulta.subquery()
+        return select(sub.c.item_id, sub.c.quantity_after).where(sub.c.posicion == 1).subquery()
+
+    finales = ultimos()
+    descuadrados = db.execute(
+        select(Item.id, Item.quantity, finales.c.quantity_after)
+        .join(finales, finales.c.item_id == Item.id)
+        .where(Item.quantity != finales.c.quantity_after)
+        .order_by(Item.id)
+    ).all()
+
+    # Suma del stock por ubicación distinta de la cantidad total del item
+    por_ubicacion = (
+        select(ItemStock.item_id, func.sum(ItemStock.quantity).label("suma"))
+        .group_by(ItemStock.item_id)
+        .subquery()
+    )
+    suma_ubicaciones = func.coalesce(por_ubicacion.c.suma, 0)
+    descuadres_ubicacion = db.execute(
+        select(Item.id, Item.quantity, suma_ubicaciones.label("suma"))
+        .outerjoin(por_ubicacion, por_ubicacion.c.item_id == Item.id)
+        .where(Item.quantity != suma_ubicaciones)
+        .order_by(Item.id)
+    ).all()
+
+    descuadres_foto = []
+    if snapshot is not None:
+        en_foto = ultimos(snapshot.taken_at)
+        descuadres_foto = db.execute(
+            select(StockSnapshotItem.item_id, StockSnapshotItem.quantity, en_foto.c.quantity_after)
+            .join(en_foto, en_foto.c.item_id == StockSnapshotItem.item_id)
+            .where(StockSnapshotItem.snapshot_id == snapshot.id)
+            .where(StockSnapshotItem.quantity != en_foto.c.quantity_after)
+            .order_by(StockSnapshotItem.item_id)
+        ).all()
+
+    return {
+        "ok": not (enlaces_rotos or descuadrados or descuadres_ubicacion or descuadres_foto),
+        "broken_links": enlaces_rotos,
+        "broken_link_samples": [
+            {"movement_id": f.id, "item_id": f.item_id, "previous_after": f.anterior, "quantity_before": f.quantity_before}
+            for f in ejemplos_enlaces
+        ],
+        "item_mismatches": len(descuadrados),
+        "item_mismatch_samples": [
+            {"item_id": f.id, "quantity": f.quantity, "last_quantity_after": f.quantity_after}
+            for f in descuadrados[:max_ejemplos]
+        ],
+        "location_mismatches": len(descuadres_ubicacion),
+        "location_mismatch_samples": [
+            {"item_id": f.id, "quantity": f.quantity, "locations_total": f.suma}
+            for f in descuadres_ubicacion[:max_ejemplos]
+        ],
+        "snapshot_id": snapshot.id if snapshot is not None else None,
+        "snapshot_mismatches": len(descuadres_foto),
+        "snapshot_mismatch_samples": [
+            {"item_id": f.item_id, "snapshot_quantity": f.quantity, "last_quantity_after": f.quantity_after}
+            for f in descuadres_foto[:max_ejemplos]
+        ],
+    }
+
+
+# -------------------------
+# Analítica de movimientos (sobre los totales diarios)
+# -------------------------
+
+PERIODOS = ("day", "week", "month")  # Agrupaciones temporales disponibles
+
+
+# Primer día del periodo (día, semana empezando en lunes o mes) que contiene una fecha
+def period_start(db: Session, columna, periodo: str):
+    if db.get_bind().dialect.name == "postgresql":
+        return cast(func.date_trunc(periodo, columna), Date)
+    if periodo == "week":
+        return func.date(columna, "-6 days", "weekday 1")  # Lunes de esa semana (SQLite)
+    if periodo == "month":
+        return func.date(columna, "start of month")
+    return func.date(columna)
+
+
+# Suma de amount de un tipo de movimiento dentro de una agregación
+def sum_of_type(tipo: str):
+    return func.coalesce(func.sum(case((MovementDailyStat.type == tipo, MovementDailyStat.amount), else_=0)), 0)
+
+
+# Filtrar los totales diarios por rango de días (ambos incluidos)
+def filter_stats(query, desde: Optional[date] = None, hasta: Optional[date] = None):
+    if desde is not None:
+        query = query.where(MovementDailyStat.day >= desde)
+    if hasta is not None:
+        query = query.where(MovementDailyStat.day <= hasta)
+    return query
+
+
+# Unidades por tipo de movimiento, agrupadas por periodo y por producto o usuario
+def get_throughput(
+    db: Session,
+    agrupar: str = "item",
+    periodo: str = "day",
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    item_id: Optional[int] = None,
+    username: Optional[str] = None,
+    limit: int = 1000,
+):
+    s = MovementDailyStat
+    inicio = period_start(db, s.day, periodo).label("period")
+    clave = s.item_id.label("item_id") if agrupar == "item" else s.username.label("username")
+    query = filter_stats(select(
+        inicio,
+        clave,
+        sum_of_type("entrada").label("entrada"),
+        sum_of_type("salida").label("salida"),
+        sum_of_type("ajuste").label("ajuste"),
+        func.sum(s.change).label("net_change"),
+        func.sum(s.movements).label("movements"),
+    ), desde, hasta)
+    if item_id is not None:
+        query = query.where(s.item_id == item_id)
+    if username is not None:
+        query = query.where(s.username == username)
+    filas = db.execute(query.group_by(inicio, clave).order_by(inicio, clave).limit(limit)).all()
+    if agrupar == "username":
+        return [{**fila._mapping, "username": fila.username or None} for fila in filas]  # "" = sin usuario
+    return filas
+
+
+# Productos con más unidades de salida (o de entrada, o más movimientos) en un rango de días
+def get_top_movers(
+    db: Session, desde: Optional[date] = None, hasta: Optional[date] = None, metrica: str = "units_out", limit: int = 20
+):
+    s = MovementDailyStat
+    totales = filter_stats(select(
+        s.item_id,
+        sum_of_type("salida").label("units_out"),
+        sum_of_type("entrada").label("units_in"),
+        func.sum(s.movements).label("movements"),
+    ), desde, hasta).group_by(s.item_id).subquery()
+    return db.execute(
+        select(totales.c.item_id, Item.sku, totales.c.units_out, totales.c.units_in, totales.c.movements)
+        .join(Item, Item.id == totales.c.item_id)
+        .order_by(totales.c[metrica].desc(), totales.c.item_id)
+        .limit(limit)
+    ).all()
+
+
+# Rotación de stock por producto: unidades de salida del periodo / stock medio (media de inicio y fin)
+# El stock al inicio y al final se obtiene de las fotos de stock más los movimientos posteriores
+def get_turnover(db: Session, desde: date, hasta: date, limit: int = 100):
+    s = MovementDailyStat
+    salidas = filter_stats(
+        select(s.item_id, sum_of_type("salida").label("units_out")), desde, hasta
+    ).group_by(s.item_id).subquery()
+
+    def stock_en(fecha):
+        partes, _ = stock_at_query(db, fecha)
+        return select(partes.c.item_id, func.sum(partes.c.quantity).label("quantity")).group_by(partes.c.item_id).subquery()
+
+    inicio = stock_en(datetime.combine(desde, datetime.min.time()) - timedelta(microseconds=1))  # Justo antes de "desde"
+    fin = stock_en(datetime.combine(hasta, datetime.max.time()))  # Al final de "hasta"
+    stock_inicio = func.coalesce(inicio.c.quantity, 0)
+    stock_fin = func.coalesce(fin.c.quantity, 0)
+    stock_medio = (stock_inicio + stock_fin) / 2.0
+    rotacion = case((stock_medio > 0, salidas.c.units_out / stock_medio))  # Sin stock medio positivo: NULL
+    return db.execute(
+        select(
+            salidas.c.item_id,
+            Item.sku,
+            salidas.c.units_out,
+            stock_inicio.label("stock_start"),
+            stock_fin.label("stock_end"),
+            stock_medio.label("average_stock"),
+            rotacion.label("turnover"),
+        )
+        .join(Item, Item.id == salidas.c.item_id)
+        .outerjoin(inicio, inicio.c.item_id == salidas.c.item_id)
+        .outerjoin(fin, fin.c.item_id == salidas.c.item_id)
+        .where(salidas.c.units_out > 0)
+        .order_by(rotacion.desc().nulls_last(), salidas.c.item_id)
+        .limit(limit)
+    ).all()
+
+
+# Recalcular los totales diarios desde el historial (datos anteriores a los totales o tras una corrección)
+# Los días de meses archivados no se recalculan
+def rebuild_movement_stats(db: Session):
+    if db.get_bind().dialect.name == "postgresql":
+        # Las escrituras concurrentes esperan a que termine: ningún movimiento se cuenta dos veces ni se pierde
+        db.execute(text("LOCK TABLE movement_daily_stats IN EXCLUSIVE MODE"))
+    # Los días archivados ya no tienen movimientos en la base de datos: sus totales se conservan
+    limite = archived_until(db)
+    borrar = db.query(MovementDailyStat)
+    if limite is not None:
+        borrar = borrar.filter(MovementDailyStat.day >= limite.date())
+    borrar.delete(synchronize_session=False)
+    dia = func.date(Movement.timestamp)
+    usuario = func.coalesce(Movement.username, "")
+    db.execute(
+        insert(MovementDailyStat).from_select(
+            ["day", "item_id", "username", "type", "amount", "change", "movements"],
+            select(dia, Movement.item_id, usuario, Movement.type, func.sum(Movement.amount), func.sum(MOVEMENT_CHANGE), func.count())
+            .group_by(dia, Movement.item_id, usuario, Movement.type),
+        )
+    )
+    filas = db.scalar(select(func.count()).select_from(MovementDailyStat))
+    db.commit()
+    return filas
+
+
+# -------------------------
+# Eventos en tiempo real
+# -------------------------
+
+# Id del último evento registrado (0 si no hay ninguno)
+def get_last_event_id(db: Session) -> int:
+    return db.scalar(select(func.max(StockEvent.id))) or 0
+
+
+# Eventos con id posterior a desde_id (y hasta hasta_id si se indica), en orden
+def get_events_after(db: Session, desde_id: int, limit: int = 1000, hasta_id: Optional[int] = None):
+    query = select(StockEvent.id, StockEvent.type, StockEvent.payload, StockEvent.source).where(StockEvent.id > desde_id)
+    if hasta_id is not None:
+        query = query.where(StockEvent.id <= hasta_id)
+    return db.execute(query.order_by(StockEvent.id).limit(limit)).all()
+
+
+# Eventos para reanudar un cliente desde su último id; None si ya no se conservan todos
+# (eventos limpiados o demasiados pendientes): el cliente debe recargar el estado completo
+def get_events_to_resume(db: Session, desde_id: int, hasta_id: int, limit: int = 1000):
+    if desde_id >= hasta_id:
+        return []
+    primero = db.scalar(select(func.min(StockEvent.id)))
+    if primero is None or desde_id < primero - 1:
+        return None
+    filas = get_events_after(db, desde_id, limit + 1, hasta_id)
+    return filas if len(filas) <= limit else None
+
+
+# Borrar los eventos anteriores al periodo de retención; devuelve cuántos se han borrado
+def prune_events(db: Session, horas: int = EVENTS_RETENTION_HOURS):
+    limite = now_madrid() - timedelta(hours=horas)
+    borrados = db.execute(delete(StockEvent).where(StockEvent.created_at < limite)).rowcount
+    db.commit()
+    return borrados
+
+
+# -------------------------
+# Idempotencia de las escrituras
+# -------------------------
+
+# La clave ya tiene una respuesta guardada: la escritura se ha deshecho y hay que devolver la guardada
+class DuplicateRequest(Exception):
+    pass
+
+
+# Petición con cabecera Idempotency-Key: usuario, clave y hash de lo que pide (método, ruta y cuerpo)
+def idempotency_request(username: str, clave: str, metodo: str, ruta: str, datos) -> dict:
+    resumen = hashlib.sha256(f"{metodo} {ruta}\n".encode() + dumps(datos)).hexdigest()
+    return {"username": username, "key": clave, "request_hash": resumen}
+
+
+# Reservar la clave de una escritura al principio de su transacción, antes de tocar el stock o registrar el
+# evento (sin efecto si la petición no trae clave). El INSERT choca con la clave primaria si la clave ya se
+# usó, y en PostgreSQL espera a que termine una petición concurrente con la misma clave. En ese caso se
+# deshace la transacción y se lanza DuplicateRequest sin haber gastado ningún id de stock_events: un
+# reintento no deja huecos en la secuencia de eventos. La fila solo existe si la escritura se confirma
+def claim_idempotency_key(db: Session, idempotencia: Optional[dict]):
+    if idempotencia is None:
+        return
+    try:
+        db.execute(insert(IdempotencyKey).values(**idempotencia, status_code=0, created_at=now_madrid()))
+    except IntegrityError:
+        db.rollback()
+        raise DuplicateRequest()
+
+
+# Guardar la respuesta de una escritura en la clave reservada, justo antes del commit
+def save_idempotent_response(db: Session, idempotencia: Optional[dict], cuerpo: Optional[str], status_code: int = 200):
+    if idempotencia is None:
+        return
+    db.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.username == idempotencia["username"], IdempotencyKey.key == idempotencia["key"])
+        .values(status_code=status_code, response=cuerpo)
+    )
+
+
+# Respuesta guardada para la clave de una petición (None si la clave no se ha usado).
+# Solo se consulta cuando la escritura no ha terminado bien: deshace antes lo que quede de ella
+def find_idempotent_response(db: Session, idempotencia: dict):
+    db.rollback()
+    return db.execute(
+        select(IdempotencyKey.request_hash, IdempotencyKey.status_code, IdempotencyKey.response)
+        .where(IdempotencyKey.username == idempotencia["username"], IdempotencyKey.key == idempotencia["key"])
+    ).first()
+
+
+# Borrar las claves de idempotencia caducadas; devuelve cuántas se han borrado
+def prune_idempotency_keys(db: Session, horas: int = IDEMPOTENCY_TTL_HOURS):
+    limite = now_madrid() - timedelta(hours=horas)
+    borradas = db.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < limite)).rowcount
+    db.commit()
+    return borradas
+
+
 # Buscar usuario por username
 def get_user_by_username(db, username: str):
     return db.query(User).filter(User.username == username).first()
@@ -113,7 +1797,7 @@ def get_user_by_username(db, username: str):
 
 # Crear nuevo usuario con password hasheada
 def create_user(db, user_data):
-    hashed_pw = pwd_context.hash(user_data.password)  # Hashear contraseña
+    hashed_pw = hash_password(user_data.password)  # Hashear contraseña (en el pool de procesos)
     user = User(username=user_data.username, hashed_password=hashed_pw)
     db.add(user)  # Añadir usuario
     db.commit()  # Guardar cambios
@@ -121,29 +1805,49 @@ def create_user(db, user_data):
     return user
 
 
+# Guardar un hash nuevo de la misma contraseña (rehash al cambiar el coste de bcrypt)
+def update_user_password_hash(db: Session, user_id: int, hashed_password: str):
+    user = db.get(User, user_id)  # Normalmente ya está en la sesión: sin consulta extra
+    user.hashed_password = hashed_password
+    db.commit()
+    return user
+
+
 # Reiniciar base de datos borrando datos y creando usuarios e items iniciales
 def reset_database(db: Session):
     print("Resetting database...")  
 
+    db.query(StockSnapshotItem).delete()  # Borrar fotos de stock
+    db.query(StockSnapshot).delete()
+    db.query(MovementDailyStat).delete()  # Borrar totales diarios
+    db.query(MovementArchive).delete()  # Olvidar los meses archivados (los ficheros se conservan)
+    db.query(IdempotencyKey).delete()  # Las respuestas guardadas se refieren a los datos borrados
     db.query(Movement).delete()  # Borrar movimientos
+    db.query(ItemStock).delete()  # Borrar stock por ubicación (las ubicaciones se conservan)
+    db.query(StockAlert).delete()  # Borrar alertas de reposición
     db.query(Item).delete()  # Borrar items
     db.query(User).delete()  # Borrar usuarios
     db.commit()  # Confirmar borrado
+    item_codes.clear()
 
     usuarios_iniciales = ["admin", "guillem", "divain"]  # Usuarios por defecto
     for nombre in usuarios_iniciales:
         create_user(db, UserCreate(username=nombre, password="1234"))  # Crear usuarios con password por defecto
 
-    # Crear items iniciales
+    # Crear items iniciales (EAN13 con dígito de control válido, como exigen POST /items y la importación)
     items = [
-        Item(sku="SKU123", ean13="1234567890123", quantity=15),
-        Item(sku="SKU456", ean13="9876543210987", quantity=5),
-        Item(sku="SKU789", ean13="4567890123456", quantity=0),
+        Item(sku=sku, ean13=base + ean13_check_digit(base), quantity=cantidad)
+        for sku, base, cantidad in [
+            ("SKU123", "123456789012", 15),
+            ("SKU456", "987654321098", 5),
+            ("SKU789", "456789012345", 0),
+        ]
     ]
     db.add_all(items)  # Añadir todos los items
     db.commit()  # Guardar cambios
 
-    ahora = datetime.now(pytz.timezone("Europe/Madrid"))  # Fecha actual en Madrid
+    ahora = now_madrid()  # Fecha actual en Madrid
+    movimientos = []
     for item in items:
         movimiento = Movement(
             item_id=item.id,
@@ -152,26 +1856,28 @@ def reset_database(db: Session):
             timestamp=ahora,
             username="sistema",  # Usuario sistema
             quantity_before=0,
-            quantity_after=item.quantity
+            quantity_after=item.quantity,
+            location_id=DEFAULT_LOCATION_ID,
         )
         db.add(movimiento)  # Añadir movimiento
+        movimientos.append(movimiento)
 
+    add_item_stock(db, {(item.id, DEFAULT_LOCATION_ID): item.quantity for item in items})  # Todo en la principal
+    record_reorder_alerts(db, [(item.id, item.reorder_point, None, item.quantity) for item in items])
+    record_movement_stats(db, movimientos)  # Totales diarios
+    record_event(db, "reset")  # Los clientes conectados deben recargar todo
     db.commit()  # Guardar movimientos
+    notify_items_changed([item.id for item in items])
     print("Database reset complete")  # Mensaje de confirmación
 
 
 # Cambiar la contraseña de un usuario, validando la actual
-def change_user_password(db: Session, user: User, old_password: str, new_password: str):
-    print(f"Intentando cambiar contraseña de: {user.username}")
-
-    # Recuperar usuario desde DB por id para obtener datos actuales
-    user_in_db = db.query(User).filter(User.id == user.id).first()
-
-    # Verificar que la contraseña antigua coincida
-    if not pwd_context.verify(old_password, user_in_db.hashed_password):
-        return False, "Contraseña actual incorrecta"
+def change_user_password(db: Session, user_id: int, hashed_password: str):
+    user_in_db = db.get(User, user_id)  # Recuperar usuario desde DB por id
+    print(f"Cambiando contraseña de: {user_in_db.username}")
 
-    # Hashear la nueva contraseña y actualizarla
-    user_in_db.hashed_password = pwd_context.hash(new_password)
+    # La contraseña antigua se verifica y la nueva se hashea en el endpoint (bcrypt en el pool de procesos)
+    user_in_db.hashed_password = hashed_password
+    user_in_db.password_version = User.password_version + 1  # Invalida los tokens anteriores
     db.commit()  # Guardar cambios
-    return True, "Contraseña actualizada correctamente"
+    return user_in_db
@@ -0,0 +1,71 @@
+import functools
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+import crud
+
+# Versiones asíncronas de las funciones de crud.py
+# Con AsyncSession (DB_ASYNC=1) la función se ejecuta con run_sync sobre el driver asíncrono;
+# con Session síncrona se ejecuta en el threadpool, igual que un endpoint "def" normal
+def to_async(funcion):
+    @functools.wraps(funcion)
+    async def envoltura(db, *args, **kwargs):
+        if isinstance(db, AsyncSession):
+            return await db.run_sync(funcion, *args, **kwargs)
+        return await run_in_threadpool(funcion, db, *args, **kwargs)
+    return envoltura
+
+
+# Items
+get_items = to_async(crud.get_items)
+get_item = to_async(crud.get_item)
+get_items_page = to_async(crud.get_items_page)
+estimate_items_count = to_async(crud.estimate_items_count)
+item_exists = to_async(crud.item_exists)
+find_item_id_by_code = to_async(crud.find_item_id_by_code)
+resolve_item_codes = to_async(crud.resolve_item_codes)
+create_item = to_async(crud.create_item)
+update_item_quantity = to_async(crud.update_item_quantity)
+delete_item = to_async(crud.delete_item)
+import_items_chunk = to_async(crud.import_items_chunk)
+
+# Movimientos
+get_movements = to_async(crud.get_movements)
+create_movement = to_async(crud.create_movement)
+create_movements_batch = to_async(crud.create_movements_batch)
+archived_until = to_async(crud.archived_until)
+
+# Ubicaciones
+location_exists = to_async(crud.location_exists)
+get_locations = to_async(crud.get_locations)
+create_location = to_async(crud.create_location)
+get_item_stock = to_async(crud.get_item_stock)
+get_location_items = to_async(crud.get_location_items)
+
+# Alertas de reposición
+set_reorder_point = to_async(crud.set_reorder_point)
+get_alerts = to_async(crud.get_alerts)
+rebuild_reorder_alerts = to_async(crud.rebuild_reorder_alerts)
+
+# Fotos de stock
+create_snapshot = to_async(crud.create_snapshot)
+get_snapshots = to_async(crud.get_snapshots)
+get_stock_at = to_async(crud.get_stock_at)
+check_consistency = to_async(crud.check_consistency)
+
+# Analítica
+get_throughput = to_async(crud.get_throughput)
+get_top_movers = to_async(crud.get_top_movers)
+get_turnover = to_async(crud.get_turnover)
+rebuild_movement_stats = to_async(crud.rebuild_movement_stats)
+
+# Idempotencia
+find_idempotent_response = to_async(crud.find_idempotent_response)
+
+# Usuarios
+get_user_by_username = to_async(crud.get_user_by_username)
+create_user = to_async(crud.create_user)
+change_user_password = to_async(crud.change_user_password)
+update_user_password_hash = to_async(crud.update_user_password_hash)
+reset_database = to_async(crud.reset_database)
@@ -1,19 +1,142 @@
-from sqlalchemy import create_engine
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+# Configuración de conexión a la base de datos PostgreSQL (sobrescribible por variables de entorno)
+DB_USER = os.getenv("DB_USER", "guillemsanchezescoi")  # Usuario de la base de datos
+DB_PASSWORD = os.getenv("DB_PASSWORD", "")  # Contraseña de la base de datos (vacío si no hay)
+DB_HOST = os.getenv("DB_HOST", "localhost")  # Host donde está la base de datos
+DB_PORT = os.getenv("DB_PORT", "5432")  # Puerto de conexión a PostgreSQL
+DB_NAME = os.getenv("DB_NAME", "inventario")  # Nombre de la base de datos
+
+# Cadena de conexión completa; DATABASE_URL tiene prioridad sobre las variables sueltas
+DATABASE_URL = os.getenv(
+    "DATABASE_URL", f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
+
+# Ajustes del pool de conexiones y del motor
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))  # Conexiones mantenidas abiertas
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))  # Conexiones extra en picos
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # Segundos máximos esperando conexión
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Renovar conexiones tras N segundos
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"  # Comprobar la conexión antes de usarla
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))  # 0 = sin límite
+# Detrás de PgBouncer en modo transacción: sin pool propio, sin sentencias preparadas con nombre
+# y statement_timeout por transacción (PgBouncer no admite parámetros de arranque)
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"
+# Conexiones abiertas al arrancar cada worker, para que las primeras peticiones no esperen a conectar
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", "2"))
+
+DB_ASYNC = os.getenv("DB_ASYNC", "0") == "1"  # Usar AsyncEngine/AsyncSession (asyncpg)
+
+# -------------------------
+# Métricas del pool
+# -------------------------
+
+# Estadísticas acumuladas de espera al obtener conexiones, por pool
+pool_wait_stats = {}
+pool_wait_lock = threading.Lock()
+
+# Registrar el tiempo de espera de una obtención de conexión
+def record_pool_wait(nombre: str, espera: float, timeout: bool = False):
+    with pool_wait_lock:
+        stats = pool_wait_stats.setdefault(
+            nombre, {"checkouts": 0, "timeouts": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+        )
+        stats["checkouts"] += 1
+        stats["timeouts"] += int(timeout)
+        stats["wait_seconds_total"] += espera
+        stats["wait_seconds_max"] = max(stats["wait_seconds_max"], espera)
+
+# Pools que miden cuánto se espera por una conexión libre
+class MeasuredQueuePool(QueuePool):
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            conexion = super()._do_get()
+        except Exception:
+            record_pool_wait("sync", time.perf_counter() - inicio, timeout=True)
+            raise
+        record_pool_wait("sync", time.perf_counter() - inicio)
+        return conexion
+
+class MeasuredAsyncQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            conexion = super()._do_get()
+        except Exception:
+            record_pool_wait("async", time.perf_counter() - inicio, timeout=True)
+            raise
+        record_pool_wait("async", time.perf_counter() - inicio)
+        return conexion
+
+# -------------------------
+# Creación de motores
+# -------------------------
+
+# Argumentos de create_engine según motor, driver y modo PgBouncer
+def engine_options(url: str, asincrono: bool = False):
+    opciones = {}
+    es_postgres = url.startswith("postgresql")
+
+    if DB_PGBOUNCER:
+        opciones["poolclass"] = NullPool  # PgBouncer ya agrupa las conexiones
+    else:
+        opciones.update(
+            poolclass=MeasuredAsyncQueuePool if asincrono else MeasuredQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+
+    if es_postgres:
+        if asincrono:
+            connect_args = {}
+            if DB_PGBOUNCER:
+                # Sentencias preparadas sin caché y con nombre único (no se comparten entre conexiones)
+                connect_args["statement_cache_size"] = 0
+                connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid.uuid4()}__"
+            elif DB_STATEMENT_TIMEOUT_MS:
+                connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+            opciones["connect_args"] = connect_args
+        elif DB_STATEMENT_TIMEOUT_MS and not DB_PGBOUNCER:
+            # Parámetro de arranque: se aplica al abrir la conexión, sin consultas extra
+            opciones["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return opciones
+
+# Con PgBouncer el statement_timeout se fija al inicio de cada transacción
+def set_local_statement_timeout(motor):
+    @event.listens_for(motor, "begin")
+    def fijar_timeout(conexion):
+        conexion.exec_driver_sql(f"SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
 
-# Configuración de conexión a la base de datos PostgreSQL
-DB_USER = "guillemsanchezescoi"  # Usuario de la base de datos
-DB_PASSWORD = ""  # Contraseña de la base de datos (vacío si no hay)
-DB_HOST = "localhost"  # Host donde está la base de datos
-DB_PORT = "5432"  # Puerto de conexión a PostgreSQL
-DB_NAME = "inventario"  # Nombre de la base de datos
+# SQLite no tiene SELECT ... FOR UPDATE y sqlite3 no abre la transacción hasta la primera escritura, así que dos
+# peticiones podían leer la misma cantidad. Cada transacción empieza con BEGIN IMMEDIATE: toma el bloqueo de
+# escritura de la base de datos y las demás esperan (o fallan con "database is locked" y se reintentan)
+def use_immediate_transactions(motor):
+    @event.listens_for(motor, "connect")
+    def desactivar_begin_implicito(conexion_dbapi, registro):
+        conexion_dbapi.isolation_level = None  # SQLAlchemy emite el BEGIN
 
-# Cadena de conexión completa con formato para PostgreSQL
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    @event.listens_for(motor, "begin")
+    def begin_immediate(conexion):
+        conexion.exec_driver_sql("BEGIN IMMEDIATE")
 
-# Crear motor de base de datos para conectar con PostgreSQL
-engine = create_engine(DATABASE_URL)
+# Crear motor de base de datos
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+if DB_PGBOUNCER and DB_STATEMENT_TIMEOUT_MS and DATABASE_URL.startswith("postgresql"):
+    set_local_statement_timeout(engine)
+if DATABASE_URL.startswith("sqlite"):
+    use_immediate_transactions(engine)
 
 # Crear fábrica de sesiones que manejarán las transacciones
 SessionLocal = sessionmaker(
@@ -22,5 +145,101 @@ SessionLocal = sessionmaker(
     bind=engine       # Asociar sesiones con el motor de base de datos
 )
 
+# -------------------------
+# Modo asíncrono (opcional): DB_ASYNC=1 usa AsyncEngine/AsyncSession con asyncpg
+# -------------------------
+
+# Drivers asíncronos equivalentes a cada motor
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+def to_async_url(url: str) -> str:
+    motor, resto = url.split("://", 1)
+    return f"{ASYNC_DRIVERS.get(motor, motor)}://{resto}"
+
+async_engine = None
+AsyncSessionLocal = None
+
+if DB_ASYNC:
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    # Motor asíncrono: las consultas no bloquean el event loop ni ocupan hilos del threadpool
+    async_engine = create_async_engine(to_async_url(DATABASE_URL), **engine_options(DATABASE_URL, True))
+    if DB_PGBOUNCER and DB_STATEMENT_TIMEOUT_MS and DATABASE_URL.startswith("postgresql"):
+        set_local_statement_timeout(async_engine.sync_engine)
+    if DATABASE_URL.startswith("sqlite"):
+        use_immediate_transactions(async_engine.sync_engine)
+
+    AsyncSessionLocal = async_sessionmaker(
+        bind=async_engine,
+        autoflush=False,
+        expire_on_commit=False,  # Evitar recargas perezosas (no permitidas fuera de await) tras commit
+    )
+
+# -------------------------
+# Dependencia de sesión compartida
+# -------------------------
+
+# Dependencia de sesión síncrona
+def get_sync_db():
+    db = SessionLocal()  # Crear sesión
+    try:
+        yield db  # Proveer sesión para uso en endpoints
+    finally:
+        db.close()  # Cerrar sesión al finalizar
+
+# Dependencia de sesión asíncrona
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Única dependencia usada por endpoints y autenticación: FastAPI la resuelve una vez por petición,
+# así una petición autenticada usa una sola sesión (y una sola conexión)
+get_db = get_async_db if DB_ASYNC else get_sync_db
+
+# -------------------------
+# Calentamiento del pool
+# -------------------------
+
+# Abrir a la vez hasta "conexiones" conexiones y devolverlas al pool (sin pool propio no hay nada que calentar)
+def warm_up_pool(motor, conexiones: int):
+    if not hasattr(motor.pool, "size"):
+        return
+    abiertas = []
+    try:
+        for _ in range(min(conexiones, motor.pool.size())):
+            abiertas.append(motor.connect())
+    finally:
+        for conexion in abiertas:
+            conexion.close()
+
+async def warm_up_async_pool(motor, conexiones: int):
+    if not hasattr(motor.sync_engine.pool, "size"):
+        return
+    abiertas = []
+    try:
+        for _ in range(min(conexiones, motor.sync_engine.pool.size())):
+            abiertas.append(await motor.connect())
+    finally:
+        for conexion in abiertas:
+            await conexion.close()
+
+# Estado actual de los pools y tiempos de espera acumulados
+def get_pool_metrics():
+    motores = {"sync": engine}
+    if async_engine is not None:
+        motores["async"] = async_engine.sync_engine
+    metricas = {}
+    for nombre, motor in motores.items():
+        pool = motor.pool
+        metricas[nombre] = {
+            "pool_class": type(pool).__name__,
+            "size": pool.size() if hasattr(pool, "size") else None,
+            "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+            "checked_in": pool.checkedin() if hasattr(pool, "checkedin") else None,
+            "overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+            **pool_wait_stats.get(nombre, {}),
+        }
+    return metricas
+
 # Crear clase base para modelos declarativos (ORM)
 Base = declarative_base()
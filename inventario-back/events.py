@@ -0,0 +1,202 @@
+import asyncio
+import json
+import os
+import select
+import threading
+import time
+import uuid
+from collections import deque
+
+from cache import MemoryBackend, item_cache
+
+EVENTS_CHANNEL = "inventario_events"  # Canal de LISTEN/NOTIFY de PostgreSQL
+EVENTS_CLIENT_BUFFER = int(os.getenv("EVENTS_CLIENT_BUFFER", "256"))  # Eventos pendientes por cliente como máximo
+EVENTS_MAX_CLIENTS = int(os.getenv("EVENTS_MAX_CLIENTS", "10000"))  # Clientes conectados por worker como máximo
+EVENTS_BACKLOG = int(os.getenv("EVENTS_BACKLOG", "5000"))  # Eventos recientes en memoria para reanudar sin consultas
+EVENTS_POLL_SECONDS = float(os.getenv("EVENTS_POLL_SECONDS", "2"))  # Comprobación periódica (respaldo de NOTIFY)
+EVENTS_KEEPALIVE_SECONDS = float(os.getenv("EVENTS_KEEPALIVE_SECONDS", "15"))  # Latido hacia clientes inactivos
+# Espera máxima por un id de evento que falta: puede ser una transacción aún sin confirmar
+# (se entrega en orden) o una transacción deshecha (el id no llegará nunca)
+EVENTS_GAP_SECONDS = float(os.getenv("EVENTS_GAP_SECONDS", "2"))
+EVENTS_FETCH_SIZE = 1000  # Eventos leídos por consulta
+
+PROCESS_ID = uuid.uuid4().hex[:12]  # Identifica los eventos escritos por este worker
+
+# -------------------------
+# Eventos
+# -------------------------
+
+# Evento ya codificado: el texto se genera una vez y se comparte entre todos los clientes
+class StreamEvent:
+    __slots__ = ("id", "type", "data", "source", "sse", "json")
+
+    def __init__(self, id: int, type: str, data: str, source: str = None):
+        self.id = id
+        self.type = type
+        self.data = data  # JSON ya serializado
+        self.source = source
+        self.sse = f"id: {id}\nevent: {type}\ndata: {data}\n\n"
+        self.json = f'{{"id": {id}, "event": "{type}", "data": {data}}}'
+
+# Cliente conectado: cola acotada; si se llena, el cliente se desconecta y reanuda con su último id
+class Subscriber:
+    def __init__(self, tamano: int):
+        self.queue = asyncio.Queue(maxsize=tamano)
+        self.overflowed = False
+
+# -------------------------
+# Distribución de eventos en el worker
+# -------------------------
+
+# Lee los eventos confirmados de la base de datos en orden de id y los reparte a los clientes del worker.
+# Un aviso (NOTIFY o escritura local) o la comprobación periódica despiertan la lectura
+class EventHub:
+    def __init__(self, buffer: int = EVENTS_CLIENT_BUFFER, backlog: int = EVENTS_BACKLOG, max_clients: int = EVENTS_MAX_CLIENTS):
+        self.buffer = buffer
+        self.max_clients = max_clients
+        self.subscribers = set()
+        self.recent = deque(maxlen=backlog)
+        self.cursor = None  # Último id entregado (todos los anteriores entregados o descartados)
+        self.gap_since = None  # Desde cuándo se espera el id siguiente al cursor
+        self.loop = None
+        self.wakeup = None
+        self.counters = {"published": 0, "dropped_clients": 0, "skipped_gaps": 0, "rejected_clients": 0}
+
+    # Avisar de que hay eventos nuevos; se puede llamar desde cualquier hilo
+    def wake(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def subscribe(self):
+        if len(self.subscribers) >= self.max_clients:
+            self.counters["rejected_clients"] += 1
+            return None
+        suscriptor = Subscriber(self.buffer)
+        self.subscribers.add(suscriptor)
+        return suscriptor
+
+    def unsubscribe(self, suscriptor: Subscriber):
+        self.subscribers.discard(suscriptor)
+
+    # Entregar un evento a todos los clientes sin esperar a ninguno
+    def publish(self, evento: StreamEvent):
+        self.recent.append(evento)
+        self.counters["published"] += 1
+        for suscriptor in list(self.subscribers):
+            try:
+                suscriptor.queue.put_nowait(evento)
+            except asyncio.QueueFull:
+                # Cliente lento: se desconecta en vez de acumular memoria o frenar a los demás
+                suscriptor.overflowed = True
+                self.subscribers.discard(suscriptor)
+                self.counters["dropped_clients"] += 1
+        if evento.source != PROCESS_ID:
+            invalidate_remote_items(evento)
+
+    # Eventos posteriores a un id desde la memoria; None si ya no están todos en memoria
+    def replay(self, desde_id: int):
+        if desde_id >= (self.cursor or 0):
+            return []
+        if not self.recent or self.recent[0].id > desde_id + 1:
+            return None
+        return [evento for evento in self.recent if evento.id > desde_id]
+
+    # Eventos de un cliente a partir de un id; produce None como latido si no hay eventos
+    async def listen(self, suscriptor: Subscriber, desde_id: int = 0):
+        while not suscriptor.overflowed:
+            try:
+                evento = await asyncio.wait_for(suscriptor.queue.get(), EVENTS_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if suscriptor.overflowed:
+                break  # Lo pendiente ya no está completo: el cliente reanudará con su último id
+            if evento.id > desde_id:  # Evita repetir los ya enviados al reanudar
+                yield evento
+
+    # Leer y entregar los eventos nuevos; fetch(desde_id, limite) devuelve filas (id, type, payload, source)
+    def deliver(self, filas):
+        for fila in filas:
+            if fila.id != self.cursor + 1:
+                ahora = time.monotonic()
+                if self.gap_since is None:
+                    self.gap_since = ahora
+                if ahora - self.gap_since < EVENTS_GAP_SECONDS:
+                    self.loop.call_later(0.05, self.wakeup.set)  # Reintentar en breve
+                    return False
+                self.counters["skipped_gaps"] += 1  # El id que falta no llegará: transacción deshecha
+            self.gap_since = None
+            self.cursor = fila.id
+            self.publish(StreamEvent(fila.id, fila.type, fila.payload, fila.source))
+        return True
+
+    async def run(self, fetch, last_id):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.cursor = await asyncio.to_thread(last_id)  # Solo se reparten eventos posteriores al arranque
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), EVENTS_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                while True:
+                    filas = await asyncio.to_thread(fetch, self.cursor, EVENTS_FETCH_SIZE)
+                    if not self.deliver(filas) or len(filas) < EVENTS_FETCH_SIZE:
+                        break
+            except Exception as e:
+                print(f"Error al leer eventos: {e}")
+                await asyncio.sleep(1)
+
+    def stats(self):
+        return {**self.counters, "clients": len(self.subscribers), "cursor": self.cursor, "recent": len(self.recent)}
+
+event_hub = EventHub()
+
+# Con la caché en memoria, cada worker tiene la suya: los cambios hechos en otros workers la invalidan aquí
+def invalidate_remote_items(evento: StreamEvent):
+    if not isinstance(item_cache.backend, MemoryBackend):
+        return  # Caché compartida (Redis): ya la invalidó el worker que hizo el cambio
+    try:
+        item_ids = [item["id"] for item in json.loads(evento.data).get("items", [])]
+    except (ValueError, AttributeError, KeyError, TypeError):
+        item_ids = []
+    item_cache.invalidate(item_ids)
+
+# -------------------------
+# LISTEN/NOTIFY (PostgreSQL)
+# -------------------------
+
+# Hilo con una conexión dedicada que escucha el canal y despierta el reparto en cada aviso.
+# Necesita una conexión directa a PostgreSQL: PgBouncer en modo transacción no admite LISTEN
+def listen_notifications(url: str, avisar, parar: threading.Event, canal: str = EVENTS_CHANNEL):
+    import psycopg2
+    import psycopg2.extensions
+
+    while not parar.is_set():
+        conexion = None
+        try:
+            conexion = psycopg2.connect(url)
+            conexion.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conexion.cursor().execute(f"LISTEN {canal}")
+            avisar()  # Recoger lo que se haya confirmado mientras no se escuchaba
+            while not parar.is_set():
+                if select.select([conexion], [], [], 1) == ([], [], []):
+                    continue
+                conexion.poll()
+                if conexion.notifies:
+                    conexion.notifies.clear()  # Basta un aviso: el reparto lee todos los eventos nuevos
+                    avisar()
+        except Exception as e:
+            print(f"Error escuchando eventos: {e}")
+            parar.wait(5)  # Reintentar la conexión
+        finally:
+            if conexion is not None:
+                conexion.close()
+
+def start_listener(url: str) -> threading.Event:
+    parar = threading.Event()
+    hilo = threading.Thread(target=listen_notifications, args=(url, event_hub.wake, parar), name="events-listener", daemon=True)
+    hilo.start()
+    return parar
@@ -1,21 +1,45 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Response, WebSocket, WebSocketDisconnect, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.requests import Request
+from starlette.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from jose import JWTError, jwt
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from typing import Optional
+from contextlib import asynccontextmanager
+import asyncio
+import csv
+import io
+import json
+import os
 import pytz
+import random
+import traceback
 
-from database import SessionLocal, engine
-from models import Base, Item, Movement, User
-from auth import get_current_user
+from database import (
+    DB_POOL_WARMUP, SessionLocal, async_engine, engine, get_db, get_pool_metrics, warm_up_async_pool, warm_up_pool
+)
+from models import Movement
+from cache import etag_matches, item_cache, item_codes
+from events import StreamEvent, event_hub, start_listener
+from serialization import FastJSONResponse, dumps, rows_to_dicts, schema_fields
+from metrics import RequestMetricsMiddleware, instrument_engine, registry, render_gauges, route_label
+from profiler import create_profiler
+from auth import Principal, get_admin_user, get_current_user, principal_cache, require_metrics_access, token_claims
 import crud
-from crud import reset_database, change_user_password
+import crud_async
+import migrations
+import partitions
+from security import get_hashing_metrics, hash_password_async, verify_and_update_async
 from schemas import (
-    ItemOut, ItemCreate, ItemUpdate,
-    MovementOut, MovementCreate,
+    ItemOut, ItemCreate, ItemUpdate, ItemImportOut, ItemResolveIn, ItemResolveOut,
+    MovementOut, MovementCreate, MovementBatchOut,
+    LocationCreate, LocationOut, ItemStockOut, LocationItemOut, ReorderPointUpdate, AlertOut,
+    SnapshotOut, StockAtOut, ThroughputOut, TopMoverOut, TurnoverOut,
     UserCreate, ChangePassword
 )
 
@@ -23,24 +47,52 @@ from schemas import (
 # Inicialización y Configuración de la base de datos y app
 # -------------------------
 
-Base.metadata.create_all(bind=engine)  # Crear tablas en la base de datos si no existen
+# Medir las consultas de los motores (número y tiempo por petición, consultas lentas)
+instrument_engine(engine)
+if async_engine is not None:
+    instrument_engine(async_engine.sync_engine)
 
-with SessionLocal() as db:
-    print("Checking DB tables...")
-    # Comprobar si las tablas tienen datos, si no, resetear base de datos (solo desarrollo/testing)
-    if not (db.query(Item).first() and db.query(User).first() and db.query(Movement).first()):
-        print("Tables empty or incomplete, resetting database")
-        reset_database(db)
-        print("Reset done")
-    else:
-        print("DB tables already have data")
+# Arranque y parada de cada worker. No crea tablas ni datos (ver manage.py): comprueba la versión del
+# esquema, abre las primeras conexiones del pool y lanza las tareas en segundo plano
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(prepare_database)
+    if async_engine is not None:
+        await warm_up_async_pool(async_engine, DB_POOL_WARMUP)
+    start_background_jobs()
+    try:
+        yield
+    finally:
+        stop_background_jobs()
+        if async_engine is not None:
+            await async_engine.dispose()  # Las conexiones asyncpg pertenecen al event loop que termina
 
-app = FastAPI()  # Crear instancia de la aplicación FastAPI
+app = FastAPI(lifespan=lifespan)  # Crear instancia de la aplicación FastAPI
 
 # Variables para el manejo del token JWT
 SECRET_KEY = "clave-super-secreta"  # Clave secreta para firmar los tokens JWT
 ALGORITHM = "HS256"  # Algoritmo de cifrado para JWT
 ACCESS_TOKEN_EXPIRE_MINUTES = 60  # Duración de vida del token en minutos
+MAX_BATCH_SIZE = 10000  # Máximo de registros aceptados en un lote de movimientos
+IMPORT_CHUNK_SIZE = 5000  # Filas por transacción al importar items
+MAX_IMPORT_ERRORS = 1000  # Errores detallados devueltos como máximo en una importación
+IDEMPOTENCY_KEY_MAX_LENGTH = 255  # Longitud máxima de la cabecera Idempotency-Key
+MAX_RESOLVE_CODES = 1000  # Códigos como máximo en POST /items/resolve
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}  # Formatos de exportación
+ITEM_COLUMNS = ["id", "sku", "ean13", "quantity"]
+SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "86400"))  # Fotos de stock (0 = desactivadas)
+SNAPSHOT_CHECK_SECONDS = 60  # Cada cuánto se comprueba si toca una foto nueva o faltan particiones
+EVENTS_REPLAY_LIMIT = 10000  # Eventos pendientes como máximo al reanudar; con más, el cliente recarga todo
+EVENTS_RETRY_MS = 3000  # Espera antes de reconectar que se indica a los clientes SSE
+# Conexión directa para LISTEN (sin PgBouncer); por defecto, la misma base de datos que el motor
+EVENTS_LISTEN_URL = os.getenv("EVENTS_LISTEN_URL") or engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+# Aplicar al arrancar las migraciones pendientes; con 0, el worker no arranca si el esquema no está al día
+# (las migraciones se aplican antes del despliegue con "python manage.py migrate")
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1") == "1"
+MOVEMENT_COLUMNS = [
+    "id", "item_id", "type", "amount", "timestamp", "username", "quantity_before", "quantity_after",
+    "location_id", "to_location_id",
+]
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")  # Esquema OAuth2 para login
 
@@ -56,12 +108,28 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Permitir todos los métodos HTTP
     allow_headers=["*"],  # Permitir todos los headers
+    expose_headers=["X-Next-Cursor", "X-Total-Estimate", "ETag", "X-DB-Queries", "Server-Timing", "Idempotent-Replayed"],  # Cabeceras legibles desde el frontend
 )
 
+# Latencia, consultas por petición y perfiles de las peticiones lentas (PROFILE_THRESHOLD_MS)
+profiler = create_profiler()
+app.add_middleware(RequestMetricsMiddleware, profiler=profiler)
+
 # -------------------------
 # Funciones Utilitarias
 # -------------------------
 
+STOCK_AT_FIELDS = schema_fields(StockAtOut)
+ALERT_FIELDS = schema_fields(AlertOut)
+
+# Respuesta JSON ya serializada con su ETag; 304 sin cuerpo si el cliente tiene la misma versión
+def cached_json_response(request: Request, etag: str, cuerpo: bytes):
+    cabeceras = {"ETag": etag, "Cache-Control": "no-cache"}  # El cliente debe revalidar siempre
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        item_cache.record_not_modified()
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cabeceras)
+    return Response(content=cuerpo, media_type="application/json", headers=cabeceras)
+
 def create_access_token(data: dict, expires_delta: timedelta):
     to_encode = data.copy()
     expire = datetime.utcnow() + expires_delta  # Calcular expiración token
@@ -69,12 +137,280 @@ def create_access_token(data: dict, expires_delta: timedelta):
     # Generar token firmado con clave secreta y algoritmo
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_db():
-    db = SessionLocal()  # Crear sesión de base de datos
+# Página de movimientos serializada directamente desde las filas (sin validar cada una con MovementOut)
+async def paginate_movements(db: Session, cursor: Optional[str], **filtros):
+    cursor_decodificado = None
+    if cursor is not None:
+        cursor_decodificado = crud.decode_cursor(cursor)
+        if cursor_decodificado is None:
+            raise HTTPException(status_code=400, detail="Cursor no válido")
+
+    movimientos, siguiente_cursor = await crud_async.get_movements(db, cursor=cursor_decodificado, **filtros)
+    cabeceras = {}
+    if siguiente_cursor:
+        cabeceras["X-Next-Cursor"] = siguiente_cursor  # Cursor para pedir la siguiente página
+    return FastJSONResponse(rows_to_dicts(movimientos, crud.MOVEMENT_FIELDS), headers=cabeceras)
+
+# Las consultas de stock a una fecha necesitan los movimientos de la base de datos: no sirven para meses archivados
+async def reject_archived_period(db: Session, fecha: datetime):
+    limite = await crud_async.archived_until(db)
+    if limite is not None and crud.to_local_naive(fecha) < limite:
+        raise HTTPException(status_code=400, detail=f"La fecha pertenece a un periodo archivado (anterior a {limite:%Y-%m-%d})")
+
+# Último id de evento recibido por un cliente (cabecera Last-Event-ID); None si no hay o no es válido
+def parse_event_id(valor: Optional[str]):
     try:
-        yield db  # Proveer sesión para usar en endpoints
-    finally:
-        db.close()  # Cerrar sesión después de su uso
+        return int(valor) if valor else None
+    except ValueError:
+        return None
+
+# Leer de la base de datos los eventos para reanudar un cliente (con sesión propia)
+def fetch_events_to_resume(desde_id: int, hasta_id: int):
+    with SessionLocal() as db:
+        return crud.get_events_to_resume(db, desde_id, hasta_id, EVENTS_REPLAY_LIMIT)
+
+# Eventos que un cliente se ha perdido desde su último id: de memoria si es posible, si no de la base de datos.
+# Si ya no se conservan, un único evento "reset" indica al cliente que recargue el estado completo
+async def events_to_resume(ultimo_id: Optional[int]):
+    if ultimo_id is None:
+        return []  # Cliente nuevo: solo eventos a partir de ahora
+    eventos = event_hub.replay(ultimo_id)
+    if eventos is None:
+        filas = await run_in_threadpool(fetch_events_to_resume, ultimo_id, event_hub.cursor or 0)
+        if filas is None:
+            return [StreamEvent(event_hub.cursor or 0, "reset", "{}")]
+        eventos = [StreamEvent(*fila) for fila in filas]
+    return eventos
+
+# Clave de idempotencia de una escritura (cabecera Idempotency-Key); None si la petición no la trae
+# datos: lo que pide la petición (cuerpo validado); con otra petición, la misma clave se rechaza
+def idempotency_request(request: Request, current_user: Principal, datos):
+    clave = request.headers.get("idempotency-key")
+    if clave is None:
+        return None
+    if not clave or len(clave) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key debe tener entre 1 y {IDEMPOTENCY_KEY_MAX_LENGTH} caracteres")
+    ruta = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+    return crud.idempotency_request(current_user.username, clave, request.method, ruta, datos)
+
+# Ejecutar una escritura con clave de idempotencia. La respuesta se guarda en la transacción de la escritura;
+# si la escritura no termina bien (la clave ya tenía respuesta, o el reintento falla porque la primera
+# petición ya hizo el cambio: stock insuficiente, SKU repetido...) y la clave está usada, se devuelve
+# la respuesta guardada. La consulta de la clave solo se hace en ese caso, nunca en una escritura correcta
+async def run_idempotent(request: Request, db: Session, idempotencia: Optional[dict], escritura):
+    try:
+        return await escritura()
+    except (HTTPException, IntegrityError, crud.DuplicateRequest) as error:
+        if idempotencia is None:
+            raise
+        guardada = await crud_async.find_idempotent_response(db, idempotencia)
+        if guardada is None:
+            if isinstance(error, crud.DuplicateRequest):
+                # La clave caducó entre el INSERT y la consulta: el cliente puede repetir la petición
+                raise HTTPException(status_code=409, detail="La clave de idempotencia acaba de caducar, repita la petición")
+            raise
+    ruta = route_label(request.scope)
+    if guardada.request_hash != idempotencia["request_hash"]:
+        registry.record_idempotent_replay(ruta, "mismatch")
+        raise HTTPException(status_code=422, detail="La clave de idempotencia ya se usó con otra petición")
+    registry.record_idempotent_replay(ruta, "replayed")
+    return Response(
+        content=guardada.response,
+        status_code=guardada.status_code,
+        media_type="application/json" if guardada.response is not None else None,
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+# Validar un registro de un lote; devuelve MovementCreate o el mensaje de error
+def parse_batch_record(registro):
+    try:
+        return MovementCreate.model_validate(registro)
+    except ValidationError as error:
+        return "; ".join(
+            f"{'.'.join(map(str, e['loc']))}: {e['msg']}" if e["loc"] else e["msg"]
+            for e in error.errors()
+        )
+
+# Interpretar una línea NDJSON; None si no es JSON válido (se reporta como registro rechazado)
+def parse_ndjson_line(linea: bytes):
+    try:
+        return json.loads(linea)
+    except ValueError:
+        return None
+
+# Recorrer las líneas de un cuerpo subido en streaming, sin cargarlo entero en memoria
+async def iter_upload_lines(request: Request):
+    pendiente = b""
+    async for bloque in request.stream():
+        *lineas, pendiente = (pendiente + bloque).split(b"\n")  # La última línea puede estar incompleta
+        for linea in lineas:
+            yield linea
+    if pendiente:
+        yield pendiente
+
+# Leer el cuerpo de un lote: array JSON o NDJSON (un registro por línea) leído en streaming
+async def read_batch_body(request: Request):
+    limite_excedido = HTTPException(status_code=413, detail=f"Máximo {MAX_BATCH_SIZE} movimientos por lote")
+
+    if "ndjson" in request.headers.get("content-type", ""):
+        registros = []
+        async for linea in iter_upload_lines(request):
+            if linea.strip():
+                registros.append(parse_ndjson_line(linea))
+            if len(registros) > MAX_BATCH_SIZE:
+                raise limite_excedido  # Cortar la lectura sin esperar al resto del cuerpo
+    else:
+        try:
+            registros = json.loads(await request.body())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="JSON no válido")
+        if not isinstance(registros, list):
+            raise HTTPException(status_code=400, detail="Se esperaba un array de movimientos")
+
+    if len(registros) > MAX_BATCH_SIZE:
+        raise limite_excedido
+    return [parse_batch_record(registro) for registro in registros]
+
+# Leer las filas de una importación de items (CSV con cabecera o NDJSON) en streaming
+# Produce dicts con sku, ean13, quantity y line, o dicts con line y error si la fila no es válida
+async def iter_import_rows(request: Request):
+    es_ndjson = "ndjson" in request.headers.get("content-type", "")
+    cabecera = None
+    numero = 0
+    async for linea in iter_upload_lines(request):
+        numero += 1
+        texto = linea.decode("utf-8-sig", errors="replace").strip()
+        if not texto:
+            continue
+        if es_ndjson:
+            registro = parse_ndjson_line(linea)
+        elif cabecera is None:
+            cabecera = [columna.strip().lower() for columna in next(csv.reader([texto]))]
+            continue
+        else:
+            registro = dict(zip(cabecera, next(csv.reader([texto]))))
+        try:
+            item = ItemCreate.model_validate(registro)
+        except ValidationError as error:
+            yield {"line": numero, "error": "; ".join(e["msg"] for e in error.errors())}
+            continue
+        yield {"sku": item.sku, "ean13": item.ean13, "quantity": item.quantity, "line": numero}
+
+# Convertir un bloque de filas al formato de exportación
+def encode_export_rows(filas, columnas: list, formato: str):
+    if formato == "csv":
+        salida = io.StringIO()
+        csv.writer(salida).writerows(filas)
+        return salida.getvalue()
+    return "".join(
+        json.dumps(dict(zip(columnas, fila)), default=lambda valor: valor.isoformat()) + "\n"
+        for fila in filas
+    )
+
+# Respuesta en streaming que recorre la consulta con cursor de servidor y sesión propia
+# (la sesión de la petición se cierra antes de que termine de enviarse la respuesta)
+def stream_export(iterador, columnas: list, formato: str, nombre: str, **filtros):
+    def generar():
+        if formato == "csv":
+            yield encode_export_rows([columnas], columnas, formato)  # Cabecera
+        with SessionLocal() as db:
+            for bloque in iterador(db, **filtros):
+                yield encode_export_rows(bloque, columnas, formato)
+
+    return StreamingResponse(
+        generar(),
+        media_type=EXPORT_FORMATS[formato],
+        headers={"Content-Disposition": f'attachment; filename="{nombre}.{formato}"'},
+    )
+
+# -------------------------
+# Tareas en segundo plano
+# -------------------------
+
+# Comprobar que el esquema está al día (aplicando las migraciones pendientes con DB_AUTO_MIGRATE=1)
+# y abrir las primeras conexiones del pool: con el esquema al día, una sola consulta
+def prepare_database():
+    pendientes = migrations.pending_migrations(engine)
+    if pendientes:
+        if not DB_AUTO_MIGRATE:
+            versiones = ", ".join(str(numero) for numero, _ in pendientes)
+            raise RuntimeError(f"Faltan migraciones de la base de datos ({versiones}): ejecute python manage.py migrate")
+        for numero, nombre in migrations.migrate(engine):
+            print(f"Migración {numero} aplicada: {nombre}")
+    warm_up_pool(engine, DB_POOL_WARMUP)
+
+# Tomar una foto de stock si toca (con sesión propia, fuera de cualquier petición)
+def run_scheduled_snapshot():
+    with SessionLocal() as db:
+        return crud.take_scheduled_snapshot(db, SNAPSHOT_INTERVAL_SECONDS)
+
+# Crear por adelantado las particiones mensuales de movimientos que falten (solo PostgreSQL)
+def run_partition_maintenance():
+    with engine.begin() as conexion:
+        return partitions.ensure_month_partitions(conexion, Movement.__tablename__, "timestamp")
+
+# Borrar los eventos del canal en tiempo real más antiguos que el periodo de retención
+def run_event_pruning():
+    with SessionLocal() as db:
+        return crud.prune_events(db)
+
+# Borrar las claves de idempotencia más antiguas que IDEMPOTENCY_TTL_HOURS
+def run_idempotency_pruning():
+    with SessionLocal() as db:
+        return crud.prune_idempotency_keys(db)
+
+# Lecturas del reparto de eventos, con sesión propia
+def fetch_events(desde_id: int, limite: int):
+    with SessionLocal() as db:
+        return crud.get_events_after(db, desde_id, limite)
+
+def fetch_last_event_id():
+    with SessionLocal() as db:
+        return crud.get_last_event_id(db)
+
+# Bucle de mantenimiento: fotos periódicas, particiones y limpieza de eventos y claves de idempotencia;
+# con varios workers, los advisory locks de PostgreSQL evitan que dos procesos hagan lo mismo a la vez.
+# La primera pasada espera un tiempo aleatorio: los workers que arrancan juntos no coinciden
+async def maintenance_job():
+    await asyncio.sleep(random.uniform(0, SNAPSHOT_CHECK_SECONDS))
+    while True:
+        try:
+            for particion in await run_in_threadpool(run_partition_maintenance):
+                print(f"Partición {particion} creada")
+        except Exception as e:
+            print(f"Error al crear particiones de movimientos: {e}")
+        try:
+            await run_in_threadpool(run_event_pruning)
+        except Exception as e:
+            print(f"Error al limpiar eventos: {e}")
+        try:
+            await run_in_threadpool(run_idempotency_pruning)
+        except Exception as e:
+            print(f"Error al limpiar claves de idempotencia: {e}")
+        if SNAPSHOT_INTERVAL_SECONDS > 0:
+            try:
+                snapshot = await run_in_threadpool(run_scheduled_snapshot)
+                if snapshot is not None:
+                    print(f"Foto de stock {snapshot.id} tomada ({snapshot.item_count} items)")
+            except Exception as e:
+                print(f"Error al tomar la foto de stock: {e}")
+        await asyncio.sleep(SNAPSHOT_CHECK_SECONDS)
+
+def start_background_jobs():
+    app.state.maintenance_task = asyncio.create_task(maintenance_job())
+    app.state.events_task = asyncio.create_task(event_hub.run(fetch_events, fetch_last_event_id))
+    # Con PostgreSQL, los cambios hechos por otros workers llegan al momento por LISTEN/NOTIFY
+    app.state.events_listener = start_listener(EVENTS_LISTEN_URL) if engine.dialect.name == "postgresql" else None
+    if profiler is not None:
+        profiler.start()
+
+def stop_background_jobs():
+    app.state.maintenance_task.cancel()
+    app.state.events_task.cancel()
+    if app.state.events_listener is not None:
+        app.state.events_listener.set()
+    if profiler is not None:
+        profiler.stop()
 
 # -------------------------
 # Manejo global de errores no controlados
@@ -82,7 +418,11 @@ def get_db():
 
 @app.exception_handler(Exception)
 async def generic_exception_handler(request: Request, exc: Exception):
-    # Aquí se puede loguear el error con exc si se desea
+    # El cliente recibe un mensaje genérico; el error completo queda en el log y en /metrics
+    ruta = route_label(request.scope)
+    registry.record_exception(ruta, exc)
+    print(f"Error no controlado en {request.method} {ruta}:")
+    traceback.print_exception(exc)
     return JSONResponse(
         status_code=500,
         content={"detail": "Error interno del servidor."}  # Mensaje genérico para cliente
@@ -93,13 +433,20 @@ async def generic_exception_handler(request: Request, exc: Exception):
 # -------------------------
 
 @app.post("/login")
-def login(
+async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),  # Obtener datos de formulario login
     db: Session = Depends(get_db)
 ):
-    user = crud.get_user_by_username(db, form_data.username)  # Buscar usuario en DB
-    if not user or not user.verify_password(form_data.password):  # Validar password
+    user = await crud_async.get_user_by_username(db, form_data.username)  # Buscar usuario en DB
+    if not user:
+        raise HTTPException(status_code=401, detail="Credenciales incorrectas")
+    # bcrypt se calcula en el pool de procesos dedicado, sin ocupar el event loop ni el threadpool
+    valida, nuevo_hash = await verify_and_update_async(form_data.password, user.hashed_password)
+    if not valida:
         raise HTTPException(status_code=401, detail="Credenciales incorrectas")
+    if nuevo_hash:
+        # El coste de bcrypt configurado ha cambiado: guardar el hash recalculado
+        await crud_async.update_user_password_hash(db, user.id, nuevo_hash)
 
     # Código comentado para resetear base datos solo en testing
     # tablas_vacias = (
@@ -112,76 +459,562 @@ def login(
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)  # Duración token
     token = create_access_token(
-        data={"sub": user.username},  # Campo "sub" con el username
+        data=token_claims(user),  # "sub" con el username y "ver" (versión de la contraseña)
         expires_delta=access_token_expires
     )
     return {"access_token": token, "token_type": "bearer"}  # Devolver token JWT
 
 @app.get("/items", response_model=list[ItemOut])
-def read_items(db: Session = Depends(get_db)):
-    return crud.get_items(db)  # Obtener todos los productos
+async def read_items(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=1000),  # Tamaño de página (sin parámetros: catálogo completo)
+    cursor: Optional[str] = None,  # Valor de X-Next-Cursor de la página anterior
+    sort: Optional[str] = Query(None, pattern="^-?(id|sku|quantity)$"),  # Orden; "-" para descendente
+    q: Optional[str] = Query(None, min_length=1),  # Prefijo de SKU o EAN13
+    contains: Optional[str] = Query(None, min_length=1),  # Texto contenido en el SKU
+    max_quantity: Optional[int] = None,  # Stock bajo: cantidad menor o igual
+    out_of_stock: bool = False,  # Solo productos sin stock
+    db: Session = Depends(get_db)
+):
+    filtros = {"q": q, "contains": contains, "max_quantity": max_quantity, "out_of_stock": out_of_stock}
+    if limit or cursor or sort or q or contains or max_quantity is not None or out_of_stock:
+        orden = sort or "id"
+        cursor_decodificado = None
+        if cursor is not None:
+            cursor_decodificado = crud.decode_item_cursor(cursor, orden)
+            if cursor_decodificado is None:
+                raise HTTPException(status_code=400, detail="Cursor no válido")
+        items, siguiente_cursor = await crud_async.get_items_page(
+            db, limit=limit or 100, orden=orden, cursor=cursor_decodificado, **filtros
+        )
+        cabeceras = {}
+        if siguiente_cursor:
+            cabeceras["X-Next-Cursor"] = siguiente_cursor  # Cursor para pedir la siguiente página
+        if cursor is None:
+            # Total aproximado de resultados, solo en la primera página
+            cabeceras["X-Total-Estimate"] = str(await crud_async.estimate_items_count(db, **filtros))
+        return FastJSONResponse(rows_to_dicts(items, crud.ITEM_FIELDS), headers=cabeceras)
+
+    # La versión se lee antes de consultar: si hay una escritura mientras tanto, el resultado
+    # se guarda bajo la versión antigua y no se sirve a las peticiones siguientes
+    version = item_cache.list_version()
+    entrada = item_cache.get_list(version)
+    if entrada is None:
+        items = await crud_async.get_items(db)  # Obtener todos los productos
+        entrada = item_cache.set_list(version, dumps(rows_to_dicts(items, crud.ITEM_FIELDS)))
+    return cached_json_response(request, *entrada)
+
+@app.get("/items/export")
+def export_items(
+    formato: str = Query("csv", pattern="^(csv|ndjson)$"),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    return stream_export(crud.iter_items, ITEM_COLUMNS, formato, "items")  # Exportar catálogo completo
+
+@app.get("/items/snapshot", response_model=list[StockAtOut])
+async def read_stock_at(
+    at: datetime,  # Fecha a consultar (sin zona: hora de Madrid)
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    await reject_archived_period(db, at)
+    filas, base = await crud_async.get_stock_at(db, at)
+    cabeceras = {}
+    if base is not None:
+        cabeceras["X-Snapshot-At"] = base.taken_at.isoformat()  # Foto usada como punto de partida
+    return FastJSONResponse(rows_to_dicts(filas, STOCK_AT_FIELDS), headers=cabeceras)  # Stock de cada producto en la fecha pedida
+
+# Item serializado (etag, cuerpo) desde la caché, consultándolo por id si falta; None si no existe o está borrado
+async def cached_item_entry(db, item_id: int):
+    version = item_cache.item_version(item_id)
+    entrada = item_cache.get_item(item_id, version)
+    if entrada is None:
+        item = await crud_async.get_item(db, item_id)
+        if item is None:
+            return None
+        entrada = item_cache.set_item(item_id, version, ItemOut.model_validate(item, from_attributes=True).model_dump_json().encode())
+    return entrada
+
+# Resolver un EAN13 o SKU: índice en memoria y caché de items, sin consultas si ambos lo tienen.
+# Una entrada del índice que ya no corresponde al item (cambio hecho en otro worker) se descarta
+async def read_item_by_code(request: Request, db, campo: str, codigo: str):
+    item_id = item_codes.get(campo, codigo)
+    if item_id is not None:
+        entrada = await cached_item_entry(db, item_id)
+        if entrada is not None and json.loads(entrada[1]).get(campo) == codigo:
+            return cached_json_response(request, *entrada)
+        item_codes.discard(item_id, stale=True)
+    item_id = await crud_async.find_item_id_by_code(db, campo, codigo)  # Índices únicos de items
+    entrada = await cached_item_entry(db, item_id) if item_id is not None else None
+    if entrada is None:
+        raise HTTPException(status_code=404, detail="Item no encontrado")
+    return cached_json_response(request, *entrada)
+
+@app.get("/items/by-ean/{ean13}", response_model=ItemOut)
+async def read_item_by_ean(ean13: str, request: Request, db: Session = Depends(get_db)):
+    return await read_item_by_code(request, db, "ean13", ean13)  # Producto de un código de barras
+
+@app.get("/items/by-sku/{sku}", response_model=ItemOut)
+async def read_item_by_sku(sku: str, request: Request, db: Session = Depends(get_db)):
+    return await read_item_by_code(request, db, "sku", sku)
+
+@app.post("/items/resolve", response_model=ItemResolveOut)
+async def resolve_items(codigos: ItemResolveIn, db: Session = Depends(get_db)):
+    if len(codigos.ean13) + len(codigos.sku) > MAX_RESOLVE_CODES:
+        raise HTTPException(status_code=413, detail=f"Máximo {MAX_RESOLVE_CODES} códigos por consulta")
+    por_ean, por_sku = await crud_async.resolve_item_codes(db, codigos.ean13, codigos.sku)  # Una sola consulta
+    return FastJSONResponse({
+        "ean13": {codigo: dict(zip(crud.ITEM_FIELDS, fila)) for codigo, fila in por_ean.items()},
+        "sku": {codigo: dict(zip(crud.ITEM_FIELDS, fila)) for codigo, fila in por_sku.items()},
+        "missing_ean13": [codigo for codigo in dict.fromkeys(codigos.ean13) if codigo not in por_ean],
+        "missing_sku": [codigo for codigo in dict.fromkeys(codigos.sku) if codigo not in por_sku],
+    })
+
+@app.get("/items/{item_id}", response_model=ItemOut)
+async def read_item(item_id: int, request: Request, db: Session = Depends(get_db)):
+    entrada = await cached_item_entry(db, item_id)
+    if entrada is None:
+        raise HTTPException(status_code=404, detail="Item no encontrado")
+    return cached_json_response(request, *entrada)
+
+@app.post("/items/import", response_model=ItemImportOut)
+async def import_items(
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    resumen = {"created": 0, "updated": 0, "unchanged": 0, "rejected": 0, "errors": []}
+
+    def acumular(errores):
+        resumen["rejected"] += len(errores)
+        resumen["errors"].extend(errores[:MAX_IMPORT_ERRORS - len(resumen["errors"])])
+
+    async def procesar(bloque):
+        resultado = await crud_async.import_items_chunk(db, bloque, current_user.username)
+        for clave in ("created", "updated", "unchanged"):
+            resumen[clave] += resultado[clave]
+        acumular(resultado["errors"])
+
+    # Cada bloque es una transacción: memoria acotada aunque el fichero tenga millones de filas
+    bloque = []
+    async for fila in iter_import_rows(request):
+        if "error" in fila:
+            acumular([fila])
+            continue
+        bloque.append(fila)
+        if len(bloque) >= IMPORT_CHUNK_SIZE:
+            await procesar(bloque)
+            bloque = []
+    if bloque:
+        await procesar(bloque)
+    return resumen
 
 @app.post("/items", response_model=ItemOut)
-def create_item(
+async def create_item(
     item: ItemCreate,
+    request: Request,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)  # Requiere autenticación
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
 ):
-    nuevo_item, error = crud.create_item(db, item)
-    if error:
-        raise HTTPException(status_code=400, detail=error)
-    return nuevo_item  # Crear nuevo producto
+    idempotencia = idempotency_request(request, current_user, item.model_dump())
+
+    async def escribir():
+        nuevo_item, error = await crud_async.create_item(db, item, idempotencia=idempotencia)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        return nuevo_item
+
+    return await run_idempotent(request, db, idempotencia, escribir)  # Crear nuevo producto
 
 @app.put("/items/{item_id}", response_model=ItemOut)
-def update_item(
+async def update_item(
     item_id: int,
     item: ItemUpdate,
+    request: Request,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)  # Requiere autenticación
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
 ):
-    updated = crud.update_item_quantity(db, item_id, item, user=current_user.username)
-    if not updated:
-        raise HTTPException(status_code=404, detail="Item not found")
-    return updated  # Actualizar cantidad producto
+    idempotencia = idempotency_request(request, current_user, item.model_dump())
+
+    async def escribir():
+        updated, error = await crud_async.update_item_quantity(
+            db, item_id, item, user=current_user.username, idempotencia=idempotencia
+        )
+        if error == crud.ITEM_NOT_FOUND:
+            raise HTTPException(status_code=404, detail="Item not found")
+        if error:
+            raise HTTPException(status_code=404, detail=error)  # Ubicación no encontrada
+        return updated
+
+    return await run_idempotent(request, db, idempotencia, escribir)  # Actualizar cantidad producto
 
 @app.delete("/items/{item_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_item(
+async def delete_item(
     item_id: int,
+    request: Request,
+    purge: bool = False,  # Borrado físico del producto y de su historial (por defecto, borrado lógico)
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)  # Requiere autenticación
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    idempotencia = idempotency_request(request, current_user, None)
+
+    # Eliminar producto (conservando su historial salvo con purge)
+    async def escribir():
+        try:
+            eliminado = await crud_async.delete_item(db, item_id, purge=purge, idempotencia=idempotencia)
+        except crud.DuplicateRequest:
+            raise
+        except Exception:
+            raise HTTPException(status_code=500, detail="Error al eliminar el item")
+        if not eliminado:
+            raise HTTPException(status_code=404, detail="Item no encontrado")
+        return {"detail": "Item eliminado"}
+
+    return await run_idempotent(request, db, idempotencia, escribir)
+
+@app.get("/items/{item_id}/movements", response_model=list[MovementOut])
+async def read_item_movements(
+    item_id: int,
+    limit: int = Query(100, ge=1, le=1000),  # Tamaño de página
+    cursor: Optional[str] = None,  # Valor de X-Next-Cursor de la página anterior
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    archived: bool = False,  # Incluir los meses archivados en ficheros
+    db: Session = Depends(get_db)
 ):
-    # Eliminar producto y sus movimientos asociados
-    item = db.query(Item).filter(Item.id == item_id).first()
-    if not item:
+    if not await crud_async.item_exists(db, item_id):
         raise HTTPException(status_code=404, detail="Item no encontrado")
-    try:
-        db.query(Movement).filter(Movement.item_id == item_id).delete()
-        db.delete(item)
-        db.commit()
-    except Exception:
-        db.rollback()
-        raise HTTPException(status_code=500, detail="Error al eliminar el item")
-    return {"detail": "Item eliminado"}
+    return await paginate_movements(
+        db, cursor, limit=limit, item_id=item_id, desde=desde, hasta=hasta, archived=archived
+    )  # Historial paginado de un producto
+
+@app.get("/movements/export")
+def export_movements(
+    formato: str = Query("csv", pattern="^(csv|ndjson)$"),
+    item_id: Optional[int] = None,
+    type: Optional[str] = None,
+    username: Optional[str] = None,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    return stream_export(
+        crud.iter_movements, MOVEMENT_COLUMNS, formato, "movements",
+        item_id=item_id, type=type, username=username, desde=desde, hasta=hasta
+    )  # Exportar historial filtrado
 
 @app.get("/movements", response_model=list[MovementOut])
-def read_movements(db: Session = Depends(get_db)):
-    return crud.get_movements(db)  # Obtener historial movimientos
+async def read_movements(
+    limit: int = Query(100, ge=1, le=1000),  # Tamaño de página
+    cursor: Optional[str] = None,  # Valor de X-Next-Cursor de la página anterior
+    item_id: Optional[int] = None,
+    type: Optional[str] = None,
+    username: Optional[str] = None,
+    desde: Optional[datetime] = None,
+    hasta: Optional[datetime] = None,
+    archived: bool = False,  # Incluir los meses archivados en ficheros
+    db: Session = Depends(get_db)
+):
+    return await paginate_movements(
+        db, cursor, limit=limit, item_id=item_id, type=type,
+        username=username, desde=desde, hasta=hasta, archived=archived
+    )  # Obtener historial movimientos paginado
 
 @app.post("/movements", response_model=MovementOut)
-def create_movement(
+async def create_movement(
     movement: MovementCreate,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    idempotencia = idempotency_request(request, current_user, movement.model_dump())
+
+    async def escribir():
+        creado, error = await crud_async.create_movement(db, movement, idempotencia=idempotencia)
+        if error in (crud.ITEM_NOT_FOUND, crud.LOCATION_NOT_FOUND):
+            raise HTTPException(status_code=404, detail=error)
+        if error:
+            raise HTTPException(status_code=400, detail=error)  # Stock insuficiente u origen igual al destino
+        return creado
+
+    return await run_idempotent(request, db, idempotencia, escribir)  # Crear movimiento nuevo
+
+@app.post("/movements/batch", response_model=MovementBatchOut)
+async def create_movements_batch(
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    registros = await read_batch_body(request)  # Array JSON o NDJSON
+    if not registros:
+        raise HTTPException(status_code=400, detail="El lote está vacío")
+    idempotencia = idempotency_request(
+        request, current_user, [r if isinstance(r, str) else r.model_dump() for r in registros]
+    )
+    return await run_idempotent(
+        request, db, idempotencia,
+        lambda: crud_async.create_movements_batch(db, registros, idempotencia=idempotencia),
+    )
+
+@app.get("/locations", response_model=list[LocationOut])
+async def read_locations(db: Session = Depends(get_db)):
+    return await crud_async.get_locations(db)  # Ubicaciones (almacenes)
+
+@app.post("/locations", response_model=LocationOut)
+async def create_location(
+    location: LocationCreate,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    ubicacion, error = await crud_async.create_location(db, location)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    return ubicacion
+
+@app.get("/items/{item_id}/stock", response_model=ItemStockOut)
+async def read_item_stock(item_id: int, db: Session = Depends(get_db)):
+    stock = await crud_async.get_item_stock(db, item_id)
+    if stock is None:
+        raise HTTPException(status_code=404, detail="Item no encontrado")
+    return FastJSONResponse(stock)  # Total y reparto por ubicación
+
+@app.get("/locations/{location_id}/items", response_model=list[LocationItemOut])
+async def read_location_items(
+    location_id: int,
+    limit: int = Query(100, ge=1, le=1000),  # Tamaño de página
+    cursor: Optional[str] = None,  # Valor de X-Next-Cursor de la página anterior
+    db: Session = Depends(get_db)
+):
+    if not await crud_async.location_exists(db, location_id):
+        raise HTTPException(status_code=404, detail=crud.LOCATION_NOT_FOUND)
+    cursor_decodificado = None
+    if cursor is not None:
+        cursor_decodificado = crud.decode_item_cursor(cursor, "id")
+        if cursor_decodificado is None:
+            raise HTTPException(status_code=400, detail="Cursor no válido")
+    filas, siguiente_cursor = await crud_async.get_location_items(
+        db, location_id, limit=limit, cursor=cursor_decodificado
+    )
+    cabeceras = {"X-Next-Cursor": siguiente_cursor} if siguiente_cursor else {}
+    return FastJSONResponse(rows_to_dicts(filas, crud.LOCATION_ITEM_FIELDS), headers=cabeceras)  # Items con stock en la ubicación
+
+@app.put("/items/{item_id}/reorder-point", response_model=ItemOut)
+async def update_reorder_point(
+    item_id: int,
+    datos: ReorderPointUpdate,
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    item = await crud_async.set_reorder_point(db, item_id, datos.reorder_point)
+    if item is None:
+        raise HTTPException(status_code=404, detail=crud.ITEM_NOT_FOUND)
+    return item  # Abre o cierra la alerta según la cantidad actual
+
+@app.get("/alerts", response_model=list[AlertOut])
+async def read_alerts(
+    include_resolved: bool = False,  # Incluir también las alertas cerradas
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    filas = await crud_async.get_alerts(db, include_resolved=include_resolved, limit=limit)
+    return FastJSONResponse(rows_to_dicts(filas, ALERT_FIELDS))  # Las más urgentes primero
+
+@app.post("/alerts/rebuild")
+async def rebuild_alerts(
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)  # Requiere autenticación
+    current_user: Principal = Depends(get_admin_user)  # Solo administradores (ver ADMIN_USERS)
 ):
-    return crud.create_movement(db, movement)  # Crear movimiento nuevo
+    return await crud_async.rebuild_reorder_alerts(db)  # Alertas abiertas y cerradas
+
+@app.get("/snapshots", response_model=list[SnapshotOut])
+async def read_snapshots(
+    limit: int = Query(100, ge=1, le=1000),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    return await crud_async.get_snapshots(db, limit=limit)  # Fotos de stock, de la más reciente a la más antigua
+
+@app.post("/snapshots", response_model=SnapshotOut)
+async def create_snapshot(
+    at: Optional[datetime] = None,  # Fecha de la foto (por defecto, ahora menos el margen de asentamiento)
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    if at is not None and crud.to_local_naive(at) > crud.snapshot_cutoff():
+        # Una foto más reciente no incluiría los movimientos que aún se están confirmando
+        raise HTTPException(
+            status_code=422,
+            detail=f"La fecha de la foto debe ser al menos {crud.SNAPSHOT_SETTLE_SECONDS} segundos anterior a la actual",
+        )
+    return await crud_async.create_snapshot(db, at)  # Tomar una foto de stock bajo demanda
+
+@app.get("/snapshots/check")
+async def check_snapshots(
+    snapshot_id: Optional[int] = None,  # Foto a verificar (por defecto, la más reciente)
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    informe = await crud_async.check_consistency(db, snapshot_id)  # Coherencia del historial y de la foto
+    if informe is None:
+        raise HTTPException(status_code=404, detail="Foto no encontrada")
+    return informe
+
+@app.get("/analytics/throughput", response_model=list[ThroughputOut])
+async def read_throughput(
+    group_by: str = Query("item", pattern="^(item|username)$"),  # Agrupar por producto o por usuario
+    period: str = Query("day", pattern="^(day|week|month)$"),  # Día, semana (desde el lunes) o mes
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    item_id: Optional[int] = None,
+    username: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    return await crud_async.get_throughput(
+        db, agrupar=group_by, periodo=period, desde=desde, hasta=hasta,
+        item_id=item_id, username=username, limit=limit
+    )  # Unidades de entrada, salida y ajuste por periodo
+
+@app.get("/analytics/top-movers", response_model=list[TopMoverOut])
+async def read_top_movers(
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    metric: str = Query("units_out", pattern="^(units_out|units_in|movements)$"),  # Criterio de orden
+    limit: int = Query(20, ge=1, le=1000),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    return await crud_async.get_top_movers(db, desde=desde, hasta=hasta, metrica=metric, limit=limit)
+
+@app.get("/analytics/turnover", response_model=list[TurnoverOut])
+async def read_turnover(
+    desde: date,
+    hasta: date,
+    limit: int = Query(100, ge=1, le=10000),
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
+):
+    if hasta < desde:
+        raise HTTPException(status_code=400, detail="La fecha 'hasta' es anterior a 'desde'")
+    await reject_archived_period(db, datetime.combine(desde, datetime.min.time()))
+    return await crud_async.get_turnover(db, desde, hasta, limit=limit)  # Salidas / stock medio por producto
+
+@app.post("/analytics/rebuild")
+async def rebuild_analytics(
+    db: Session = Depends(get_db),
+    current_user: Principal = Depends(get_admin_user)  # Solo administradores (ver ADMIN_USERS)
+):
+    filas = await crud_async.rebuild_movement_stats(db)  # Recalcular totales diarios desde el historial
+    return {"rows": filas}
+
+@app.get("/events")
+async def stream_events(
+    request: Request,
+    last_event_id: Optional[int] = Query(None, ge=0),  # Alternativa a la cabecera Last-Event-ID
+):
+    # Server-Sent Events: el navegador reconecta solo y envía Last-Event-ID con el último evento recibido
+    ultimo_id = last_event_id if last_event_id is not None else parse_event_id(request.headers.get("last-event-id"))
+    suscriptor = event_hub.subscribe()  # Antes de leer lo pendiente, para no perder eventos entre medias
+    if suscriptor is None:
+        raise HTTPException(status_code=503, detail="Demasiados clientes conectados")
+    try:
+        pendientes = await events_to_resume(ultimo_id)
+    except Exception:
+        event_hub.unsubscribe(suscriptor)
+        raise
+
+    async def generar():
+        try:
+            yield f"retry: {EVENTS_RETRY_MS}\n\n"
+            for evento in pendientes:
+                yield evento.sse
+            desde = pendientes[-1].id if pendientes else (ultimo_id or 0)
+            async for evento in event_hub.listen(suscriptor, desde):
+                yield evento.sse if evento is not None else ": ping\n\n"  # Comentario SSE como latido
+            # Cliente demasiado lento: se cierra la conexión y reanuda desde su último evento
+        finally:
+            event_hub.unsubscribe(suscriptor)
+
+    return StreamingResponse(
+        generar(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # Sin buffer en proxys
+    )
+
+@app.websocket("/ws/events")
+async def websocket_events(websocket: WebSocket, last_event_id: Optional[int] = None):
+    # Mismos eventos que /events, como mensajes JSON {"id", "event", "data"}
+    suscriptor = event_hub.subscribe()
+    if suscriptor is None:
+        await websocket.close(code=1013)  # Try again later
+        return
+    try:
+        await websocket.accept()
+        pendientes = await events_to_resume(last_event_id)
+        for evento in pendientes:
+            await websocket.send_text(evento.json)
+        desde = pendientes[-1].id if pendientes else (last_event_id or 0)
+        async for evento in event_hub.listen(suscriptor, desde):
+            await websocket.send_text(evento.json if evento is not None else '{"event": "ping"}')
+        await websocket.close(code=1013)  # Cliente demasiado lento: debe reconectar con last_event_id
+    except WebSocketDisconnect:
+        pass
+    finally:
+        event_hub.unsubscribe(suscriptor)
+
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(require_metrics_access)])
+def read_metrics():
+    # Formato de exposición de Prometheus; con varios workers, cada proceso publica sus propias métricas
+    lineas = registry.render()
+    for nombre, pool in get_pool_metrics().items():
+        lineas += render_gauges("pool", pool, {"pool": nombre})
+    lineas += render_gauges("cache", item_cache.stats())
+    lineas += render_gauges("item_codes", item_codes.stats())
+    lineas += render_gauges("auth_cache", principal_cache.stats())
+    lineas += render_gauges("hashing", get_hashing_metrics())
+    lineas += render_gauges("events", event_hub.stats())
+    return PlainTextResponse("\n".join(lineas) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics/pool", dependencies=[Depends(require_metrics_access)])
+def read_pool_metrics():
+    return get_pool_metrics()  # Conexiones en uso, desbordamiento y tiempos de espera del pool
+
+@app.get("/metrics/auth", dependencies=[Depends(require_metrics_access)])
+def read_auth_metrics():
+    return principal_cache.stats()  # Aciertos y fallos de la caché de usuarios autenticados
+
+@app.get("/metrics/cache", dependencies=[Depends(require_metrics_access)])
+def read_cache_metrics():
+    return item_cache.stats()  # Aciertos, fallos, respuestas 304 e invalidaciones de la caché de items
+
+@app.get("/metrics/item-codes", dependencies=[Depends(require_metrics_access)])
+def read_item_code_metrics():
+    return item_codes.stats()  # Aciertos, fallos y entradas obsoletas del índice de códigos de barras
+
+@app.get("/metrics/events", dependencies=[Depends(require_metrics_access)])
+def read_event_metrics():
+    return event_hub.stats()  # Clientes conectados, eventos repartidos y clientes desconectados por lentos
+
+@app.get("/metrics/hashing", dependencies=[Depends(require_metrics_access)])
+def read_hashing_metrics():
+    return get_hashing_metrics()  # Operaciones bcrypt y tiempo de espera en cola
 
 @app.post("/change-password")
-def change_password(
+async def change_password(
     datos: ChangePassword,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)  # Requiere autenticación
+    current_user: Principal = Depends(get_current_user)  # Requiere autenticación
 ):
-    success, message = crud.change_user_password(db, current_user, datos.old_password, datos.new_password)
-    if not success:
-        raise HTTPException(status_code=400, detail=message)
-    return {"detail": message}  # Cambiar contraseña de usuario
+    user = await crud_async.get_user_by_username(db, current_user.username)
+    if user is None:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    # Como en /login: bcrypt en el pool de procesos, sin bloquear el event loop
+    valida, _ = await verify_and_update_async(datos.old_password, user.hashed_password)
+    if not valida:
+        raise HTTPException(status_code=400, detail="Contraseña actual incorrecta")
+    nuevo_hash = await hash_password_async(datos.new_password)
+    await crud_async.change_user_password(db, user.id, nuevo_hash)
+    principal_cache.invalidate(current_user.username)  # Los tokens anteriores dejan de ser válidos
+    return {"detail": "Contraseña actualizada correctamente"}  # Cambiar contraseña de usuario
@@ -0,0 +1,78 @@
+import argparse
+
+from sqlalchemy import select
+
+import migrations
+from database import SessionLocal, engine
+from models import Item, Movement, User
+
+# Tareas de administración de la base de datos
+# Uso: python manage.py migrate          (aplica las migraciones pendientes)
+#      python manage.py status           (muestra la versión del esquema)
+#      python manage.py seed             (crea los usuarios e items iniciales en una base de datos vacía)
+#      python manage.py seed --reset     (borra todos los datos y vuelve a crear los iniciales)
+#      python manage.py rebuild-stats    (recalcula los totales diarios de movimientos desde el historial)
+#      python manage.py rebuild-alerts   (recalcula las alertas de stock bajo el punto de pedido)
+
+def migrate():
+    aplicadas = migrations.migrate(engine)
+    for numero, nombre in aplicadas:
+        print(f"Migración {numero} aplicada: {nombre}")
+    if not aplicadas:
+        print(f"El esquema ya está al día (versión {migrations.LATEST_VERSION})")
+
+def status():
+    pendientes = migrations.pending_migrations(engine)
+    print(f"Versión del esquema: {migrations.LATEST_VERSION - len(pendientes)} de {migrations.LATEST_VERSION}")
+    for numero, nombre in pendientes:
+        print(f"  Pendiente {numero}: {nombre}")
+
+def seed(reset: bool):
+    import crud  # bcrypt y el resto de la aplicación solo hacen falta aquí
+
+    if migrations.pending_migrations(engine):
+        raise SystemExit("El esquema no está al día: ejecute antes python manage.py migrate")
+    with SessionLocal() as db:
+        tiene_datos = any(db.scalar(select(modelo.id).limit(1)) is not None for modelo in (Item, Movement, User))
+        if tiene_datos and not reset:
+            raise SystemExit("La base de datos ya tiene datos; use --reset para borrarlos y crear los iniciales")
+        crud.reset_database(db)
+
+def rebuild_stats():
+    import crud
+
+    with SessionLocal() as db:
+        filas = crud.rebuild_movement_stats(db)
+    print(f"Totales diarios recalculados: {filas} filas")
+
+def rebuild_alerts():
+    import crud
+
+    with SessionLocal() as db:
+        resultado = crud.rebuild_reorder_alerts(db)
+    print(f"Alertas abiertas: {resultado['opened']}, resueltas: {resultado['resolved']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Administración de la base de datos del inventario")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+    comandos.add_parser("migrate", help="Aplicar las migraciones pendientes")
+    comandos.add_parser("status", help="Mostrar la versión del esquema y las migraciones pendientes")
+    semilla = comandos.add_parser("seed", help="Crear los usuarios e items iniciales")
+    semilla.add_argument("--reset", action="store_true", help="Borrar antes todos los datos existentes")
+    comandos.add_parser("rebuild-stats", help="Recalcular los totales diarios de movimientos")
+    comandos.add_parser("rebuild-alerts", help="Recalcular las alertas de stock bajo mínimos")
+    args = parser.parse_args()
+
+    if args.comando == "migrate":
+        migrate()
+    elif args.comando == "status":
+        status()
+    elif args.comando == "rebuild-stats":
+        rebuild_stats()
+    elif args.comando == "rebuild-alerts":
+        rebuild_alerts()
+    else:
+        seed(args.reset)
+
+if __name__ == "__main__":
+    main()
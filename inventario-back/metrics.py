@@ -0,0 +1,250 @@
+import contextvars
+import os
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import event
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))  # Consultas más lentas se registran (0 = desactivado)
+# Veces que se repite la misma sentencia en una petición a partir de las cuales se avisa de un posible N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+SLOW_QUERY_MAX_CHARS = 1000  # Longitud máxima de la sentencia en el registro de consultas lentas
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Segundos
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)  # Consultas por petición
+
+# -------------------------
+# Estadísticas de la petición en curso
+# -------------------------
+
+# Consultas hechas durante una petición; se comparte por referencia con el threadpool y con run_sync
+class RequestStats:
+    __slots__ = ("queries", "db_seconds", "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.statements = Counter()  # Veces que se ejecuta cada sentencia (mismo SQL, otros parámetros)
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+# -------------------------
+# Registro de métricas (formato de exposición de Prometheus)
+# -------------------------
+
+def _escape(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(nombres: tuple, valores: tuple, extra: str = "") -> str:
+    partes = [f'{nombre}="{_escape(valor)}"' for nombre, valor in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+# Histograma por combinación de etiquetas: cuenta por cubo, suma y total de observaciones
+class Histogram:
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple, buckets: tuple):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, valores: tuple, valor: float):
+        serie = self.series.get(valores)
+        if serie is None:
+            serie = self.series[valores] = [0] * len(self.buckets) + [0.0, 0]
+        for indice, limite in enumerate(self.buckets):
+            if valor <= limite:
+                serie[indice] += 1
+        serie[-2] += valor
+        serie[-1] += 1
+
+    def render(self) -> list:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        for valores, serie in sorted(self.series.items()):
+            for indice, limite in enumerate(self.buckets + ("+Inf",)):
+                etiquetas = _labels(self.etiquetas, valores, 'le="%s"' % limite)
+                acumulado = serie[indice] if indice < len(self.buckets) else serie[-1]
+                lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+            lineas.append(f"{self.nombre}_sum{_labels(self.etiquetas, valores)} {serie[-2]}")
+            lineas.append(f"{self.nombre}_count{_labels(self.etiquetas, valores)} {serie[-1]}")
+        return lineas
+
+# Contador por combinación de etiquetas
+class LabeledCounter:
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self.series = Counter()
+
+    def inc(self, valores: tuple = (), cantidad: float = 1):
+        self.series[valores] += cantidad
+
+    def render(self) -> list:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        for valores, valor in sorted(self.series.items()):
+            lineas.append(f"{self.nombre}{_labels(self.etiquetas, valores)} {valor}")
+        return lineas
+
+# Métricas del proceso (cada worker de uvicorn tiene las suyas)
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        ruta = ("method", "route")
+        self.requests = LabeledCounter("inventario_http_requests_total", "Peticiones HTTP atendidas", ("method", "route", "status"))
+        self.latency = Histogram("inventario_http_request_duration_seconds", "Duración de las peticiones HTTP", ruta, LATENCY_BUCKETS)
+        self.request_queries = Histogram("inventario_http_request_db_queries", "Consultas a la base de datos por petición", ruta, QUERY_COUNT_BUCKETS)
+        self.request_db_time = Histogram("inventario_http_request_db_seconds", "Tiempo en la base de datos por petición", ruta, LATENCY_BUCKETS)
+        self.exceptions = LabeledCounter("inventario_http_exceptions_total", "Excepciones no controladas", ("route", "exception"))
+        self.n_plus_one = LabeledCounter("inventario_db_n_plus_one_total", "Peticiones con una misma sentencia repetida muchas veces", ("route",))
+        self.queries = Histogram("inventario_db_query_duration_seconds", "Duración de las consultas a la base de datos", (), LATENCY_BUCKETS)
+        self.slow_queries = LabeledCounter("inventario_db_slow_queries_total", "Consultas más lentas que SLOW_QUERY_MS")
+        self.idempotent_replays = LabeledCounter(
+            "inventario_idempotent_replays_total", "Escrituras repetidas con una Idempotency-Key ya usada", ("route", "result")
+        )
+        self.in_progress = 0
+
+    def request_started(self):
+        with self.lock:
+            self.in_progress += 1
+
+    def request_finished(self, metodo: str, ruta: str, estado: int, duracion: float, stats: RequestStats):
+        with self.lock:
+            self.in_progress -= 1
+            self.requests.inc((metodo, ruta, str(estado)))
+            self.latency.observe((metodo, ruta), duracion)
+            self.request_queries.observe((metodo, ruta), stats.queries)
+            self.request_db_time.observe((metodo, ruta), stats.db_seconds)
+
+    def record_query(self, duracion: float, lenta: bool):
+        with self.lock:
+            self.queries.observe((), duracion)
+            if lenta:
+                self.slow_queries.inc()
+
+    def record_exception(self, ruta: str, excepcion: BaseException):
+        with self.lock:
+            self.exceptions.inc((ruta, type(excepcion).__name__))
+
+    def record_n_plus_one(self, ruta: str):
+        with self.lock:
+            self.n_plus_one.inc((ruta,))
+
+    def record_idempotent_replay(self, ruta: str, resultado: str):
+        with self.lock:
+            self.idempotent_replays.inc((ruta, resultado))
+
+    def render(self) -> list:
+        with self.lock:
+            lineas = [
+                "# HELP inventario_http_requests_in_progress Peticiones HTTP en curso",
+                "# TYPE inventario_http_requests_in_progress gauge",
+                f"inventario_http_requests_in_progress {self.in_progress}",
+            ]
+            for metrica in (self.requests, self.latency, self.request_queries, self.request_db_time,
+                            self.exceptions, self.n_plus_one, self.queries, self.slow_queries, self.idempotent_replays):
+                lineas += metrica.render()
+            return lineas
+
+registry = MetricsRegistry()
+
+# Valores numéricos de un dict de estadísticas (como los de /metrics/pool o /metrics/cache) como gauges
+def render_gauges(prefijo: str, valores: dict, etiquetas: dict = None) -> list:
+    lineas = []
+    texto_etiquetas = _labels(tuple(etiquetas or {}), tuple((etiquetas or {}).values()))
+    for clave, valor in valores.items():
+        if isinstance(valor, bool):
+            valor = int(valor)
+        if isinstance(valor, (int, float)):
+            lineas.append(f"inventario_{prefijo}_{clave}{texto_etiquetas} {valor}")
+    return lineas
+
+# -------------------------
+# Consultas a la base de datos
+# -------------------------
+
+# Medir cada consulta de un motor: total por petición, histograma global y registro de consultas lentas
+# (solo la sentencia y el número de parámetros: los valores pueden contener datos personales)
+def instrument_engine(motor):
+    @event.listens_for(motor, "before_cursor_execute")
+    def antes_de_consulta(conexion, cursor, sentencia, parametros, contexto, executemany):
+        conexion.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(motor, "after_cursor_execute")
+    def despues_de_consulta(conexion, cursor, sentencia, parametros, contexto, executemany):
+        duracion = time.perf_counter() - conexion.info["query_start"].pop()
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += duracion
+            if not executemany:
+                stats.statements[sentencia] += 1
+        lenta = SLOW_QUERY_MS > 0 and duracion * 1000 >= SLOW_QUERY_MS
+        registry.record_query(duracion, lenta)
+        if lenta:
+            numero = len(parametros) if isinstance(parametros, (list, tuple, dict)) else 0
+            texto = " ".join(sentencia.split())[:SLOW_QUERY_MAX_CHARS]
+            print(f"Consulta lenta ({duracion * 1000:.0f} ms, {numero} parámetros ocultos): {texto}")
+
+    @event.listens_for(motor, "handle_error")
+    def error_de_consulta(contexto):
+        if contexto.connection is not None and contexto.connection.info.get("query_start"):
+            contexto.connection.info["query_start"].pop()  # La consulta falló: no habrá after_cursor_execute
+
+# Sentencias de una petición repetidas al menos N_PLUS_ONE_THRESHOLD veces
+def repeated_statements(stats: RequestStats) -> list:
+    return [(sentencia, veces) for sentencia, veces in stats.statements.items() if veces >= N_PLUS_ONE_THRESHOLD]
+
+# -------------------------
+# Middleware
+# -------------------------
+
+# Ruta de la petición como plantilla (/items/{item_id}), para no crear una serie por cada id
+def route_label(scope) -> str:
+    ruta = scope.get("route")
+    return getattr(ruta, "path", None) or "<sin ruta>"
+
+# Middleware ASGI (sin BaseHTTPMiddleware: no altera las respuestas en streaming como /events).
+# Añade a cada respuesta X-DB-Queries y Server-Timing con las consultas hechas hasta enviar las cabeceras
+class RequestMetricsMiddleware:
+    def __init__(self, app, profiler=None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        estado = 500  # Si la aplicación lanza una excepción no llega a enviar cabeceras
+        inicio = time.perf_counter()
+        registry.request_started()
+
+        async def enviar(mensaje):
+            nonlocal estado
+            if mensaje["type"] == "http.response.start":
+                estado = mensaje["status"]
+                cabeceras = list(mensaje.get("headers", []))
+                cabeceras.append((b"x-db-queries", str(stats.queries).encode()))
+                cabeceras.append((b"server-timing", f"db;dur={stats.db_seconds * 1000:.1f}".encode()))
+                mensaje = {**mensaje, "headers": cabeceras}
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            current_request.reset(token)
+            fin = time.perf_counter()
+            ruta = route_label(scope)
+            registry.request_finished(scope["method"], ruta, estado, fin - inicio, stats)
+            repetidas = repeated_statements(stats)
+            if repetidas:
+                registry.record_n_plus_one(ruta)
+                sentencia, veces = max(repetidas, key=lambda repetida: repetida[1])
+                print(f"Posible N+1 en {scope['method']} {ruta}: sentencia repetida {veces} veces: {' '.join(sentencia.split())[:200]}")
+            if self.profiler is not None:
+                self.profiler.request_finished(inicio, fin, scope["method"], ruta)
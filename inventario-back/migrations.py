@@ -0,0 +1,187 @@
+from datetime import datetime
+
+from sqlalchemy import func, insert, inspect, literal, select, text
+from sqlalchemy.orm import Session
+
+import partitions
+from models import (
+    DEFAULT_LOCATION_ID, ITEMS_TRGM_INDEX, Base, IdempotencyKey, Item, ItemStock, Location, Movement,
+    MovementDailyStat, SchemaVersion, StockAlert, User,
+)
+
+MIGRATION_LOCK_ID = 7313  # Clave del advisory lock que evita migrar desde dos procesos a la vez
+
+# -------------------------
+# Migraciones
+# -------------------------
+
+# Cada migración es idempotente: se puede aplicar sobre una base de datos nueva, sobre una creada con
+# create_all por versiones anteriores de la aplicación o sobre el esquema original (sin versión)
+
+# Tablas que aún no existen (en una base de datos vacía, el esquema completo)
+def create_missing_tables(conexion):
+    Base.metadata.create_all(bind=conexion, checkfirst=True)
+
+# Columna de borrado lógico de items
+def add_item_deleted_at(conexion):
+    columnas = {columna["name"] for columna in inspect(conexion).get_columns("items")}
+    if "deleted_at" not in columnas:
+        conexion.execute(text("ALTER TABLE items ADD COLUMN deleted_at TIMESTAMP"))
+
+# Convertir movements en tabla particionada por mes (solo PostgreSQL), copiando el historial existente
+def partition_movements(conexion):
+    tabla = Movement.__tablename__
+    if conexion.dialect.name != "postgresql" or partitions.is_partitioned(conexion, tabla):
+        return
+    antigua = f"{tabla}_unpartitioned"
+    conexion.execute(text(f"ALTER TABLE {tabla} RENAME TO {antigua}"))
+    # Los nombres de índices y secuencias son globales: se liberan para la tabla nueva
+    for (restriccion,) in conexion.execute(text(
+        "SELECT conname FROM pg_constraint WHERE conrelid = CAST(:tabla AS regclass) AND contype IN ('p', 'u')"
+    ), {"tabla": antigua}):
+        conexion.execute(text(f'ALTER TABLE {antigua} DROP CONSTRAINT "{restriccion}"'))
+    for (indice,) in conexion.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE tablename = :tabla AND schemaname = current_schema()"
+    ), {"tabla": antigua}):
+        conexion.execute(text(f'DROP INDEX "{indice}"'))
+    conexion.execute(text(f"ALTER SEQUENCE IF EXISTS {tabla}_id_seq RENAME TO {antigua}_id_seq"))
+
+    Movement.__table__.create(bind=conexion)  # Con la partición por defecto y las de los próximos meses
+    primero, ultimo = conexion.execute(text(f"SELECT min(timestamp), max(timestamp) FROM {antigua}")).one()
+    if primero is not None:
+        mes = partitions.month_start(primero)
+        while mes <= partitions.month_start(ultimo):
+            partitions.create_month_partition(conexion, tabla, "timestamp", mes)
+            mes = partitions.add_months(mes, 1)
+    # Solo las columnas que ya tenía la tabla: las posteriores las añaden sus migraciones
+    existentes = {columna["name"] for columna in inspect(conexion).get_columns(antigua)}
+    columnas = ", ".join(columna.name for columna in Movement.__table__.columns if columna.name in existentes)
+    conexion.execute(text(f"INSERT INTO {tabla} ({columnas}) SELECT {columnas} FROM {antigua}"))
+    conexion.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{tabla}', 'id'), COALESCE(max(id), 0) + 1, false) FROM {tabla}"
+    ))
+    conexion.execute(text(f"DROP TABLE {antigua}"))
+
+# Índices definidos en los modelos que falten, sustituyendo la unicidad global de SKU y EAN13
+# del esquema original por la unicidad entre items no borrados
+def create_missing_indexes(conexion):
+    for indice in ("ix_items_sku", "ix_items_ean13"):
+        conexion.execute(text(f"DROP INDEX IF EXISTS {indice}"))
+    for tabla in Base.metadata.sorted_tables:
+        for indice in tabla.indexes:
+            indice.create(bind=conexion, checkfirst=True)
+    if conexion.dialect.name == "postgresql":
+        conexion.execute(ITEMS_TRGM_INDEX)
+
+# Totales diarios de los movimientos anteriores a la tabla movement_daily_stats
+def fill_daily_stats(conexion):
+    hay_totales = conexion.scalar(select(func.count()).select_from(select(MovementDailyStat.day).limit(1).subquery()))
+    hay_movimientos = conexion.scalar(select(func.count()).select_from(select(Movement.id).limit(1).subquery()))
+    if hay_totales or not hay_movimientos:
+        return
+    import crud  # Solo al migrar: crud carga el resto de la aplicación
+
+    # El commit de rebuild_movement_stats libera un savepoint: la migración sigue siendo una transacción
+    with Session(bind=conexion, join_transaction_mode="create_savepoint") as db:
+        crud.rebuild_movement_stats(db)
+
+# Tabla de claves de idempotencia de las escrituras
+def create_idempotency_keys(conexion):
+    IdempotencyKey.__table__.create(bind=conexion, checkfirst=True)
+
+# Stock por ubicación: tablas de ubicaciones y de stock por item, columnas de ubicación en los movimientos
+# (los anteriores quedan sin ubicación: la principal) y el stock actual de cada item en la ubicación principal
+def add_locations(conexion):
+    Location.__table__.create(bind=conexion, checkfirst=True)
+    ItemStock.__table__.create(bind=conexion, checkfirst=True)
+    columnas = {columna["name"] for columna in inspect(conexion).get_columns(Movement.__tablename__)}
+    for columna in ("location_id", "to_location_id"):
+        if columna not in columnas:
+            conexion.execute(text(f"ALTER TABLE {Movement.__tablename__} ADD COLUMN {columna} INTEGER"))
+
+    if conexion.scalar(select(Location.id).where(Location.id == DEFAULT_LOCATION_ID)) is None:
+        conexion.execute(insert(Location).values(id=DEFAULT_LOCATION_ID, code="PRINCIPAL", name="Almacén principal"))
+        if conexion.dialect.name == "postgresql":
+            conexion.execute(text("SELECT setval(pg_get_serial_sequence('locations', 'id'), max(id)) FROM locations"))
+    if conexion.scalar(select(ItemStock.item_id).limit(1)) is None:
+        conexion.execute(insert(ItemStock).from_select(
+            ["item_id", "location_id", "quantity"],
+            select(Item.id, literal(DEFAULT_LOCATION_ID), Item.quantity).where(Item.quantity != 0),
+        ))
+
+# Alertas de reposición: punto de pedido de los items (0: avisar al agotarse) y tabla de alertas,
+# con las alertas abiertas de los items que ya están en su punto de pedido o por debajo
+def add_reorder_alerts(conexion):
+    columnas = {columna["name"] for columna in inspect(conexion).get_columns(Item.__tablename__)}
+    if "reorder_point" not in columnas:
+        conexion.execute(text(f"ALTER TABLE {Item.__tablename__} ADD COLUMN reorder_point INTEGER DEFAULT 0"))
+    StockAlert.__table__.create(bind=conexion, checkfirst=True)
+    if conexion.scalar(select(StockAlert.id).limit(1)) is not None:
+        return
+    import crud  # Solo al migrar: crud carga el resto de la aplicación
+
+    with Session(bind=conexion, join_transaction_mode="create_savepoint") as db:
+        crud.rebuild_reorder_alerts(db)
+
+# Versión de la contraseña de los usuarios (claim "ver" de los tokens), independiente del hash
+def add_user_password_version(conexion):
+    columnas = {columna["name"] for columna in inspect(conexion).get_columns(User.__tablename__)}
+    if "password_version" not in columnas:
+        conexion.execute(text(
+            f"ALTER TABLE {User.__tablename__} ADD COLUMN password_version INTEGER NOT NULL DEFAULT 0"
+        ))
+
+# Lista ordenada de migraciones: (versión, descripción, función). Las nuevas se añaden al final
+MIGRATIONS = [
+    (1, "Tablas nuevas", create_missing_tables),
+    (2, "Borrado lógico de items", add_item_deleted_at),
+    (3, "Movimientos particionados por mes", partition_movements),
+    (4, "Índices del catálogo y del historial", create_missing_indexes),
+    (5, "Totales diarios de movimientos", fill_daily_stats),
+    (6, "Claves de idempotencia", create_idempotency_keys),
+    (7, "Stock por ubicación", add_locations),
+    (8, "Alertas de reposición", add_reorder_alerts),
+    (9, "Versión de contraseña de los usuarios", add_user_password_version),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# -------------------------
+# Aplicación de migraciones
+# -------------------------
+
+# Última migración aplicada (0 si la base de datos no tiene tabla de versiones)
+def current_version(conexion) -> int:
+    if not inspect(conexion).has_table(SchemaVersion.__tablename__):
+        return 0
+    return conexion.scalar(select(func.max(SchemaVersion.version))) or 0
+
+# Migraciones pendientes, como (versión, descripción)
+def pending_migrations(motor) -> list:
+    with motor.connect() as conexion:
+        version = current_version(conexion)
+    return [(numero, nombre) for numero, nombre, _ in MIGRATIONS if numero > version]
+
+# Aplicar las migraciones pendientes, cada una en su transacción; devuelve las aplicadas
+# Con PostgreSQL, el resto de procesos que migran a la vez esperan al lock y no encuentran nada pendiente
+def migrate(motor) -> list:
+    aplicadas = []
+    with motor.connect() as bloqueo:
+        if motor.dialect.name == "postgresql":
+            bloqueo.execute(text("SELECT pg_advisory_lock(:clave)"), {"clave": MIGRATION_LOCK_ID})
+            bloqueo.commit()
+        try:
+            for numero, nombre, migracion in MIGRATIONS:
+                with motor.begin() as conexion:
+                    if numero <= current_version(conexion):
+                        continue
+                    migracion(conexion)
+                    SchemaVersion.__table__.create(bind=conexion, checkfirst=True)
+                    conexion.execute(SchemaVersion.__table__.insert().values(
+                        version=numero, name=nombre, applied_at=datetime.utcnow()
+                    ))
+                aplicadas.append((numero, nombre))
+        finally:
+            if motor.dialect.name == "postgresql":
+                bloqueo.execute(text("SELECT pg_advisory_unlock(:clave)"), {"clave": MIGRATION_LOCK_ID})
+                bloqueo.commit()
+    return aplicadas
@@ -1,23 +1,58 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Integer
+from sqlalchemy import DDL, Column, Date, Integer, String, ForeignKey, DateTime, Index, Integer, Text, event, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
 from schemas import ItemOut
 
-from security import pwd_context
+from security import verify_password
+import partitions
 
 # Modelo para la tabla "items"
 class Item(Base):
     __tablename__ = "items"  # Nombre tabla en la base de datos
 
     id = Column(Integer, primary_key=True, index=True)  # PK autoincremental
-    sku = Column(String, unique=True, index=True, nullable=False)  # SKU único obligatorio
-    ean13 = Column(String, unique=True, index=True, nullable=False)  # EAN13 único obligatorio
-    quantity = Column(Integer, default=0)  # Cantidad disponible, valor por defecto 0
+    sku = Column(String, nullable=False)  # SKU obligatorio, único entre los items no borrados
+    ean13 = Column(String, nullable=False)  # EAN13 obligatorio, único entre los items no borrados
+    quantity = Column(Integer, default=0)  # Cantidad disponible en total (suma de todas las ubicaciones)
+    deleted_at = Column(DateTime, nullable=True)  # Fecha de borrado lógico (None si está activo)
+    # Punto de pedido: alerta de reposición con la cantidad en o por debajo (None: sin alertas)
+    reorder_point = Column(Integer, nullable=True, default=0, server_default="0")
 
     movements = relationship("Movement", back_populates="item")  
     # Relación uno a muchos con movimientos (movements)
 
+    # Índices del catálogo paginado y con búsqueda
+    __table_args__ = (
+        # Unicidad parcial: un SKU o EAN13 de un item borrado puede volver a usarse
+        Index(
+            "uq_items_sku_active", "sku", unique=True,
+            postgresql_where=text("deleted_at IS NULL"), sqlite_where=text("deleted_at IS NULL"),
+        ),
+        Index(
+            "uq_items_ean13_active", "ean13", unique=True,
+            postgresql_where=text("deleted_at IS NULL"), sqlite_where=text("deleted_at IS NULL"),
+        ),
+        Index("ix_items_quantity_id", "quantity", "id"),  # Orden por cantidad y filtros de stock bajo
+        # Búsqueda por prefijo (LIKE 'abc%') con independencia de la collation de la base de datos
+        Index("ix_items_sku_pattern", "sku", postgresql_ops={"sku": "varchar_pattern_ops"}).ddl_if(dialect="postgresql"),
+        Index("ix_items_ean13_pattern", "ean13", postgresql_ops={"ean13": "varchar_pattern_ops"}).ddl_if(dialect="postgresql"),
+    )
+
+# Búsqueda de texto en cualquier posición del SKU (ILIKE '%abc%') con un índice de trigramas (solo PostgreSQL)
+# Si la extensión pg_trgm no está instalada o no hay permisos, la tabla se crea igualmente sin este índice
+ITEMS_TRGM_INDEX = DDL("""
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS ix_items_sku_trgm ON items USING gin (sku gin_trgm_ops);
+EXCEPTION WHEN undefined_file OR feature_not_supported OR insufficient_privilege THEN
+    RAISE NOTICE 'pg_trgm no disponible: la búsqueda por texto en el SKU no usará índice';
+END
+$$
+""")
+event.listen(Item.__table__, "after_create", ITEMS_TRGM_INDEX.execute_if(dialect="postgresql"))
+
 # Modelo para la tabla "movements" (movimientos/entradas/salidas de inventario)
 class Movement(Base):
     __tablename__ = 'movements'  # Nombre tabla movimientos
@@ -30,10 +65,154 @@ class Movement(Base):
     username = Column(String, nullable=True)  # Usuario que realizó el movimiento (puede ser nulo)
     quantity_before = Column(Integer)  # Cantidad antes del movimiento
     quantity_after = Column(Integer)   # Cantidad después del movimiento
+    # Ubicación del movimiento (origen en un traspaso); None en los anteriores a las ubicaciones: la principal
+    location_id = Column(Integer, nullable=True)
+    to_location_id = Column(Integer, nullable=True)  # Ubicación de destino de un traspaso
 
     item = relationship("Item", back_populates="movements")  
     # Relación inversa con item
 
+    # Índices compuestos para paginación keyset por (timestamp, id): cada página es un rango del índice
+    # El filtro por tipo (pocos valores distintos) se aplica recorriendo el índice global
+    # En PostgreSQL la tabla se particiona por mes de timestamp; la clave primaria pasa a ser (id, timestamp)
+    __table_args__ = (
+        Index("ix_movements_timestamp_id", "timestamp", "id"),  # Historial global
+        Index("ix_movements_item_id_timestamp_id", "item_id", "timestamp", "id"),  # Historial por producto
+        Index("ix_movements_username_timestamp_id", "username", "timestamp", "id"),  # Historial por usuario
+        {"postgresql_partition_by": "RANGE (timestamp)", "info": {"partition_key": "timestamp"}},
+    )
+
+# Crear la partición por defecto y las mensuales al crear la tabla (solo PostgreSQL)
+def create_movement_partitions(tabla, conexion, **kw):
+    if conexion.dialect.name == "postgresql":
+        partitions.create_default_partition(conexion, tabla.name)
+        partitions.ensure_month_partitions(conexion, tabla.name, "timestamp")
+
+event.listen(Movement.__table__, "after_create", create_movement_partitions)
+
+DEFAULT_LOCATION_ID = 1  # Ubicación principal, creada por la migración 7 con el stock que ya existía
+
+# Modelo para la tabla "locations" (almacenes o zonas con stock propio)
+class Location(Base):
+    __tablename__ = "locations"
+
+    id = Column(Integer, primary_key=True, index=True)  # PK autoincremental
+    code = Column(String, unique=True, nullable=False)  # Código corto de la ubicación
+    name = Column(String, nullable=False)  # Nombre descriptivo
+
+# Modelo para la tabla "item_stock" (cantidad de cada item en cada ubicación)
+# items.quantity es el total de todas las ubicaciones y se actualiza en la misma transacción.
+# Las filas de un item se modifican siempre con la fila del item bloqueada
+class ItemStock(Base):
+    __tablename__ = "item_stock"
+
+    item_id = Column(Integer, primary_key=True)  # Sin FK, como los totales diarios: el purgado lo borra
+    location_id = Column(Integer, ForeignKey("locations.id"), primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)  # Cantidad del item en la ubicación
+
+    # Stock de una ubicación recorrido por item
+    __table_args__ = (Index("ix_item_stock_location_id_item_id", "location_id", "item_id"),)
+
+# Modelo para la tabla "stock_alerts" (alertas de reposición)
+# Un item tiene como mucho una alerta abierta: se abre cuando su cantidad baja hasta el punto de pedido y se
+# cierra cuando lo supera, siempre con la fila del item bloqueada
+class StockAlert(Base):
+    __tablename__ = "stock_alerts"
+
+    id = Column(Integer, primary_key=True)  # PK autoincremental
+    item_id = Column(Integer, nullable=False)  # Sin FK, como los totales diarios: el purgado la borra
+    reorder_point = Column(Integer, nullable=False)  # Punto de pedido cuando se abrió
+    quantity = Column(Integer, nullable=False)  # Cantidad que la abrió
+    created_at = Column(DateTime, nullable=False, index=True)  # Hora Madrid
+    resolved_at = Column(DateTime, nullable=True)  # Hora Madrid en que se cerró (None mientras está abierta)
+
+    # Alertas abiertas: un índice pequeño aunque se acumule el histórico
+    __table_args__ = (
+        Index(
+            "ix_stock_alerts_open_item_id", "item_id",
+            postgresql_where=text("resolved_at IS NULL"), sqlite_where=text("resolved_at IS NULL"),
+        ),
+    )
+
+# Modelo para la tabla "movement_archives" (meses de movimientos archivados en ficheros)
+class MovementArchive(Base):
+    __tablename__ = "movement_archives"
+
+    id = Column(Integer, primary_key=True, index=True)  # PK autoincremental
+    range_start = Column(DateTime, unique=True, nullable=False)  # Inicio del mes archivado (incluido)
+    range_end = Column(DateTime, nullable=False)  # Fin del mes archivado (excluido)
+    path = Column(String, nullable=False)  # Fichero NDJSON comprimido con gzip
+    row_count = Column(Integer, nullable=False)  # Movimientos archivados
+    created_at = Column(DateTime, nullable=False)  # Fecha del archivado
+
+# Modelo para la tabla "movement_daily_stats" (totales diarios de movimientos, mantenidos al escribir)
+class MovementDailyStat(Base):
+    __tablename__ = "movement_daily_stats"
+
+    day = Column(Date, primary_key=True)  # Día (hora Madrid) de los movimientos
+    item_id = Column(Integer, primary_key=True)  # Producto
+    username = Column(String, primary_key=True, default="")  # Usuario ("" si el movimiento no tiene)
+    type = Column(String, primary_key=True)  # Tipo de movimiento
+    amount = Column(Integer, nullable=False, default=0)  # Suma de amount
+    change = Column(Integer, nullable=False, default=0)  # Suma de quantity_after - quantity_before
+    movements = Column(Integer, nullable=False, default=0)  # Número de movimientos
+
+    # Consultas de un producto o de un usuario dentro de un periodo
+    __table_args__ = (
+        Index("ix_movement_daily_stats_username_day", "username", "day"),
+        Index("ix_movement_daily_stats_item_id_day", "item_id", "day"),
+    )
+
+# Modelo para la tabla "stock_snapshots" (fotos periódicas del stock de todos los items)
+class StockSnapshot(Base):
+    __tablename__ = "stock_snapshots"
+
+    id = Column(Integer, primary_key=True, index=True)  # PK autoincremental
+    taken_at = Column(DateTime, unique=True, nullable=False)  # Instante (hora Madrid) al que corresponde el stock
+    item_count = Column(Integer, default=0)  # Número de items incluidos
+
+    items = relationship("StockSnapshotItem", cascade="all, delete-orphan", passive_deletes=True)
+
+# Modelo para la tabla "stock_snapshot_items" (cantidad de cada item en una foto)
+class StockSnapshotItem(Base):
+    __tablename__ = "stock_snapshot_items"
+
+    snapshot_id = Column(Integer, ForeignKey("stock_snapshots.id", ondelete="CASCADE"), primary_key=True)
+    item_id = Column(Integer, primary_key=True)  # Sin FK: la foto se conserva aunque el item se borre
+    quantity = Column(Integer, nullable=False)  # Cantidad del item en taken_at
+
+# Modelo para la tabla "stock_events" (cambios de stock confirmados, para el canal en tiempo real)
+class StockEvent(Base):
+    __tablename__ = "stock_events"
+
+    id = Column(Integer, primary_key=True)  # Orden de los eventos y cursor de reanudación de los clientes
+    created_at = Column(DateTime, nullable=False, index=True)  # Hora Madrid (limpieza de eventos antiguos)
+    type = Column(String, nullable=False)  # stock, item_created, item_deleted o reset
+    payload = Column(Text, nullable=False)  # JSON con los items y movimientos del cambio
+    source = Column(String)  # Worker que hizo el cambio
+
+    __table_args__ = {"sqlite_autoincrement": True}  # Los ids no se reutilizan tras limpiar eventos
+
+# Modelo para la tabla "idempotency_keys" (respuestas de las escrituras con cabecera Idempotency-Key)
+# La clave primaria es la restricción única: dos peticiones con la misma clave no pueden guardarse a la vez
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    username = Column(String, primary_key=True)  # Usuario: las claves de cada usuario son independientes
+    key = Column(String, primary_key=True)  # Valor de la cabecera Idempotency-Key
+    request_hash = Column(String, nullable=False)  # SHA-256 del método, la ruta y el cuerpo de la petición
+    status_code = Column(Integer, nullable=False)  # Código HTTP de la respuesta guardada
+    response = Column(Text, nullable=True)  # Cuerpo JSON de la respuesta (None si no tiene)
+    created_at = Column(DateTime, nullable=False, index=True)  # Hora Madrid (limpieza de claves caducadas)
+
+# Modelo para la tabla "schema_version" (migraciones aplicadas, ver migrations.py)
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True, autoincrement=False)  # Número de la migración
+    name = Column(String, nullable=False)  # Descripción de la migración
+    applied_at = Column(DateTime, nullable=False)  # Fecha en que se aplicó (UTC)
+
 # Modelo para la tabla "users"
 class User(Base):
     __tablename__ = "users"  # Nombre tabla usuarios
@@ -41,7 +220,9 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)  # PK autoincremental
     username = Column(String, unique=True, index=True)  # Nombre de usuario único e indexado
     hashed_password = Column(String)  # Contraseña hasheada para seguridad
+    # Versión de la contraseña (claim "ver" del token): sube al cambiarla, no al recalcular el hash con otro coste
+    password_version = Column(Integer, nullable=False, default=0, server_default="0")
 
     # Método para verificar contraseña con la contraseña hasheada almacenada
     def verify_password(self, password: str):
-        return pwd_context.verify(password, self.hashed_password)
+        return verify_password(password, self.hashed_password)  # bcrypt en el pool de procesos
@@ -0,0 +1,115 @@
+import os
+from datetime import date, datetime
+
+from sqlalchemy import PrimaryKeyConstraint, text
+from sqlalchemy.ext.compiler import compiles
+
+# Particiones mensuales creadas por adelantado (además de la del mes actual)
+PARTITION_MONTHS_AHEAD = int(os.getenv("MOVEMENTS_PARTITION_MONTHS_AHEAD", "3"))
+PARTITION_LOCK_ID = 7312  # Clave del advisory lock que evita crear particiones desde dos procesos a la vez
+
+# -------------------------
+# Clave primaria de tablas particionadas
+# -------------------------
+
+# En PostgreSQL la clave primaria de una tabla particionada debe incluir la columna de partición.
+# Las tablas con info={"partition_key": columna} la añaden solo en el DDL de PostgreSQL: el ORM
+# (y SQLite, donde id sigue siendo INTEGER PRIMARY KEY autoincremental) siguen viendo solo "id"
+@compiles(PrimaryKeyConstraint, "postgresql")
+def compile_primary_key(restriccion, compilador, **kw):
+    texto = compilador.visit_primary_key_constraint(restriccion, **kw)
+    tabla = restriccion.table
+    clave = tabla.info.get("partition_key") if tabla is not None else None
+    if clave and clave not in restriccion.columns and texto.endswith(")"):
+        texto = texto[:-1] + ", " + compilador.preparer.quote(clave) + ")"
+    return texto
+
+# -------------------------
+# Rangos mensuales
+# -------------------------
+
+# Primer día del mes de una fecha
+def month_start(fecha) -> date:
+    return date(fecha.year, fecha.month, 1)
+
+# Primer día del mes desplazado n meses
+def add_months(fecha: date, meses: int) -> date:
+    indice = fecha.year * 12 + fecha.month - 1 + meses
+    return date(indice // 12, indice % 12 + 1, 1)
+
+# Nombre de la partición mensual de una tabla (p. ej. movements_2025_01)
+def partition_name(tabla: str, inicio: date) -> str:
+    return f"{tabla}_{inicio:%Y_%m}"
+
+# -------------------------
+# Gestión de particiones (PostgreSQL)
+# -------------------------
+
+# Indica si una tabla está particionada en la base de datos conectada
+def is_partitioned(conexion, tabla: str) -> bool:
+    if conexion.dialect.name != "postgresql":
+        return False
+    return bool(conexion.execute(
+        text(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = :tabla AND pg_table_is_visible(c.oid)"
+        ),
+        {"tabla": tabla},
+    ).scalar())
+
+# Indica si existe una tabla (o partición) con ese nombre
+def table_exists(conexion, nombre: str) -> bool:
+    return conexion.execute(text("SELECT to_regclass(:nombre) IS NOT NULL"), {"nombre": nombre}).scalar()
+
+# Partición por defecto: recoge filas fuera de los meses creados, para que ningún INSERT falle
+def create_default_partition(conexion, tabla: str):
+    conexion.execute(text(f"CREATE TABLE IF NOT EXISTS {tabla}_default PARTITION OF {tabla} DEFAULT"))
+
+# Crear la partición mensual que empieza en "inicio"; devuelve False si ya existía
+# Si la partición por defecto ya tiene filas de ese mes, se mueven a la nueva partición
+def create_month_partition(conexion, tabla: str, columna: str, inicio: date) -> bool:
+    nombre = partition_name(tabla, inicio)
+    if table_exists(conexion, nombre):
+        return False
+    fin = add_months(inicio, 1)
+    rango = {"inicio": datetime.combine(inicio, datetime.min.time()), "fin": datetime.combine(fin, datetime.min.time())}
+    limites = f"FOR VALUES FROM ('{inicio.isoformat()}') TO ('{fin.isoformat()}')"
+    defecto = f"{tabla}_default"
+    filtro = f"{columna} >= :inicio AND {columna} < :fin"
+
+    hay_filas = table_exists(conexion, defecto) and conexion.execute(
+        text(f"SELECT EXISTS (SELECT 1 FROM {defecto} WHERE {filtro})"), rango
+    ).scalar()
+    if not hay_filas:
+        conexion.execute(text(f"CREATE TABLE {nombre} PARTITION OF {tabla} {limites}"))
+        return True
+
+    # La partición por defecto no puede tener filas del rango nuevo: se separa, se mueven y se vuelve a unir
+    conexion.execute(text(f"ALTER TABLE {tabla} DETACH PARTITION {defecto}"))
+    conexion.execute(text(f"CREATE TABLE {nombre} PARTITION OF {tabla} {limites}"))
+    conexion.execute(text(f"INSERT INTO {nombre} SELECT * FROM {defecto} WHERE {filtro}"), rango)
+    conexion.execute(text(f"DELETE FROM {defecto} WHERE {filtro}"), rango)
+    conexion.execute(text(f"ALTER TABLE {tabla} ATTACH PARTITION {defecto} DEFAULT"))
+    return True
+
+# Asegurar las particiones del mes actual y de los próximos meses; devuelve las creadas
+def ensure_month_partitions(conexion, tabla: str, columna: str, meses: int = PARTITION_MONTHS_AHEAD):
+    if not is_partitioned(conexion, tabla):
+        return []
+    conexion.execute(text("SELECT pg_advisory_xact_lock(:clave)"), {"clave": PARTITION_LOCK_ID})
+    actual = month_start(date.today())
+    creadas = []
+    for desplazamiento in range(meses + 1):
+        inicio = add_months(actual, desplazamiento)
+        if create_month_partition(conexion, tabla, columna, inicio):
+            creadas.append(partition_name(tabla, inicio))
+    return creadas
+
+# Separar y borrar la partición mensual que empieza en "inicio" (sus filas ya deben estar archivadas)
+def drop_month_partition(conexion, tabla: str, inicio: date) -> bool:
+    nombre = partition_name(tabla, inicio)
+    if not table_exists(conexion, nombre):
+        return False
+    conexion.execute(text(f"ALTER TABLE {tabla} DETACH PARTITION {nombre}"))
+    conexion.execute(text(f"DROP TABLE {nombre}"))
+    return True
@@ -0,0 +1,95 @@
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+# Peticiones más lentas que este umbral guardan un perfil (0 = perfilador desactivado)
+PROFILE_THRESHOLD_MS = float(os.getenv("PROFILE_THRESHOLD_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))  # Intervalo de muestreo
+PROFILE_HISTORY_SECONDS = float(os.getenv("PROFILE_HISTORY_SECONDS", "30"))  # Muestras conservadas en memoria
+PROFILE_MIN_GAP_SECONDS = float(os.getenv("PROFILE_MIN_GAP_SECONDS", "10"))  # Un perfil cada N segundos como máximo
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+
+# Funciones en las que un hilo está parado esperando trabajo (threadpool inactivo, event loop sin eventos)
+IDLE_FRAMES = {"wait", "select", "_wait_for_tstate_lock"}
+
+# Perfilador por muestreo: un hilo toma cada pocos milisegundos la pila de todos los hilos del proceso.
+# Al terminar una petición lenta se guardan las muestras de su intervalo en formato "folded"
+# (una pila por línea, funciones separadas por ";" y número de muestras), entrada de flamegraph.pl o speedscope.
+# Es un perfil de tiempo real de todo el proceso: con peticiones simultáneas incluye también las suyas
+class SamplingProfiler:
+    def __init__(self, umbral_ms: float = PROFILE_THRESHOLD_MS, intervalo_ms: float = PROFILE_INTERVAL_MS,
+                 directorio: str = PROFILE_DIR):
+        self.umbral = umbral_ms / 1000
+        self.intervalo = intervalo_ms / 1000
+        self.directorio = directorio
+        self.samples = deque(maxlen=max(1, int(PROFILE_HISTORY_SECONDS / self.intervalo)))
+        self.parar = threading.Event()
+        self.hilo = None
+        self.ultimo_volcado = 0.0
+        self.lock = threading.Lock()
+        self.pendientes = queue.SimpleQueue()  # Peticiones lentas cuyo perfil falta por guardar
+
+    def start(self):
+        self.hilo = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.hilo.start()
+
+    def stop(self):
+        self.parar.set()
+
+    def _run(self):
+        propio = threading.get_ident()
+        while not self.parar.wait(self.intervalo):
+            ahora = time.perf_counter()
+            for hilo_id, marco in sys._current_frames().items():
+                if hilo_id != propio and marco.f_code.co_name not in IDLE_FRAMES:
+                    self.samples.append((ahora, folded_stack(marco)))
+            while not self.pendientes.empty():
+                self._dump(*self.pendientes.get())
+
+    # Llamado por el middleware al terminar cada petición. Solo encola: el perfil lo escribe el hilo
+    # del perfilador, sin añadir E/S de disco al event loop de la petición lenta
+    def request_finished(self, inicio: float, fin: float, metodo: str, ruta: str):
+        if fin - inicio < self.umbral:
+            return
+        with self.lock:
+            if fin - self.ultimo_volcado < PROFILE_MIN_GAP_SECONDS:
+                return  # Evitar llenar el disco si muchas peticiones son lentas a la vez
+            self.ultimo_volcado = fin
+        self.pendientes.put((inicio, fin, metodo, ruta))
+
+    # Guardar las muestras del intervalo de una petición lenta en formato "folded"
+    def _dump(self, inicio: float, fin: float, metodo: str, ruta: str):
+        pilas = Counter(pila for instante, pila in list(self.samples) if inicio <= instante <= fin)
+        if not pilas:
+            return
+        nombre = re.sub(r"[^A-Za-z0-9]+", "_", f"{metodo}_{ruta}").strip("_")
+        ruta_fichero = os.path.join(
+            self.directorio, f"{datetime.now():%Y%m%d-%H%M%S}-{nombre}-{(fin - inicio) * 1000:.0f}ms.folded"
+        )
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            with open(ruta_fichero, "w", encoding="utf-8") as fichero:
+                for pila, muestras in pilas.most_common():
+                    fichero.write(f"{pila} {muestras}\n")
+        except OSError as error:
+            print(f"No se pudo guardar el perfil de {metodo} {ruta}: {error}")  # El perfilador sigue muestreando
+            return
+        print(f"Perfil de {metodo} {ruta} ({(fin - inicio) * 1000:.0f} ms) guardado en {ruta_fichero}")
+
+# Pila de un marco desde la raíz, como "funcion (fichero:línea);..."
+def folded_stack(marco) -> str:
+    partes = []
+    while marco is not None:
+        codigo = marco.f_code
+        partes.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})")
+        marco = marco.f_back
+    return ";".join(reversed(partes))
+
+# Perfilador configurado por variables de entorno; None si está desactivado
+def create_profiler():
+    return SamplingProfiler() if PROFILE_THRESHOLD_MS > 0 else None
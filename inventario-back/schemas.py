@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from datetime import datetime
+from pydantic import BaseModel, field_validator, model_validator
+from datetime import date, datetime
 from typing import Optional
 
 
@@ -7,6 +7,11 @@ from typing import Optional
 # ITEM
 # -------------------------
 
+# Dígito de control de un EAN13 a partir de sus 12 primeros dígitos
+def ean13_check_digit(base: str) -> str:
+    suma = sum(int(digito) * (3 if posicion % 2 else 1) for posicion, digito in enumerate(base))
+    return str((10 - suma % 10) % 10)
+
 # Clase base para Item con campos comunes
 class ItemBase(BaseModel):
     sku: str  # Código SKU del producto
@@ -15,32 +20,90 @@ class ItemBase(BaseModel):
 # Modelo para crear un nuevo item, incluye cantidad inicial
 class ItemCreate(ItemBase):
     quantity: int  # Cantidad inicial del producto
+    location_id: Optional[int] = None  # Ubicación de la cantidad inicial (por defecto, la principal)
+    reorder_point: int = 0  # Punto de pedido (por defecto, alerta al agotarse)
+
+    # Un escaneo erróneo se rechaza sin llegar a la base de datos
+    @field_validator("ean13")
+    @classmethod
+    def check_ean13(cls, ean13: str) -> str:
+        if len(ean13) != 13 or not ean13.isdigit():
+            raise ValueError("El EAN13 debe tener 13 dígitos")
+        if ean13_check_digit(ean13[:12]) != ean13[12]:
+            raise ValueError("Dígito de control del EAN13 incorrecto")
+        return ean13
 
 # Modelo para actualizar un item, solo la cantidad
+# Sin ubicación es la cantidad total y la diferencia se aplica a la ubicación principal;
+# con ubicación es la cantidad en esa ubicación
 class ItemUpdate(BaseModel):
     quantity: int  # Nueva cantidad para actualizar
+    location_id: Optional[int] = None  # Ubicación cuya cantidad se fija (opcional)
 
 # Modelo para salida (response) de un item con todos los campos y orm_mode
 class ItemOut(ItemBase):
     id: int  # ID interno del producto
     quantity: int  # Cantidad actual del producto
+    reorder_point: Optional[int] = None  # Punto de pedido (None: sin alertas de reposición)
 
     class Config:
         orm_mode = True  # Permite usar objetos ORM directamente
 
+# Códigos a resolver en una sola petición (escáneres)
+class ItemResolveIn(BaseModel):
+    ean13: list[str] = []  # EAN13 leídos
+    sku: list[str] = []  # SKU leídos
+
+# Items encontrados por código y códigos sin item
+class ItemResolveOut(BaseModel):
+    ean13: dict[str, ItemOut]  # EAN13 -> item
+    sku: dict[str, ItemOut]  # SKU -> item
+    missing_ean13: list[str]  # EAN13 sin item activo
+    missing_sku: list[str]  # SKU sin item activo
+
+# Error de una línea durante la importación de items
+class ItemImportError(BaseModel):
+    line: int  # Número de línea del fichero (empezando en 1)
+    error: str  # Motivo del rechazo
+
+# Resumen de una importación masiva de items
+class ItemImportOut(BaseModel):
+    created: int  # Items nuevos
+    updated: int  # Items existentes cuya cantidad o EAN13 cambió
+    unchanged: int  # Items existentes sin cambios
+    rejected: int  # Líneas rechazadas
+    errors: list[ItemImportError]  # Detalle de las primeras líneas rechazadas
+
 # -------------------------
 # MOVEMENT
 # -------------------------
 
+TRANSFER_TYPE = "traspaso"  # Movimiento entre dos ubicaciones: no cambia la cantidad total del item
+
 # Clase base para movimientos con tipo y cantidad
 class MovementBase(BaseModel):
-    type: str  # Tipo de movimiento: 'entrada', 'salida' o 'ajuste'
+    type: str  # Tipo de movimiento: 'entrada', 'salida', 'ajuste' o 'traspaso'
     amount: int  # Cantidad de unidades movidas (puede ser positiva o negativa)
 
 # Modelo para crear un movimiento, añade id de item y usuario opcional
 class MovementCreate(MovementBase):
     item_id: int  # ID del producto afectado
     username: Optional[str] = None  # Nombre del usuario que realiza el movimiento (opcional)
+    location_id: Optional[int] = None  # Ubicación (origen en un traspaso); por defecto, la principal
+    to_location_id: Optional[int] = None  # Ubicación de destino (solo en traspasos)
+
+    # Un traspaso mueve unidades positivas entre dos ubicaciones distintas
+    @model_validator(mode="after")
+    def check_transfer(self):
+        if self.type != TRANSFER_TYPE:
+            if self.to_location_id is not None:
+                raise ValueError("to_location_id solo se admite en traspasos")
+            return self
+        if self.to_location_id is None:
+            raise ValueError("Un traspaso necesita la ubicación de destino (to_location_id)")
+        if self.amount <= 0:
+            raise ValueError("La cantidad de un traspaso debe ser positiva")
+        return self
 
 # Modelo para respuesta de movimiento con todos los datos
 class MovementOut(BaseModel):
@@ -52,10 +115,147 @@ class MovementOut(BaseModel):
     username: Optional[str] = None  # Usuario que realizó el movimiento (opcional)
     quantity_before: int  # Cantidad antes del movimiento
     quantity_after: int  # Cantidad después del movimiento
+    location_id: Optional[int] = None  # Ubicación (origen en un traspaso)
+    to_location_id: Optional[int] = None  # Ubicación de destino de un traspaso
 
     class Config:
         orm_mode = True  # Permite uso directo con objetos ORM
 
+# Resultado de un registro dentro de un lote de movimientos
+class MovementBatchResult(BaseModel):
+    index: int  # Posición del registro en el lote recibido
+    ok: bool  # Si el movimiento se ha aplicado
+    movement_id: Optional[int] = None  # ID del movimiento creado (si ok)
+    quantity_after: Optional[int] = None  # Cantidad del item tras aplicar el registro (si ok)
+    error: Optional[str] = None  # Motivo del rechazo (si no ok)
+
+# Respuesta de la ingesta por lotes de movimientos
+class MovementBatchOut(BaseModel):
+    accepted: int  # Registros aplicados
+    rejected: int  # Registros rechazados
+    results: list[MovementBatchResult]  # Resultado por registro, en el orden recibido
+
+# -------------------------
+# LOCATION
+# -------------------------
+
+# Modelo para crear una ubicación (almacén)
+class LocationCreate(BaseModel):
+    code: str  # Código corto, único
+    name: str  # Nombre descriptivo
+
+# Ubicación con su id
+class LocationOut(LocationCreate):
+    id: int  # ID de la ubicación
+
+    class Config:
+        from_attributes = True
+
+# Cantidad de un item en una ubicación
+class LocationStockOut(BaseModel):
+    location_id: int  # ID de la ubicación
+    code: str  # Código de la ubicación
+    quantity: int  # Cantidad del item en la ubicación
+
+# Stock de un item: total y reparto por ubicación
+class ItemStockOut(BaseModel):
+    item_id: int  # ID del producto
+    quantity: int  # Cantidad total (suma de las ubicaciones)
+    locations: list[LocationStockOut]  # Ubicaciones con stock (distinto de 0)
+
+# Item con stock en una ubicación
+class LocationItemOut(BaseModel):
+    item_id: int  # ID del producto
+    sku: str  # SKU del producto
+    ean13: str  # EAN13 del producto
+    quantity: int  # Cantidad en la ubicación
+
+# -------------------------
+# ALERTS
+# -------------------------
+
+# Modelo para cambiar el punto de pedido de un item
+class ReorderPointUpdate(BaseModel):
+    reorder_point: Optional[int] = None  # Cantidad a partir de la cual (incluida) se avisa; None: sin alertas
+
+# Alerta de reposición con el stock actual y la previsión de rotura
+class AlertOut(BaseModel):
+    id: int  # ID de la alerta
+    item_id: int  # ID del producto
+    sku: str  # SKU del producto
+    quantity: int  # Cantidad actual
+    reorder_point: Optional[int] = None  # Punto de pedido actual
+    triggered_quantity: int  # Cantidad que abrió la alerta
+    created_at: datetime  # Hora (Madrid) en que se abrió
+    resolved_at: Optional[datetime] = None  # Hora en que se cerró (None si sigue abierta)
+    daily_consumption: float  # Media diaria de unidades de salida en la ventana de consumo
+    days_to_stockout: Optional[float] = None  # Días hasta agotarse al consumo medio (None sin consumo)
+
+# -------------------------
+# SNAPSHOTS
+# -------------------------
+
+# Foto de stock tomada en una fecha
+class SnapshotOut(BaseModel):
+    id: int  # ID de la foto
+    taken_at: datetime  # Fecha (hora Madrid) a la que corresponde el stock
+    item_count: int  # Items incluidos
+
+    class Config:
+        from_attributes = True
+
+# Stock de un item a una fecha
+class StockAtOut(BaseModel):
+    item_id: int  # ID del producto
+    sku: str  # SKU del producto
+    ean13: str  # EAN13 del producto
+    quantity: int  # Cantidad en la fecha pedida
+
+    class Config:
+        from_attributes = True
+
+# -------------------------
+# ANALYTICS
+# -------------------------
+
+# Unidades movidas en un periodo por un producto o un usuario
+class ThroughputOut(BaseModel):
+    period: date  # Primer día del periodo
+    item_id: Optional[int] = None  # Producto (al agrupar por producto)
+    username: Optional[str] = None  # Usuario (al agrupar por usuario)
+    entrada: int  # Unidades de entrada
+    salida: int  # Unidades de salida
+    ajuste: int  # Suma de los ajustes
+    net_change: int  # Variación neta de stock
+    movements: int  # Número de movimientos
+
+    class Config:
+        from_attributes = True
+
+# Producto con más actividad en un rango de días
+class TopMoverOut(BaseModel):
+    item_id: int
+    sku: str
+    units_out: int  # Unidades de salida
+    units_in: int  # Unidades de entrada
+    movements: int  # Número de movimientos
+
+    class Config:
+        from_attributes = True
+
+# Rotación de stock de un producto en un rango de días
+class TurnoverOut(BaseModel):
+    item_id: int
+    sku: str
+    units_out: int  # Unidades de salida del periodo
+    stock_start: int  # Stock al inicio del periodo
+    stock_end: int  # Stock al final del periodo
+    average_stock: float  # Media de stock inicial y final
+    turnover: Optional[float] = None  # Salidas / stock medio (None si el stock medio no es positivo)
+
+    class Config:
+        from_attributes = True
+
 # -------------------------
 # USERS
 # -------------------------
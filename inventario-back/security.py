@@ -1,5 +1,126 @@
-from passlib.context import CryptContext  # Importa la clase para manejo seguro de contraseñas
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+import weakref
 
-# Crea un contexto para hashing de contraseñas usando el algoritmo bcrypt
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-# "deprecated='auto'" maneja automáticamente esquemas obsoletos si se usan
+# Coste de bcrypt (log2 de las iteraciones); al cambiarlo, los hashes antiguos se rehacen en el login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Procesos dedicados a bcrypt (0 = calcular en el propio proceso, en el hilo que lo pide)
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Operaciones bcrypt en curso como máximo; el resto espera en cola (tiempo medido en las métricas)
+BCRYPT_MAX_CONCURRENCY = int(os.getenv("BCRYPT_MAX_CONCURRENCY", str(max(1, BCRYPT_WORKERS))))
+
+# Contexto de passlib para bcrypt, creado al primer uso: los workers de la API no hashean
+# (lo hacen los procesos del pool), así no cargan passlib al arrancar
+_pwd_context = None
+
+def get_pwd_context():
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext  # Importa la clase para manejo seguro de contraseñas
+
+        _pwd_context = CryptContext(
+            schemes=["bcrypt"],
+            deprecated="auto",
+            bcrypt__default_rounds=BCRYPT_ROUNDS,
+            bcrypt__min_rounds=BCRYPT_ROUNDS,  # Un hash con otro coste se considera obsoleto...
+            bcrypt__max_rounds=BCRYPT_ROUNDS,  # ...y verify_and_update devuelve el hash nuevo
+        )
+        # "deprecated='auto'" maneja automáticamente esquemas obsoletos si se usan
+    return _pwd_context
+
+# -------------------------
+# Ejecución en procesos dedicados
+# -------------------------
+
+# Funciones ejecutadas dentro de los procesos del pool (deben ser importables)
+def _hash(password: str):
+    return get_pwd_context().hash(password)
+
+def _verify_and_update(password: str, hashed: str):
+    return get_pwd_context().verify_and_update(password, hashed)
+
+_executor = None
+_executor_lock = threading.Lock()
+_sync_slots = threading.BoundedSemaphore(BCRYPT_MAX_CONCURRENCY)  # Límite para llamadas síncronas
+_async_slots = weakref.WeakKeyDictionary()  # Límite para llamadas asíncronas, por event loop
+
+hashing_stats = {"tasks": 0, "in_flight": 0, "queue_seconds_total": 0.0, "queue_seconds_max": 0.0}
+_stats_lock = threading.Lock()
+
+# Pool de procesos creado al primer uso ("spawn": no hereda hilos ni conexiones del servidor)
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=BCRYPT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _executor
+
+def _record_queue_time(espera: float, delta_en_curso: int):
+    with _stats_lock:
+        if delta_en_curso > 0:
+            hashing_stats["tasks"] += 1
+            hashing_stats["queue_seconds_total"] += espera
+            hashing_stats["queue_seconds_max"] = max(hashing_stats["queue_seconds_max"], espera)
+        hashing_stats["in_flight"] += delta_en_curso
+
+# Ejecutar una función bcrypt bloqueando solo el hilo llamante (la CPU la gasta otro proceso)
+def _run_sync(funcion, *args):
+    inicio = time.perf_counter()
+    with _sync_slots:
+        _record_queue_time(time.perf_counter() - inicio, 1)
+        try:
+            if BCRYPT_WORKERS == 0:
+                return funcion(*args)
+            return get_executor().submit(funcion, *args).result()
+        finally:
+            _record_queue_time(0, -1)
+
+# Ejecutar una función bcrypt sin ocupar el event loop ni hilos del threadpool
+async def _run_async(funcion, *args):
+    bucle = asyncio.get_running_loop()
+    slots = _async_slots.setdefault(bucle, asyncio.Semaphore(BCRYPT_MAX_CONCURRENCY))
+    inicio = time.perf_counter()
+    async with slots:
+        _record_queue_time(time.perf_counter() - inicio, 1)
+        try:
+            if BCRYPT_WORKERS == 0:
+                return await bucle.run_in_executor(None, funcion, *args)
+            return await asyncio.wrap_future(get_executor().submit(funcion, *args))
+        finally:
+            _record_queue_time(0, -1)
+
+# -------------------------
+# API de contraseñas
+# -------------------------
+
+# Hashear contraseña (versión síncrona, para crud y scripts)
+def hash_password(password: str) -> str:
+    return _run_sync(_hash, password)
+
+# Verificar contraseña (versión síncrona)
+def verify_password(password: str, hashed: str) -> bool:
+    return _run_sync(_verify_and_update, password, hashed)[0]
+
+# Hashear contraseña sin bloquear el event loop
+async def hash_password_async(password: str) -> str:
+    return await _run_async(_hash, password)
+
+# Verificar contraseña; devuelve (válida, hash nuevo si el coste configurado ha cambiado o None)
+async def verify_and_update_async(password: str, hashed: str):
+    return await _run_async(_verify_and_update, password, hashed)
+
+# Tareas bcrypt realizadas, en curso y tiempo de espera en cola
+def get_hashing_metrics():
+    with _stats_lock:
+        return {
+            **hashing_stats,
+            "workers": BCRYPT_WORKERS,
+            "max_concurrency": BCRYPT_MAX_CONCURRENCY,
+            "rounds": BCRYPT_ROUNDS,
+        }
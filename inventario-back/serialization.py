@@ -0,0 +1,42 @@
+import json
+from datetime import date, datetime
+
+from starlette.responses import Response
+
+# orjson es opcional: si no está instalado se usa json de la biblioteca estándar con el mismo formato
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# -------------------------
+# Codificación JSON rápida
+# -------------------------
+
+# Fechas en ISO 8601, igual que las serializa Pydantic
+def _default(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    raise TypeError(f"Tipo no serializable a JSON: {type(valor).__name__}")
+
+# Convertir un valor (listas, dicts, números, textos, fechas) a JSON compacto en bytes
+def dumps(valor) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(valor)
+    return json.dumps(valor, default=_default, separators=(",", ":"), ensure_ascii=False).encode()
+
+# Campos de un esquema de respuesta, en el orden en que Pydantic los serializa
+def schema_fields(esquema) -> tuple:
+    return tuple(esquema.model_fields)
+
+# Filas (Row de SQLAlchemy o tuplas) con las columnas en el orden de los campos, como dicts del esquema.
+# Sustituye a validar cada fila con Pydantic: las consultas ya devuelven los tipos del esquema
+def rows_to_dicts(filas, campos: tuple) -> list:
+    return [dict(zip(campos, fila)) for fila in filas]
+
+# Respuesta JSON codificada con dumps; el endpoint conserva su response_model para la documentación
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,37 @@
+# Base de datos de las pruebas. Por defecto, una base de datos SQLite temporal; con TEST_DATABASE_URL,
+# la indicada (se migra y se le añaden items, no se borra nada):
+#   TEST_DATABASE_URL=postgresql://usuario@localhost/inventario_test python -m pytest tests
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL") or f"sqlite:///{tempfile.mkdtemp()}/pruebas.db"
+
+# database.py lee la conexión al importarse
+os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+os.environ["DB_ASYNC"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crud  # noqa: E402
+import migrations  # noqa: E402
+from database import SessionLocal, engine  # noqa: E402
+from schemas import ItemCreate, ean13_check_digit  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def esquema():
+    migrations.migrate(engine)
+
+
+# Crear un item con SKU y EAN13 únicos, para no depender de los datos de la base de datos
+def nuevo_item(cantidad: int) -> int:
+    base = str(uuid.uuid4().int)[:12]
+    with SessionLocal() as db:
+        item, error = crud.create_item(db, ItemCreate(
+            sku=f"TEST-{uuid.uuid4().hex[:12]}", ean13=base + ean13_check_digit(base), quantity=cantidad,
+        ))
+        assert error is None
+        return item.id
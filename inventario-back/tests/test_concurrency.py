@@ -0,0 +1,92 @@
+# Prueba de estrés: muchos hilos moviendo stock de un mismo item a la vez
+# Por defecto usa una base de datos SQLite temporal (BEGIN IMMEDIATE); con TEST_DATABASE_URL apuntando a
+# PostgreSQL prueba sus bloqueos de fila (ver conftest.py)
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import crud
+from conftest import nuevo_item
+from database import SessionLocal
+from models import Item, Movement
+from schemas import ItemUpdate, MovementCreate
+
+HILOS = int(os.getenv("STRESS_THREADS", "16"))  # Hilos concurrentes
+MOVIMIENTOS = int(os.getenv("STRESS_MOVEMENTS", "2000"))  # Movimientos en total
+CANTIDAD_INICIAL = 100000  # Suficiente para que ninguna salida deje el stock en negativo
+
+
+@pytest.fixture
+def item_id():
+    return nuevo_item(CANTIDAD_INICIAL)
+
+
+# Movimiento en una sesión propia, como cada petición
+def mover(item_id: int, tipo: str, cantidad: int):
+    with SessionLocal() as db:
+        movimiento, error = crud.create_movement(db, MovementCreate(item_id=item_id, type=tipo, amount=cantidad))
+        assert error is None, error
+        return movimiento.quantity_after - movimiento.quantity_before
+
+
+# Ajuste de la cantidad total en una sesión propia
+def ajustar(item_id: int, cantidad: int):
+    with SessionLocal() as db:
+        _, error = crud.update_item_quantity(db, item_id, ItemUpdate(quantity=cantidad))
+        assert error is None, error
+
+
+# Comprobar que los movimientos del item forman una cadena sin huecos que acaba en su cantidad actual
+def comprobar_cadena(item_id: int):
+    with SessionLocal() as db:
+        movimientos = (
+            db.query(Movement).filter(Movement.item_id == item_id).order_by(Movement.timestamp, Movement.id).all()
+        )
+        cantidad = db.get(Item, item_id).quantity
+        informe = crud.check_consistency(db)
+    anterior = 0
+    for movimiento in movimientos:
+        assert movimiento.quantity_before == anterior, f"Cadena rota en el movimiento {movimiento.id}"
+        anterior = movimiento.quantity_after
+    assert anterior == cantidad
+    assert informe["broken_links"] == 0
+    assert informe["item_mismatches"] == 0
+    return cantidad, movimientos
+
+
+def test_movimientos_concurrentes(item_id):
+    rng = random.Random(1)
+    operaciones = [(rng.choice(["entrada", "salida"]), rng.randint(1, 20)) for _ in range(MOVIMIENTOS)]
+    with ThreadPoolExecutor(max_workers=HILOS) as pool:
+        deltas = list(pool.map(lambda op: mover(item_id, *op), operaciones))
+
+    esperado = CANTIDAD_INICIAL + sum(c if tipo == "entrada" else -c for tipo, c in operaciones)
+    assert sum(deltas) == esperado - CANTIDAD_INICIAL
+    cantidad, movimientos = comprobar_cadena(item_id)
+    assert cantidad == esperado
+    assert len(movimientos) == MOVIMIENTOS + 1  # Más el movimiento de creación
+
+
+def test_movimientos_y_ajustes_concurrentes(item_id):
+    rng = random.Random(2)
+    operaciones = [
+        ("ajuste", rng.randint(CANTIDAD_INICIAL // 2, CANTIDAD_INICIAL)) if rng.random() < 0.2
+        else (rng.choice(["entrada", "salida"]), rng.randint(1, 20))
+        for _ in range(MOVIMIENTOS)
+    ]
+
+    def ejecutar(operacion):
+        tipo, cantidad = operacion
+        if tipo == "ajuste":
+            ajustar(item_id, cantidad)
+        else:
+            mover(item_id, tipo, cantidad)
+
+    with ThreadPoolExecutor(max_workers=HILOS) as pool:
+        list(pool.map(ejecutar, operaciones))
+
+    # La cantidad final es la inicial más la suma de las variaciones registradas, en cualquier orden de ejecución
+    cantidad, movimientos = comprobar_cadena(item_id)
+    assert cantidad == sum(m.quantity_after - m.quantity_before for m in movimientos)
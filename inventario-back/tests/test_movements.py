@@ -0,0 +1,56 @@
+# Regla de stock de los movimientos: un movimiento suelto y un lote rechazan lo mismo
+# (salidas y traspasos que dejarían la ubicación en negativo)
+import uuid
+
+import pytest
+
+import crud
+from conftest import nuevo_item
+from database import SessionLocal
+from models import Item, Movement
+from schemas import TRANSFER_TYPE, LocationCreate, MovementCreate
+
+
+# Aplicar un movimiento suelto y el mismo en un lote; devuelve los dos errores
+def errores_suelto_y_lote(movimiento: MovementCreate):
+    with SessionLocal() as db:
+        _, error_suelto = crud.create_movement(db, movimiento)
+    with SessionLocal() as db:
+        resumen = crud.create_movements_batch(db, [movimiento])
+    return error_suelto, resumen["results"][0]["error"]
+
+
+def estado(item_id: int):
+    with SessionLocal() as db:
+        cantidad = db.get(Item, item_id).quantity
+        movimientos = db.query(Movement).filter(Movement.item_id == item_id).count()
+    return cantidad, movimientos
+
+
+@pytest.fixture
+def ubicacion_id():
+    with SessionLocal() as db:
+        ubicacion, error = crud.create_location(db, LocationCreate(code=f"T-{uuid.uuid4().hex[:8]}", name="Pruebas"))
+        assert error is None
+        return ubicacion.id
+
+
+def test_salida_sin_stock():
+    item_id = nuevo_item(5)
+    assert errores_suelto_y_lote(MovementCreate(item_id=item_id, type="salida", amount=6)) == (
+        crud.INSUFFICIENT_STOCK, crud.INSUFFICIENT_STOCK
+    )
+    assert estado(item_id) == (5, 1)  # Sin cambios: solo el movimiento de creación
+
+    # El rechazo no deja el item en un estado que haga fallar los lotes siguientes
+    with SessionLocal() as db:
+        resumen = crud.create_movements_batch(db, [MovementCreate(item_id=item_id, type="salida", amount=5)])
+    assert resumen["accepted"] == 1
+    assert estado(item_id) == (0, 2)
+
+
+def test_traspaso_sin_stock_en_origen(ubicacion_id):
+    item_id = nuevo_item(5)
+    traspaso = MovementCreate(item_id=item_id, type=TRANSFER_TYPE, amount=6, to_location_id=ubicacion_id)
+    assert errores_suelto_y_lote(traspaso) == (crud.INSUFFICIENT_STOCK, crud.INSUFFICIENT_STOCK)
+    assert estado(item_id) == (5, 1)
@@ -104,9 +104,15 @@ function StockList() {
 
   const verHistorial = async (id) => {
     try {
-      const res = await fetchWithAuth(`${API_URL}/movements`);
-      const data = await res.json();
-      const historial = data.filter(mov => mov.item_id === id);
+      // Pedir páginas de 1000 siguiendo X-Next-Cursor hasta tener el historial completo
+      const historial = [];
+      let cursor = null;
+      do {
+        const parametros = cursor ? `&cursor=${encodeURIComponent(cursor)}` : '';
+        const res = await fetchWithAuth(`${API_URL}/items/${id}/movements?limit=1000${parametros}`);
+        historial.push(...await res.json());
+        cursor = res.headers.get('X-Next-Cursor');
+      } while (cursor);
       if (historial.length === 0) {
         alert('Este producto no tiene movimientos.');
       } else {